@@ -0,0 +1,157 @@
+import hashlib
+import math
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from query_cache import CacheStats
+
+# ENVIRONMENT VARIABLES
+# Trueの場合、初回の質問に対する回答をキャッシュし、類似の質問に同じ回答を返す
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+# キャッシュした回答を使う、質問文のベクトル値のコサイン類似度の下限
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.95"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "500"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+# キャッシュした回答を画面に流す、1回あたりの文字数
+ANSWER_CACHE_REPLAY_CHUNK_CHARS = int(os.getenv("ANSWER_CACHE_REPLAY_CHUNK_CHARS", "16"))
+
+
+def answer_sources(search_items: list) -> tuple:
+    """回答の元になった検索結果を、キャッシュの照合に使うキーにする。
+    アイテムのIDと内容のハッシュ値の組のため、アイテムが更新または削除された場合や、
+    検索結果の顔ぶれが変わった場合はキャッシュした回答を使わない。
+
+    Args:
+        search_items (list): 回答の生成に使った検索結果のアイテムのリスト
+
+    Returns:
+        tuple: (アイテムのID, 内容のハッシュ値) の組を並べたタプル
+    """
+    return tuple(sorted(
+        (str(item.get("id")), hashlib.sha1((item.get("content") or "").encode("utf-8")).hexdigest())
+        for item in search_items))
+
+
+@dataclass
+class _AnswerEntry:
+    embedding: array
+    sources: tuple
+    answer: str
+    expires_at: float
+
+
+class AnswerCache:
+    """初回の質問に対する回答を、質問文のベクトル値のコサイン類似度で検索するキャッシュ。
+    回答の元になった検索結果（answer_sources）が一致するエントリーのみを比較するため、比較する件数は少ない。
+    有効期限付きのLRUで、スレッドセーフ。ヒット率と追い出した件数を記録する。
+    """
+
+    def __init__(self, threshold: float = ANSWER_CACHE_SIMILARITY_THRESHOLD,
+                 max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS) -> None:
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stats = CacheStats()
+        # 上限または有効期限により削除したエントリー数
+        self.evictions = 0
+        # エントリーのIDとエントリー（最も古く使われたものが先頭）
+        self._entries = OrderedDict()
+        # 検索結果のキーと、エントリーのIDの集合
+        self._by_sources = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, embedding: list, sources: tuple):
+        """類似の質問に対する回答を取得する。
+
+        Args:
+            embedding (list): 質問文のベクトル値
+            sources (tuple): answer_sources で作成した検索結果のキー
+
+        Returns:
+            str | None: 回答。ない場合はNone
+        """
+        query = _unit(embedding)
+        with self._lock:
+            entry_id, _ = self._find(query, sources)
+            if entry_id is None:
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(entry_id)
+            self.stats.hits += 1
+            return self._entries[entry_id].answer
+
+    def store(self, embedding: list, sources: tuple, answer: str) -> None:
+        """回答を登録する。類似の質問の回答が登録済みの場合は置き換える。
+
+        Args:
+            embedding (list): 質問文のベクトル値
+            sources (tuple): answer_sources で作成した検索結果のキー
+            answer (str): 回答
+        """
+        query = _unit(embedding)
+        with self._lock:
+            entry_id, _ = self._find(query, sources)
+            if entry_id is not None:
+                self._remove(entry_id)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = _AnswerEntry(query, sources, answer, time.monotonic() + self.ttl_seconds)
+            self._by_sources.setdefault(sources, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._by_sources.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _find(self, query: array, sources: tuple) -> tuple:
+        """検索結果が一致するエントリーのうち、類似度がしきい値以上で最も高いものを返す。期限切れのエントリーは削除する。
+        """
+        now = time.monotonic()
+        best_id, best_score = None, self.threshold
+        for entry_id in list(self._by_sources.get(sources, ())):
+            entry = self._entries[entry_id]
+            if entry.expires_at < now:
+                self._remove(entry_id)
+                self.evictions += 1
+                continue
+            score = sum(map(float.__mul__, entry.embedding, query))
+            if score >= best_score:
+                best_id, best_score = entry_id, score
+        return best_id, best_score
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        entry_ids = self._by_sources[entry.sources]
+        entry_ids.discard(entry_id)
+        if not entry_ids:
+            del self._by_sources[entry.sources]
+
+
+def replay_answer(answer: str, chunk_chars: int = ANSWER_CACHE_REPLAY_CHUNK_CHARS):
+    """キャッシュした回答を、ストリーミングの回答と同じように断片に分けて返す。
+
+    Yields:
+        str: 回答の断片
+    """
+    chunk_chars = max(1, chunk_chars)
+    for start in range(0, len(answer), chunk_chars):
+        yield answer[start:start + chunk_chars]
+
+
+def _unit(embedding: list) -> array:
+    """内積がコサイン類似度になるよう、長さを1にしたベクトル値を返す。
+    """
+    norm = math.sqrt(sum(value * value for value in embedding)) or 1.0
+    return array("d", (value / norm for value in embedding))
@@ -2,12 +2,20 @@ import streamlit as st
 from streamlit_chat import message
 import os
 
+import telemetry
 from openai_service import AzureOpenAIService
 from cosmos_service import CosmosService
+from query_cache import CorpusVersionTracker, RetrievalCache
+from chat_engine import ChatEngine, ThrottledRenderer
+from answer_cache import ANSWER_CACHE_ENABLED, AnswerCache
 
 # ENVIRONMENT VARIABLES
 AOAI_CHAT_DEPLOYMENT = os.getenv("AOAI_CHAT_DEPLOYMENT")
 VECTOR_SCORE_THRESHOLD = float(os.getenv("VECTOR_SCORE_THRESHOLD"))
+# Trueの場合、CosmosDBのベクトル検索の代わりにローカルのベクトルインデックスで検索する
+LOCAL_VECTOR_INDEX = os.getenv("LOCAL_VECTOR_INDEX", "false").lower() == "true"
+# Trueの場合、ベクトル検索とキーワード検索を組み合わせたハイブリッド検索を行う
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "true").lower() == "true"
 
 # PROMPT SETUP
 system_prompt_chat = """あなたはAIアシスタントです。問い合わせに対し「# 検索結果」の内容をもとに回答してください。
@@ -20,8 +28,92 @@ system_prompt_chat = """あなたはAIアシスタントです。問い合わせ
 """
 
 # Client
-aoai_service = AzureOpenAIService()
-cosmos_service = CosmosService()
+@st.cache_resource
+def get_aoai_service() -> AzureOpenAIService:
+    """Azure OpenAIのサービスを取得する。再実行やセッションをまたいで共有し、接続を使い回す。
+    """
+    return AzureOpenAIService()
+
+
+@st.cache_resource
+def get_cosmos_service() -> CosmosService:
+    """CosmosDBのサービスを取得する。再実行やセッションをまたいで共有し、接続を使い回す。
+    """
+    return CosmosService()
+
+
+@st.cache_resource
+def get_vector_index():
+    """ローカルのベクトルインデックスを取得する。セッション間で共有し、初回のみ読み込む。
+    numpyの読み込みを遅らせるため、使う時にモジュールを読み込む。
+    """
+    from vector_index import LocalVectorIndex
+    return LocalVectorIndex(get_cosmos_service()).start()
+
+
+@st.cache_resource
+def get_retrieval_cache() -> RetrievalCache:
+    """質問文のベクトル値と検索結果のキャッシュを取得する。セッション間で共有する。
+    """
+    return RetrievalCache()
+
+
+@st.cache_resource
+def get_answer_cache() -> AnswerCache:
+    """初回の質問に対する回答のキャッシュを取得する。セッション間で共有する。
+    """
+    return AnswerCache()
+
+
+@st.cache_resource
+def get_corpus_version_tracker() -> CorpusVersionTracker:
+    """CosmosDBのコーパスのバージョンを追跡する。セッション間で共有する。
+    """
+    return CorpusVersionTracker(get_cosmos_service())
+
+
+@st.cache_resource
+def get_chat_engine() -> ChatEngine:
+    """検索と回答の生成を画面の描画と並行して実行するエンジンを取得する。セッション間で共有する。
+    """
+    return ChatEngine(get_aoai_service(), get_retrieval_cache(), AOAI_CHAT_DEPLOYMENT,
+                      system_prompt_chat, VECTOR_SCORE_THRESHOLD, HYBRID_SEARCH,
+                      answer_cache=get_answer_cache() if ANSWER_CACHE_ENABLED else None)
+
+
+def get_search_backend():
+    """ベクトル検索を行う関数とコーパスのバージョンを返す関数を作成する。
+    st.cache_resource の値はスクリプトのスレッドで取得し、コーパスの確認と検索はエンジンのスレッドで実行する。
+    """
+    if LOCAL_VECTOR_INDEX:
+        vector_index = get_vector_index()
+
+        def search_backend(keywords):
+            search = (lambda embedding, threshold: vector_index.search_hybrid(embedding, keywords, threshold)) \
+                if keywords else vector_index.search
+            return search, vector_index.version
+    else:
+        cosmos_service = get_cosmos_service()
+        corpus_version_tracker = get_corpus_version_tracker()
+
+        def search_backend(keywords):
+            search = (lambda embedding, threshold: cosmos_service.get_items_by_hybrid(embedding, keywords, threshold)) \
+                if keywords else cosmos_service.get_items_by_vector
+            return search, corpus_version_tracker.current()
+    return search_backend
+
+
+chat_engine = get_chat_engine()
+
+
+def cancel_chat_turn():
+    """実行中の質問の検索と回答の生成を取り消す。
+    """
+    chat_turn = st.session_state.get("chat_turn")
+    if chat_turn is not None:
+        chat_turn.cancel()
+        st.session_state["chat_turn"] = None
+
 
 # SESSION MANAGEMENT
 if "chat_messages" not in st.session_state:
@@ -34,11 +126,28 @@ st.title("🚀Udemy RAG")
 # SIDEBAR SETUP
 clear_button = st.sidebar.button("Clear Conversation", key="clear")
 if clear_button:
+    cancel_chat_turn()
     st.session_state["chat_messages"] = []
 
+# キャッシュのヒット率を表示
+retrieval_cache = get_retrieval_cache()
+answer_cache_caption = f"  \nAnswer cache: {get_answer_cache().stats}" if ANSWER_CACHE_ENABLED else ""
+st.sidebar.caption(
+    f"Embedding cache: {retrieval_cache.embeddings.stats}  \n"
+    f"Search cache: {retrieval_cache.results.stats}{answer_cache_caption}")
+
 # with container:
 user_message = st.chat_input("user:")
-assistant_text = ""
+
+# 新しい質問が届いたら、前の質問の処理を取り消し、過去のメッセージの描画と並行してベクトル化と検索を始める
+chat_turn = None
+if user_message:
+    cancel_chat_turn()
+    chat_turn = chat_engine.start(
+        user_message,
+        [*st.session_state["chat_messages"], {"role": "user", "content": user_message}],
+        get_search_backend())
+    st.session_state["chat_turn"] = chat_turn
 
 # 過去のチャットメッセージを表示
 for text_info in st.session_state["chat_messages"]:
@@ -46,7 +155,7 @@ for text_info in st.session_state["chat_messages"]:
         st.write(text_info["content"])
 
 # ユーザーの入力がある場合
-if user_message:
+if chat_turn:
     # ユーザーの入力を表示
     with st.chat_message("user", avatar="user"):
         st.write(user_message)
@@ -55,58 +164,28 @@ if user_message:
     st.session_state["chat_messages"].append(
         {"role": "user", "content": user_message})
 
-    # CosmosDBでベクトル検索
-    search_items = cosmos_service.get_items_by_vector(
-        aoai_service.getEmbedding(
-            input=user_message
-        ),
-        VECTOR_SCORE_THRESHOLD
-    )
-
-    # システムメッセージに検索結果を追加
-    system_message = system_prompt_chat + "\n\n# 検索結果"
-    # 画面に表示する検索結果
-    display_searched_file_name = "\n\n---\n #### 参考情報"
-    for index, result in enumerate(search_items):
-        # ループ番号を付与してファイルの内容をシステムメッセージに追加
-        system_message += f'\n\n--- {index + 1} ---\n{result["content"]}'
-        # 画面に表示する検索結果を追加
-        display_searched_file_name += f'\n{index + 1}. {result["file_name"]}  (page{result["page_number"]})  : {result["SimilarityScore"]}'
-    print(f"system_message: {system_message}")
-
-    # OpenAIリクエスト用のメッセージ
-    messages = [
-        {"role": "system", "content": system_message},
-        *st.session_state["chat_messages"],
-    ]
-
-    # OpenAI Chat APIで回答を取得
-    response = aoai_service.openai.chat.completions.create(
-        model=AOAI_CHAT_DEPLOYMENT,
-        messages=[
-            {"role": "system", "content": system_message},
-            *st.session_state["chat_messages"],
-        ],
-        stream=True,
-    )
-    # AIからの回答をStreamで表示
-    with st.chat_message("assistant", avatar="assistant"):
-        place_assistant = st.empty()
-        for chunk in response:
-            if chunk.choices:
-                content = chunk.choices[0].delta.content
-                if content:
-                    assistant_text += content
-                    place_assistant.write(assistant_text)
-            else:
-                content = None
+    # AIからの回答をStreamで表示。描画は一定の間隔でまとめて行う
+    # 最初のトークンまでの時間と生成の時間は、このスパンの属性として記録する
+    with st.chat_message("assistant", avatar="assistant"), telemetry.span("chat.completion") as span:
+        renderer = ThrottledRenderer(st.empty())
+        for content in chat_turn.stream():
+            renderer.append(content)
+        renderer.flush()
+        span.set("chat.renders", renderer.renders)
+        span.set("chat.answer_cache_hit", chat_turn.cached)
+        for key, value in telemetry.token_usage(chat_turn).items():
+            span.set(key, value)
 
         # 検索結果があれば、検索結果をAI回答の末尾に追加
+        search_items = chat_turn.search_items()
         place_append = st.empty()
         if search_items:
-            place_append.write(display_searched_file_name)
+            place_append.write("\n\n---\n #### 参考情報" + "".join(
+                f'\n{index + 1}. {result["file_name"]}  (page{result["page_number"]})  : {result["SimilarityScore"]}'
+                for index, result in enumerate(search_items)))
 
     # AIの回答をchat_messagesに追加
     st.session_state["chat_messages"].append(
-        {"role": "assistant", "content": assistant_text}
+        {"role": "assistant", "content": renderer.text}
     )
+    st.session_state["chat_turn"] = None
@@ -0,0 +1,253 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import telemetry
+from answer_cache import answer_sources, replay_answer
+from context_builder import build_system_message, select_search_items, trim_history
+from keyword_extractor import extract_keywords
+
+# ENVIRONMENT VARIABLES
+# ベクトル化と検索を実行するスレッド数。セッション間で共有する
+CHAT_ENGINE_MAX_WORKERS = int(os.getenv("CHAT_ENGINE_MAX_WORKERS", "8"))
+# 回答のストリーミング中に画面を更新する1秒あたりの回数
+CHAT_RENDER_FPS = float(os.getenv("CHAT_RENDER_FPS", "10"))
+# 0より大きい場合、1秒あたりの回数の代わりに、この文字数が溜まるごとに画面を更新する
+CHAT_RENDER_CHUNK_CHARS = int(os.getenv("CHAT_RENDER_CHUNK_CHARS", "0"))
+# Trueの場合、ストリーミングの最後のチャンクでトークン使用量を受け取る（stream_options に対応したAPIバージョンが必要）
+AOAI_STREAM_USAGE = os.getenv("AOAI_STREAM_USAGE", "false").lower() == "true"
+
+
+class ThrottledRenderer:
+    """ストリーミングの回答を、一定の間隔（または文字数）ごとにまとめて画面に反映する。
+    トークンごとに回答全体を描画し直すと、長い回答では描画の合計がトークン数の2乗に比例するため、描画の回数を制限する。
+    """
+
+    def __init__(self, placeholder, fps: float = CHAT_RENDER_FPS,
+                 chunk_chars: int = CHAT_RENDER_CHUNK_CHARS) -> None:
+        """
+        Args:
+            placeholder (_type_): 回答を描画する st.empty()
+            fps (float, optional): 1秒あたりの最大の描画回数。0以下の場合はトークンごとに描画する
+            chunk_chars (int, optional): 0より大きい場合、この文字数が溜まるごとに描画する
+        """
+        self.placeholder = placeholder
+        self.interval = 1 / fps if fps > 0 else 0.0
+        self.chunk_chars = chunk_chars
+        self.renders = 0
+        self._text = ""
+        self._pending = []
+        self._pending_chars = 0
+        self._rendered_at = 0.0
+
+    @property
+    def text(self) -> str:
+        """これまでに受け取った回答の全体。
+        """
+        if self._pending:
+            self._text += "".join(self._pending)
+            self._pending.clear()
+        return self._text
+
+    def append(self, content: str) -> None:
+        """回答の断片を追加し、間隔（または文字数）に達していれば描画する。
+        """
+        self._pending.append(content)
+        self._pending_chars += len(content)
+        if self.chunk_chars > 0:
+            if self._pending_chars >= self.chunk_chars:
+                self.flush()
+        elif time.monotonic() - self._rendered_at >= self.interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """描画していない断片があれば描画する。ストリーミングの終了時に呼び出す。
+        """
+        if not self._pending_chars:
+            return
+        self._pending_chars = 0
+        self.placeholder.write(self.text)
+        self._rendered_at = time.monotonic()
+        self.renders += 1
+
+
+class ChatTurn:
+    """1回の質問に対する検索と回答の生成。
+    検索は作成時にバックグラウンドで始まり、stream で回答を生成する。cancel で処理を取り消す。
+    """
+
+    def __init__(self, engine: "ChatEngine", user_message: str, history: list) -> None:
+        self.engine = engine
+        self.user_message = user_message
+        # 質問を含むチャット履歴。画面側の履歴が変わっても影響を受けないようにコピーする
+        self.history = list(history)
+        self.cancelled = threading.Event()
+        self.retrieval: Future = None
+        # 質問文のベクトル値（検索時に設定する）と、回答をキャッシュから返したかどうか
+        self.embedding = None
+        self.cached = False
+        # 回答のトークン使用量（AOAI_STREAM_USAGE が有効な場合のみ）
+        self.usage = None
+        # 最初のトークンまでの時間は、質問を受け付けた時点から計測する
+        self.started = time.perf_counter()
+        self._response = None
+        self._lock = threading.Lock()
+
+    def search_items(self, timeout: float = None) -> list:
+        """検索結果を返す。検索が終わっていない場合は待つ。
+
+        Returns:
+            list: トークン数の上限に収まるように選んだ検索結果のアイテムのリスト
+        """
+        return self.retrieval.result(timeout)
+
+    def stream(self):
+        """検索結果をもとに、回答をストリーミングで生成する。
+
+        Yields:
+            str: 回答の断片。取り消された場合はその時点で終了する
+        """
+        search_items = self.search_items()
+        if self.cancelled.is_set():
+            return
+        # 初回の質問は、類似の質問に対する同じ検索結果からの回答がキャッシュにあれば、それを返す
+        answer_cache = self.engine.answer_cache if len(self.history) == 1 else None
+        if answer_cache is not None:
+            sources = answer_sources(search_items)
+            answer = answer_cache.lookup(self.embedding, sources)
+            if answer is not None:
+                self.cached = True
+                yield from self._replay(answer)
+                return
+        system_message = build_system_message(self.engine.system_prompt, search_items)
+        # 検索結果を含むプロンプトは、ログレベルがDEBUGの場合のみ出力する
+        if telemetry.content_logging_enabled():
+            logging.debug(f"system_message: {system_message}")
+        # OpenAIリクエスト用のメッセージ。チャット履歴は直近の分のみ送信する
+        messages = [
+            {"role": "system", "content": system_message},
+            *trim_history(self.history),
+        ]
+        response = self.engine.aoai_service.client.chat.completions.create(
+            model=self.engine.chat_deployment,
+            messages=messages,
+            stream=True,
+            **({"stream_options": {"include_usage": True}} if AOAI_STREAM_USAGE else {}),
+        )
+        with self._lock:
+            self._response = response
+        # 登録までの間に取り消された場合も、レスポンスを閉じる
+        if self.cancelled.is_set():
+            self._close()
+            return
+        first_token_at = None
+        parts = []
+        try:
+            for chunk in response:
+                if self.cancelled.is_set():
+                    return
+                if getattr(chunk, "usage", None) is not None:
+                    self.usage = chunk.usage
+                if chunk.choices:
+                    content = chunk.choices[0].delta.content
+                    if content:
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                            telemetry.record_stage("chat.ttft", first_token_at - self.started)
+                        parts.append(content)
+                        yield content
+            if first_token_at is not None:
+                telemetry.record_stage("chat.generation", time.perf_counter() - first_token_at)
+            # 最後まで生成できた回答のみキャッシュする
+            if answer_cache is not None and parts and not self.cancelled.is_set():
+                answer_cache.store(self.embedding, sources, "".join(parts))
+        except Exception:
+            # 取り消しでレスポンスを閉じた場合の読み取りエラーは無視する
+            if self.cancelled.is_set():
+                return
+            raise
+        finally:
+            self._close()
+
+    def _replay(self, answer: str):
+        """キャッシュした回答を、ストリーミングの回答と同じ断片の形で返す。
+        """
+        telemetry.record_stage("chat.ttft", time.perf_counter() - self.started, {"cached": True})
+        for content in replay_answer(answer):
+            if self.cancelled.is_set():
+                return
+            yield content
+
+    def cancel(self) -> None:
+        """検索と回答の生成を取り消す。実行中の検索は結果を使わず、回答のストリーミングは接続を閉じる。
+        """
+        self.cancelled.set()
+        if self.retrieval is not None:
+            self.retrieval.cancel()
+        self._close()
+
+    def _close(self) -> None:
+        with self._lock:
+            response, self._response = self._response, None
+        if response is not None:
+            response.close()
+
+
+class ChatEngine:
+    """質問のベクトル化、検索、回答の生成を、画面の描画と並行して実行する。
+    Streamlitの再実行やセッションをまたいで共有し、スレッドプールを使い回す。
+    Streamlitのチャット入力は送信時まで入力中の文字列を受け取れないため、ベクトル化は送信時に始める。
+    """
+
+    def __init__(self, aoai_service, retrieval_cache, chat_deployment: str, system_prompt: str,
+                 score_threshold: float, hybrid_search: bool = True,
+                 max_workers: int = CHAT_ENGINE_MAX_WORKERS, answer_cache=None) -> None:
+        self.aoai_service = aoai_service
+        self.retrieval_cache = retrieval_cache
+        # 初回の質問に対する回答のキャッシュ（AnswerCache）。Noneの場合は使わない
+        self.answer_cache = answer_cache
+        self.chat_deployment = chat_deployment
+        self.system_prompt = system_prompt
+        self.score_threshold = score_threshold
+        self.hybrid_search = hybrid_search
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="chat-engine")
+
+    def start(self, user_message: str, history: list, search_backend) -> ChatTurn:
+        """質問に対する検索をバックグラウンドで始める。
+
+        Args:
+            user_message (str): 質問文
+            history (list): 質問を含むチャット履歴
+            search_backend (Callable[[list], tuple]): キーワードを受け取り、
+                (ベクトル検索を行う関数, コーパスのバージョン) を返す関数。ベクトル化と並行して実行する
+
+        Returns:
+            ChatTurn: 質問に対する処理
+        """
+        turn = ChatTurn(self, user_message, history)
+        embedding = self._executor.submit(
+            self.retrieval_cache.get_embedding, user_message,
+            lambda text: self.aoai_service.getEmbedding(input=text))
+        turn.retrieval = self._executor.submit(self._retrieve, turn, embedding, search_backend)
+        return turn
+
+    def _retrieve(self, turn: ChatTurn, embedding: Future, search_backend) -> list:
+        """キーワードの抽出とコーパスのバージョンの確認をベクトル化と並行して行い、検索する。
+        """
+        # 質問文のキーワードが一致するアイテムは、類似度が低くても検索結果に含める
+        keywords = extract_keywords(turn.user_message, 0) if self.hybrid_search else []
+        search, corpus_version = search_backend(keywords)
+        embedding = embedding.result()
+        turn.embedding = embedding
+        if turn.cancelled.is_set():
+            return []
+        with telemetry.span("chat.search", {"search.keywords": len(keywords)}) as span:
+            # 同じ質問のベクトル値と検索結果はキャッシュから取得し、コーパスが変更されたら検索結果を取得し直す
+            search_items = self.retrieval_cache.search(
+                embedding, self.score_threshold, search, corpus_version, keywords)
+            # トークン数の上限に収まるように検索結果を選ぶ
+            selected = select_search_items(search_items)
+            span.set("search.item_count", len(selected))
+        return selected
@@ -0,0 +1,122 @@
+import os
+from functools import lru_cache
+
+import tiktoken
+
+# ENVIRONMENT VARIABLES
+TIKTOKEN_ENCODING = os.getenv("TIKTOKEN_ENCODING", "cl100k_base")
+# システムメッセージに含める検索結果の最大トークン数
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "6000"))
+# OpenAIに送信するチャット履歴の最大トークン数と最大メッセージ数
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "2000"))
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "10"))
+
+# 1メッセージあたりの書式のトークン数（role などの分）
+_TOKENS_PER_MESSAGE = 4
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """トークナイザーを取得する。初回呼び出し時のみ読み込む。
+    """
+    return tiktoken.get_encoding(TIKTOKEN_ENCODING)
+
+
+def count_tokens(text: str) -> int:
+    """文字列のトークン数を数える。
+
+    Args:
+        text (str): トークン数を数える文字列
+
+    Returns:
+        int: トークン数
+    """
+    return len(_get_encoding().encode(text, disallowed_special=()))
+
+
+def select_search_items(search_items: list, max_tokens: int = CONTEXT_MAX_TOKENS) -> list:
+    """検索結果をスコアの高い順に、トークン数の上限に収まるだけ選ぶ。
+    ハイブリッド検索の結果はRRFのスコア、それ以外は類似度の順に並べる。
+    同じファイル・ページのチャンクは1つだけ選び、同じファイルの他のチャンクと重複する段落は取り除く。
+
+    Args:
+        search_items (list): 検索結果のアイテムのリスト
+        max_tokens (int, optional): 選んだチャンクの合計の最大トークン数
+
+    Returns:
+        list: 選んだアイテムのリスト。content は重複する段落を取り除いた内容に置き換える
+    """
+    selected = []
+    seen_pages = set()
+    # ファイル名ごとの、選んだチャンクに含まれる段落
+    seen_paragraphs = {}
+    total_tokens = 0
+    for item in sorted(search_items, key=lambda item: item.get("RrfScore", item["SimilarityScore"]), reverse=True):
+        page_key = (item["file_name"], item["page_number"])
+        if page_key in seen_pages:
+            continue
+
+        # 先頭の段落はファイル名のタイトルのため、重複していても残す
+        title, *paragraphs = item["content"].split("\n\n")
+        file_paragraphs = seen_paragraphs.setdefault(item["file_name"], set())
+        paragraphs = [paragraph for paragraph in paragraphs
+                      if paragraph.strip() and paragraph not in file_paragraphs]
+        if not paragraphs:
+            continue
+
+        content = "\n\n".join([title, *paragraphs])
+        tokens = count_tokens(content)
+        if total_tokens + tokens > max_tokens:
+            continue
+
+        seen_pages.add(page_key)
+        file_paragraphs.update(paragraphs)
+        total_tokens += tokens
+        selected.append({**item, "content": content})
+    return selected
+
+
+def build_system_message(system_prompt: str, search_items: list) -> str:
+    """システムプロンプトに検索結果を追加したシステムメッセージを作成する。
+
+    Args:
+        system_prompt (str): システムプロンプト
+        search_items (list): select_search_items で選んだ検索結果
+
+    Returns:
+        str: システムメッセージ
+    """
+    parts = [system_prompt, "# 検索結果"]
+    for index, result in enumerate(search_items):
+        # ループ番号を付与してファイルの内容を追加
+        parts.append(f'--- {index + 1} ---\n{result["content"]}')
+    return "\n\n".join(parts)
+
+
+def trim_history(messages: list, max_tokens: int = HISTORY_MAX_TOKENS,
+                 max_messages: int = HISTORY_MAX_MESSAGES) -> list:
+    """チャット履歴を、新しいメッセージから順にトークン数とメッセージ数の上限に収まるだけ残す。
+    最新のメッセージ（ユーザーの質問）は上限を超えても必ず残す。
+
+    Args:
+        messages (list): チャット履歴
+        max_tokens (int, optional): 残すメッセージの合計の最大トークン数
+        max_messages (int, optional): 残す最大メッセージ数
+
+    Returns:
+        list: 残したメッセージのリスト（古い順）
+    """
+    trimmed = []
+    total_tokens = 0
+    for message in reversed(messages[-max_messages:]):
+        tokens = count_tokens(message["content"]) + _TOKENS_PER_MESSAGE
+        if trimmed and total_tokens + tokens > max_tokens:
+            break
+        trimmed.append(message)
+        total_tokens += tokens
+    trimmed.reverse()
+
+    # 履歴がアシスタントの回答から始まらないようにする
+    while len(trimmed) > 1 and trimmed[0]["role"] == "assistant":
+        trimmed.pop(0)
+    return trimmed
@@ -1,15 +1,43 @@
+from azure.core.pipeline.transport import RequestsTransport
 from azure.cosmos import CosmosClient, exceptions
+from datetime import datetime, timedelta, timezone
+from requests.adapters import HTTPAdapter
+import logging
 import os
+import requests
+
+import telemetry
+from keyword_index import reciprocal_rank_fusion
+
+# ENVIRONMENT VARIABLES
+# キーワード検索で取得する最大件数（一致したアイテムすべてを一致数と類似度で並べた上位）
+KEYWORD_SEARCH_TOP = int(os.getenv("KEYWORD_SEARCH_TOP", "50"))
+# 検索に使うベクトル値のフィールド。Embeddingモデルの切り替え時に、バックフィルで書き込んだフィールドに変更する
+COSMOS_VECTOR_FIELD = os.getenv("COSMOS_VECTOR_FIELD", "vector")
+# HTTP接続プールの最大接続数と、リクエストのタイムアウト（秒）
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "20"))
+HTTP_READ_TIMEOUT_SECONDS = float(os.getenv("HTTP_READ_TIMEOUT_SECONDS", "60"))
+# 変更フィードを初めて読む場合に、現在時刻より前から読む時間（秒）
+CHANGE_FEED_START_MARGIN_SECONDS = float(os.getenv("CHANGE_FEED_START_MARGIN_SECONDS", "60"))
+
+# 継続トークンがまだない場合に、読み始める時刻を保持する値の接頭辞
+_CHANGE_FEED_START_TIME_PREFIX = "start_time:"
 
 
 class CosmosService:
 
     def __init__(self) -> None:
         """CosmosDBのクライアントを初期化する。
+        Streamlitの再実行ごとに作成し直さないよう、chat.py で st.cache_resource を使って共有する。
         """
+        # ベクトル検索、変更フィードの確認、ローカルインデックスの同期が並行に使うため、接続プールを広げる
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_maxsize=HTTP_POOL_MAX_CONNECTIONS))
         self.client = CosmosClient(
             url=os.getenv('COSMOS_URL'),
-            credential=os.getenv('COSMOS_CREDENTIAL')
+            credential=os.getenv('COSMOS_CREDENTIAL'),
+            transport=RequestsTransport(session=session),
+            connection_timeout=HTTP_READ_TIMEOUT_SECONDS
         )
         self.database = self.client.get_database_client(
             os.getenv('COSMOS_DATABASE_NAME'))
@@ -27,28 +55,32 @@ class CosmosService:
             list: CosmosDBから取得したアイテムのリスト
         """
         try:
-            print('🚀Querying CosmosDB.')
-            print(f'🚀vectorScore: {VECTOR_SCORE_THRESHOLD}')
+            logging.debug(f'🚀Querying CosmosDB. vectorScore: {VECTOR_SCORE_THRESHOLD}')
 
-            query = f"""SELECT TOP 10 c.file_name, c.page_number, c.content, 
-            VectorDistance(c.vector, @embedding) AS SimilarityScore 
+            query = f"""SELECT TOP 10 c.id, c.file_name, c.page_number, c.content, 
+            VectorDistance(c.{COSMOS_VECTOR_FIELD}, @embedding) AS SimilarityScore 
             FROM c 
-            WHERE VectorDistance(c.vector, @embedding) > {VECTOR_SCORE_THRESHOLD} 
-            ORDER BY VectorDistance(c.vector, @embedding)"""
+            WHERE VectorDistance(c.{COSMOS_VECTOR_FIELD}, @embedding) > {VECTOR_SCORE_THRESHOLD} 
+            ORDER BY VectorDistance(c.{COSMOS_VECTOR_FIELD}, @embedding)"""
             parameters = [
                 {'name': '@embedding', 'value': embedding}
             ]
 
-            items = self.container.query_items(
-                query=query,
-                parameters=parameters,
-                enable_cross_partition_query=True
-            )
+            with telemetry.span('cosmos.query', {'cosmos.operation': 'vector_search'}) as span:
+                items = self.container.query_items(
+                    query=query,
+                    parameters=parameters,
+                    enable_cross_partition_query=True
+                )
+                resources = [item for item in items]
+                span.set(telemetry.REQUEST_CHARGE, telemetry.query_charge(self.container))
+                span.set('cosmos.item_count', len(resources))
 
-            resources = [item for item in items]
-            for item in resources:
-                print(
-                    f'🚀{item["file_name"]}, {item["page_number"]}, {item["content"]}, {item["SimilarityScore"]} is a capitol \n')
+            # 検索結果の本文は、ログレベルがDEBUGの場合のみ出力する
+            if telemetry.content_logging_enabled():
+                for item in resources:
+                    logging.debug(
+                        f'🚀{item["file_name"]}, {item["page_number"]}, {item["content"]}, {item["SimilarityScore"]}')
 
             return resources
 
@@ -59,3 +91,139 @@ class CosmosService:
         except Exception as e:
             print(f'❌Error at get_items_by_vector: {e}')
             raise e
+
+    def get_items_by_keywords(self, keywords: list, embedding) -> list:
+        """キーワードが一致するアイテムをCosmosDBから取得する。
+        一致したキーワードの数の降順、同数の場合は類似度の降順に並べる。
+        一致したアイテムすべての一致数と類似度を先に取得して順位を決め、上位のアイテムのみ本文を取得する。
+
+        Args:
+            keywords (list): 検索クエリから抽出したキーワード
+            embedding (_type_): 検索クエリのベクトル値。結果の類似度の計算に使う
+
+        Returns:
+            list: CosmosDBから取得したアイテムのリスト
+        """
+        if not keywords:
+            return []
+        try:
+            logging.debug(f'🚀Querying CosmosDB by keywords: {keywords}')
+            # 一致するアイテムのみ、一致したキーワードの数と類似度を取得する（本文は取得しない）
+            rank_query = f"""SELECT c.id,
+            ARRAY_LENGTH(ARRAY(SELECT VALUE k FROM k IN c.keywords WHERE ARRAY_CONTAINS(@keywords, k))) AS KeywordHits,
+            VectorDistance(c.{COSMOS_VECTOR_FIELD}, @embedding) AS SimilarityScore
+            FROM c
+            WHERE EXISTS(SELECT VALUE k FROM k IN c.keywords WHERE ARRAY_CONTAINS(@keywords, k))"""
+            rank_parameters = [
+                {'name': '@embedding', 'value': embedding},
+                {'name': '@keywords', 'value': keywords}
+            ]
+            with telemetry.span('cosmos.query', {'cosmos.operation': 'keyword_search'}) as span:
+                ranks = list(self.container.query_items(
+                    query=rank_query,
+                    parameters=rank_parameters,
+                    enable_cross_partition_query=True
+                ))
+                charge = telemetry.query_charge(self.container)
+                for rank in ranks:
+                    # ベクトル値が未登録のアイテムは類似度が返されない
+                    rank.setdefault('SimilarityScore', 0.0)
+                ranks.sort(key=lambda rank: (rank['KeywordHits'], rank['SimilarityScore']), reverse=True)
+                ranks = ranks[:KEYWORD_SEARCH_TOP]
+
+                items = []
+                if ranks:
+                    items = list(self.container.query_items(
+                        query="""SELECT c.id, c.file_name, c.page_number, c.content
+                        FROM c WHERE ARRAY_CONTAINS(@ids, c.id)""",
+                        parameters=[{'name': '@ids', 'value': [rank['id'] for rank in ranks]}],
+                        enable_cross_partition_query=True
+                    ))
+                    charge += telemetry.query_charge(self.container)
+                span.set(telemetry.REQUEST_CHARGE, charge)
+                span.set('cosmos.item_count', len(items))
+
+            items_by_id = {item['id']: item for item in items}
+            results = []
+            for rank in ranks:
+                item = items_by_id.get(rank['id'])
+                # 順位の取得後に削除されたアイテムは除く
+                if item is not None:
+                    results.append({**item, 'SimilarityScore': rank['SimilarityScore'],
+                                    'KeywordHits': rank['KeywordHits']})
+            return results
+
+        except exceptions.CosmosHttpResponseError as e:
+            print(f'❌CosmosHttpResponseError at get_items_by_keywords: {e}')
+            raise e
+
+    def get_items_by_hybrid(self, embedding, keywords: list, VECTOR_SCORE_THRESHOLD, top_k: int = 10) -> list:
+        """ベクトル検索とキーワード検索の結果を Reciprocal Rank Fusion で統合して取得する。
+        キーワードが一致したアイテムは、類似度がしきい値以下でも結果に含める。
+
+        Args:
+            embedding (_type_): 検索クエリのベクトル値
+            keywords (list): 検索クエリから抽出したキーワード
+            VECTOR_SCORE_THRESHOLD (_type_): ベクトルスコアのしきい値
+            top_k (int, optional): 取得する件数
+
+        Returns:
+            list: 統合したアイテムのリスト
+        """
+        with telemetry.span('cosmos.hybrid_search', {'search.keywords': len(keywords)}):
+            vector_items = self.get_items_by_vector(embedding, VECTOR_SCORE_THRESHOLD)
+            keyword_items = self.get_items_by_keywords(keywords, embedding)
+            return reciprocal_rank_fusion([vector_items, keyword_items], top_k)
+
+    def get_all_vectors(self) -> list:
+        """ベクトル値が登録済みのアイテムをすべて取得する。ローカルのベクトルインデックスの作成に使う。
+
+        Returns:
+            list: アイテムのリスト（id, file_name, page_number, content, is_contain_image, keywords, vector）
+        """
+        try:
+            print('🚀Querying all vectors from CosmosDB.')
+            items = self.container.query_items(
+                query=f"""SELECT c.id, c.file_name, c.page_number, c.content, c.is_contain_image, c.keywords,
+                c.{COSMOS_VECTOR_FIELD} AS vector
+                FROM c WHERE c.vector_update_flag = false AND ARRAY_LENGTH(c.{COSMOS_VECTOR_FIELD}) > 0""",
+                enable_cross_partition_query=True
+            )
+            return list(items)
+
+        except exceptions.CosmosHttpResponseError as e:
+            print(f'❌CosmosHttpResponseError at get_all_vectors: {e}')
+            raise e
+
+    def read_change_feed(self, continuation=None) -> tuple[list, str]:
+        """変更フィードから、前回の読み取り以降に追加・更新されたアイテムを取得する。
+        継続トークンはSDKがすべての物理パーティション（フィード範囲）の位置をまとめたもので、そのまま保存して次回に渡す。
+
+        Args:
+            continuation (str, optional): 前回の読み取りで返された継続トークン。省略時は現在以降の変更を読む
+
+        Returns:
+            tuple[list, str]: 変更されたアイテムのリストと、次回の読み取りに使う継続トークン
+        """
+        try:
+            start_time = None
+            if continuation and not continuation.startswith(_CHANGE_FEED_START_TIME_PREFIX):
+                changes = self.container.query_items_change_feed(continuation=continuation)
+            else:
+                if continuation:
+                    start_time = datetime.fromisoformat(continuation[len(_CHANGE_FEED_START_TIME_PREFIX):])
+                else:
+                    # 時計のずれで変更を取りこぼさないよう、少し前から読む（同じ変更を重ねて取り込んでも結果は変わらない）
+                    start_time = datetime.now(timezone.utc) - timedelta(seconds=CHANGE_FEED_START_MARGIN_SECONDS)
+                changes = self.container.query_items_change_feed(start_time=start_time)
+            pages = changes.by_page()
+            items = [item for page in pages for item in page]
+            next_continuation = pages.continuation_token or continuation
+            if next_continuation is None:
+                # 変更がなくSDKが継続トークンを返さない場合は、次回も同じ時刻から読む
+                next_continuation = _CHANGE_FEED_START_TIME_PREFIX + start_time.isoformat()
+            return items, next_continuation
+
+        except exceptions.CosmosHttpResponseError as e:
+            print(f'❌CosmosHttpResponseError at read_change_feed: {e}')
+            raise e
@@ -0,0 +1,82 @@
+import math
+import os
+from collections import defaultdict
+
+# ENVIRONMENT VARIABLES
+# Reciprocal Rank Fusion の定数。大きいほど下位の検索結果の影響が大きくなる
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+
+def reciprocal_rank_fusion(rankings: list, top_k: int = 10, k: int = RRF_K) -> list:
+    """複数の検索結果を Reciprocal Rank Fusion で統合する。
+    各検索結果での順位 r に対して 1 / (k + r) を合計したスコアの降順に並べる。
+
+    Args:
+        rankings (list[list[dict]]): 検索結果のリスト。各検索結果はスコアの降順に並んだアイテムのリスト
+        top_k (int, optional): 取得する件数
+        k (int, optional): RRFの定数
+
+    Returns:
+        list: 統合したアイテムのリスト。RrfScore にRRFのスコアを設定する
+    """
+    scores = defaultdict(float)
+    items = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            key = item.get("id") or (item["file_name"], item["page_number"])
+            scores[key] += 1 / (k + rank)
+            items.setdefault(key, item)
+
+    fused = []
+    for key in sorted(scores, key=scores.get, reverse=True)[:top_k]:
+        fused.append({**items[key], "RrfScore": scores[key]})
+    return fused
+
+
+class KeywordIndex:
+    """キーワードから行番号を引く転置インデックス。
+    CosmosDBのキーワード検索の代わりに、ローカルのベクトルインデックスと組み合わせて使う。
+    """
+
+    def __init__(self) -> None:
+        self._rows_by_keyword = defaultdict(set)
+        self._keywords_by_row = {}
+
+    def add(self, row: int, keywords: list) -> None:
+        """行のキーワードを登録する。登録済みの行は置き換える。
+        """
+        self.remove(row)
+        keywords = set(keywords or [])
+        for keyword in keywords:
+            self._rows_by_keyword[keyword].add(row)
+        self._keywords_by_row[row] = keywords
+
+    def remove(self, row: int) -> None:
+        """行のキーワードを削除する。
+        """
+        for keyword in self._keywords_by_row.pop(row, ()):
+            rows = self._rows_by_keyword[keyword]
+            rows.discard(row)
+            if not rows:
+                del self._rows_by_keyword[keyword]
+
+    def search(self, keywords: list, top_k: int = 10) -> list[tuple[int, float]]:
+        """キーワードに一致する行を、一致したキーワードのIDFの合計の降順に返す。
+
+        Args:
+            keywords (list): 検索するキーワード
+            top_k (int, optional): 取得する件数
+
+        Returns:
+            list[tuple[int, float]]: 行番号とスコアの組のリスト
+        """
+        total = len(self._keywords_by_row)
+        scores = defaultdict(float)
+        for keyword in set(keywords):
+            rows = self._rows_by_keyword.get(keyword)
+            if not rows:
+                continue
+            idf = math.log(1 + total / len(rows))
+            for row in rows:
+                scores[row] += idf
+        return sorted(scores.items(), key=lambda score: score[1], reverse=True)[:top_k]
@@ -1,20 +1,41 @@
 import logging
 import os
+import httpx
 import openai
 from pydantic import BaseModel
 
+import telemetry
+
 # ENVIRONMENT VARIABLES
 AOAI_CHAT_DEPLOYMENT = os.getenv("AOAI_CHAT_DEPLOYMENT")
+# Embeddingの次元数。登録時（functions）の EMBEDDING_DIMENSIONS と同じ値にする。0の場合はモデルの既定値
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "0"))
+# HTTP接続プールの最大接続数と、keep-aliveで保持する接続数、保持する時間（秒）
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "20"))
+HTTP_POOL_MAX_KEEPALIVE = int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "60"))
+# 接続と読み取りのタイムアウト（秒）。回答のストリーミングはチャンクごとに読み取りのタイムアウトが適用される
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "5"))
+HTTP_READ_TIMEOUT_SECONDS = float(os.getenv("HTTP_READ_TIMEOUT_SECONDS", "60"))
 
 
 class AzureOpenAIService:
 
     def __init__(self) -> None:
-        self.openai = openai
-        self.openai.api_type = "azure"
-        self.openai.azure_endpoint = os.getenv("AOAI_ENDPOINT")
-        self.openai.api_version = os.getenv("AOAI_API_VERSION")
-        self.openai.api_key = os.getenv("AOAI_API_KEY")
+        """接続プールを設定したクライアントを作成する。
+        Streamlitの再実行ごとに作成し直さないよう、chat.py で st.cache_resource を使って共有する。
+        """
+        self.client = openai.AzureOpenAI(
+            azure_endpoint=os.getenv("AOAI_ENDPOINT"),
+            api_version=os.getenv("AOAI_API_VERSION"),
+            api_key=os.getenv("AOAI_API_KEY"),
+            http_client=httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=HTTP_POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=HTTP_KEEPALIVE_SECONDS),
+                timeout=httpx.Timeout(HTTP_READ_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS))
+        )
 
     def getEmbedding(self, input) -> list:
         """ベクトル値を取得する。
@@ -26,10 +47,14 @@ class AzureOpenAIService:
             list: ベクトル値
         """
         try:
-            response = self.openai.embeddings.create(
-                input=input,
-                model=os.getenv("AOAI_EMBEDDING_DEPLOYMENT")
-            )
+            with telemetry.span("openai.embeddings", {"openai.inputs": 1}) as span:
+                response = self.client.embeddings.create(
+                    input=input,
+                    model=os.getenv("AOAI_EMBEDDING_DEPLOYMENT"),
+                    **({"dimensions": EMBEDDING_DIMENSIONS} if EMBEDDING_DIMENSIONS > 0 else {})
+                )
+                for key, value in telemetry.token_usage(response).items():
+                    span.set(key, value)
             return response.data[0].embedding
         except Exception as e:
             logging.error(f'❌Error at getEmbedding: {e}')
@@ -0,0 +1,171 @@
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+# ENVIRONMENT VARIABLES
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "1000"))
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS", "3600"))
+# CosmosDBの変更フィードでコーパスの変更を確認する間隔（秒）
+CORPUS_VERSION_CHECK_SECONDS = float(os.getenv("CORPUS_VERSION_CHECK_SECONDS", "30"))
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+_TRAILING_PUNCTUATION_PATTERN = re.compile(r"[?？!！。．.、,，\s]+$")
+
+
+def normalize_query(text: str) -> str:
+    """キャッシュのキーにするため、質問文を正規化する。
+    全角・半角、大文字・小文字、空白、文末の記号の違いを吸収する。
+
+    Args:
+        text (str): 質問文
+
+    Returns:
+        str: 正規化した質問文
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = _WHITESPACE_PATTERN.sub(" ", text).strip()
+    return _TRAILING_PUNCTUATION_PATTERN.sub("", text)
+
+
+class CacheStats:
+    """キャッシュのヒット数とミス数。
+    """
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self) -> str:
+        return f"{self.hits}/{self.hits + self.misses} hits ({self.hit_rate:.0%})"
+
+
+class TTLLRUCache:
+    """有効期限付きのLRUキャッシュ。スレッドセーフで、ヒット率を記録する。
+    """
+
+    def __init__(self, max_entries: int = QUERY_CACHE_MAX_ENTRIES,
+                 ttl_seconds: float = QUERY_CACHE_TTL_SECONDS) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stats = CacheStats()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """キーに対応する値を取得する。期限切れまたは存在しない場合はNoneを返す。
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry[1]
+
+    def set(self, key, value) -> None:
+        """値を登録する。上限を超えた場合は最も古く使われた値を削除する。
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class CorpusVersionTracker:
+    """CosmosDBの変更フィードを一定間隔で確認し、コーパスが変更されるたびにバージョンを上げる。
+    ローカルのベクトルインデックスを使わない場合の、検索結果のキャッシュの無効化に使う。
+    """
+
+    def __init__(self, cosmos_service, check_seconds: float = CORPUS_VERSION_CHECK_SECONDS) -> None:
+        self.cosmos_service = cosmos_service
+        self.check_seconds = check_seconds
+        self.version = 0
+        self._continuation = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def current(self) -> int:
+        """現在のコーパスのバージョンを返す。前回の確認から一定時間が経過していれば変更フィードを確認する。
+        """
+        with self._lock:
+            if time.monotonic() - self._checked_at >= self.check_seconds:
+                items, self._continuation = self.cosmos_service.read_change_feed(
+                    self._continuation)
+                if items:
+                    self.version += 1
+                self._checked_at = time.monotonic()
+            return self.version
+
+
+class RetrievalCache:
+    """質問文のベクトル値と、ベクトル検索の結果をキャッシュする。
+    検索結果はコーパスのバージョンが変わったときにすべて無効にする。
+    """
+
+    def __init__(self, max_entries: int = QUERY_CACHE_MAX_ENTRIES,
+                 ttl_seconds: float = QUERY_CACHE_TTL_SECONDS) -> None:
+        self.embeddings = TTLLRUCache(max_entries, ttl_seconds)
+        self.results = TTLLRUCache(max_entries, ttl_seconds)
+        self._corpus_version = None
+
+    def get_embedding(self, query: str, embed) -> list:
+        """質問文のベクトル値を取得する。キャッシュにない場合は embed で取得して登録する。
+
+        Args:
+            query (str): 質問文
+            embed (Callable[[str], list]): ベクトル値を取得する関数
+
+        Returns:
+            list: ベクトル値
+        """
+        key = normalize_query(query)
+        embedding = self.embeddings.get(key)
+        if embedding is None:
+            embedding = embed(query)
+            self.embeddings.set(key, embedding)
+        return embedding
+
+    def search(self, embedding: list, threshold: float, search, corpus_version, keywords: list = ()) -> list:
+        """ベクトル検索の結果を取得する。キャッシュにない場合は search で検索して登録する。
+
+        Args:
+            embedding (list): 検索クエリのベクトル値
+            threshold (float): 類似度のしきい値
+            search (Callable[[list, float], list]): ベクトル検索を行う関数
+            corpus_version (_type_): コーパスのバージョン。前回と異なる場合はキャッシュを無効にする
+            keywords (list, optional): ハイブリッド検索のキーワード
+
+        Returns:
+            list: 検索結果のアイテムのリスト
+        """
+        if corpus_version != self._corpus_version:
+            self.results.clear()
+            self._corpus_version = corpus_version
+
+        key = (hashlib.sha1(array("f", embedding).tobytes()).hexdigest(), threshold, tuple(keywords))
+        results = self.results.get(key)
+        if results is None:
+            results = search(embedding, threshold)
+            self.results.set(key, results)
+        return results
@@ -0,0 +1,411 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from cosmos_service import COSMOS_VECTOR_FIELD
+from keyword_index import KeywordIndex, reciprocal_rank_fusion
+
+# ENVIRONMENT VARIABLES
+# 検索方式: exact（行列積による全件検索）/ hnsw（hnswlib）/ ivf（転置ファイル）
+VECTOR_INDEX_MODE = os.getenv("VECTOR_INDEX_MODE", "exact")
+VECTOR_INDEX_SNAPSHOT_DIR = os.getenv("VECTOR_INDEX_SNAPSHOT_DIR", ".vector_index")
+# 変更フィードを読む間隔と、削除を反映するために全件を読み直す間隔（秒）
+VECTOR_INDEX_REFRESH_SECONDS = float(os.getenv("VECTOR_INDEX_REFRESH_SECONDS", "10"))
+VECTOR_INDEX_FULL_RELOAD_SECONDS = float(os.getenv("VECTOR_INDEX_FULL_RELOAD_SECONDS", "3600"))
+# IVFで検索するクラスター数
+VECTOR_INDEX_IVF_NPROBE = int(os.getenv("VECTOR_INDEX_IVF_NPROBE", "8"))
+# HNSWの検索時のパラメーター
+VECTOR_INDEX_HNSW_EF = int(os.getenv("VECTOR_INDEX_HNSW_EF", "64"))
+# 量子化: none / int8（int8で候補を絞り込み、float32で類似度を計算し直す）
+VECTOR_INDEX_QUANTIZATION = os.getenv("VECTOR_INDEX_QUANTIZATION", "none")
+# int8で絞り込む候補の数（取得する件数の倍数）
+VECTOR_INDEX_RESCORE_FACTOR = int(os.getenv("VECTOR_INDEX_RESCORE_FACTOR", "4"))
+
+# 検索結果として保持するアイテムのフィールド
+_META_FIELDS = ("id", "file_name", "page_number", "content", "is_contain_image", "keywords")
+# int8の行列をfloat32に変換して計算する1回あたりの行数
+_QUANTIZED_BLOCK_ROWS = 65536
+# スナップショットに保存する変更フィードの継続トークンの形式（2: SDKのフィード範囲の継続トークン）
+_CONTINUATION_FORMAT = 2
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """ベクトルをL2ノルムで正規化する。正規化したベクトルの内積はコサイン類似度になる。
+    """
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return (vectors / norms).astype(np.float32, copy=False)
+
+
+def _quantize_int8(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ベクトルを行ごとのスケールでint8にスカラー量子化する。
+
+    Args:
+        vectors (np.ndarray): float32の行列（1行が1ベクトル）
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: int8の行列と、行ごとのスケール（元の値 ≒ int8の値 x スケール）
+    """
+    vectors = np.atleast_2d(vectors)
+    codes = np.empty(vectors.shape, dtype=np.int8)
+    scales = np.empty(len(vectors), dtype=np.float32)
+    # メモリマップした行列を一度にメモリに読み込まないよう、ブロックごとに変換する
+    for start in range(0, len(vectors), _QUANTIZED_BLOCK_ROWS):
+        block = np.asarray(vectors[start:start + _QUANTIZED_BLOCK_ROWS], dtype=np.float32)
+        block_scales = np.abs(block).max(axis=1) / 127
+        block_scales[block_scales == 0] = 1
+        codes[start:start + len(block)] = np.rint(block / block_scales[:, None])
+        scales[start:start + len(block)] = block_scales
+    return codes, scales
+
+
+class _IvfIndex:
+    """k-meansのクラスターごとにベクトルを分けて、クエリに近いクラスターのみを検索する転置ファイルインデックス。
+    """
+
+    def __init__(self, vectors: np.ndarray, iterations: int = 10) -> None:
+        n_lists = max(1, int(np.sqrt(len(vectors))))
+        rng = np.random.default_rng(0)
+        self.centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(vectors @ self.centroids.T, axis=1)
+            for cluster in range(n_lists):
+                members = vectors[assignments == cluster]
+                if len(members):
+                    self.centroids[cluster] = members.mean(axis=0)
+            self.centroids = _normalize(self.centroids)
+        assignments = np.argmax(vectors @ self.centroids.T, axis=1)
+        self.lists = [list(np.flatnonzero(assignments == cluster)) for cluster in range(n_lists)]
+        # 行番号と、その行を登録したクラスター
+        self.clusters = {row: int(cluster) for row, cluster in enumerate(assignments)}
+
+    def add(self, row: int, vector: np.ndarray) -> None:
+        """行を登録する。登録済みの行（ベクトル値の更新）は、元のクラスターから外してから登録し直す。
+        """
+        old_cluster = self.clusters.get(row)
+        if old_cluster is not None:
+            self.lists[old_cluster].remove(row)
+        cluster = int(np.argmax(self.centroids @ vector))
+        self.lists[cluster].append(row)
+        self.clusters[row] = cluster
+
+    def candidates(self, query: np.ndarray, n_probe: int) -> np.ndarray:
+        probes = np.argsort(-(self.centroids @ query))[:n_probe]
+        rows = [row for cluster in probes for row in self.lists[cluster]]
+        return np.unique(np.asarray(rows, dtype=np.int64))
+
+
+class LocalVectorIndex:
+    """チャットアプリ用のローカルのベクトルインデックス。
+    CosmosDBのベクトル値を一度だけ読み込んでfloat32の連続した行列として保持し、
+    スナップショットファイル（メモリマップ）から起動して、変更フィードで差分を取り込む。
+    """
+
+    def __init__(self, cosmos_service, mode: str = VECTOR_INDEX_MODE,
+                 snapshot_dir: str = VECTOR_INDEX_SNAPSHOT_DIR) -> None:
+        self.cosmos_service = cosmos_service
+        self.mode = mode
+        self.snapshot_dir = snapshot_dir
+        self._lock = threading.RLock()
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._alive = np.zeros(0, dtype=bool)
+        self._meta = []
+        self._row_by_id = {}
+        self._keywords = KeywordIndex()
+        self._continuation = None
+        self._ann = None
+        self._codes = None
+        self._scales = None
+        self._loaded_at = 0.0
+        self._thread = None
+        # 変更を取り込むたびに増える番号。検索結果のキャッシュの無効化に使う
+        self.version = 0
+
+    def start(self) -> "LocalVectorIndex":
+        """インデックスを読み込み、変更フィードを取り込むバックグラウンドスレッドを開始する。
+        """
+        if not self._load_snapshot():
+            self.full_reload()
+        self.refresh()
+        self._thread = threading.Thread(target=self._refresh_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def full_reload(self) -> None:
+        """CosmosDBから全件を読み直してインデックスを作り直し、スナップショットを保存する。
+        """
+        # 読み込み中の変更を取りこぼさないよう、先に変更フィードの位置を取得する
+        _, continuation = self.cosmos_service.read_change_feed()
+        items = self.cosmos_service.get_all_vectors()
+        vectors = _normalize(np.asarray(
+            [item["vector"] for item in items], dtype=np.float32).reshape(len(items), -1))
+        meta = [{field: item.get(field) for field in _META_FIELDS} for item in items]
+
+        with self._lock:
+            self._set_index(vectors, meta, continuation)
+            self._save_snapshot()
+        logging.info(f"🚀 Local vector index loaded: {len(items)} items")
+
+    def refresh(self) -> int:
+        """変更フィードから追加・更新されたアイテムを取り込む。
+
+        Returns:
+            int: 取り込んだアイテムの数
+        """
+        items, continuation = self.cosmos_service.read_change_feed(self._continuation)
+        with self._lock:
+            for item in items:
+                self._apply_change(item)
+            self._continuation = continuation
+            if items:
+                self.version += 1
+        return len(items)
+
+    def search(self, embedding, threshold: float, top_k: int = 10) -> list:
+        """クエリのベクトル値に近いアイテムを検索する。
+        CosmosServiceのget_items_by_vectorと同じ形式の結果を返す。
+
+        Args:
+            embedding (list): 検索クエリのベクトル値
+            threshold (float): 類似度のしきい値
+            top_k (int): 取得する件数
+
+        Returns:
+            list: アイテムのリスト（類似度の降順）
+        """
+        query = _normalize(np.asarray(embedding, dtype=np.float32))
+        with self._lock:
+            if not len(self._meta):
+                return []
+            rows, scores = self._search_rows(query, top_k)
+            results = []
+            for row, score in zip(rows, scores):
+                if score <= threshold:
+                    continue
+                result = dict(self._meta[row])
+                result["SimilarityScore"] = float(score)
+                results.append(result)
+            return results
+
+    def search_hybrid(self, embedding, keywords: list, threshold: float, top_k: int = 10) -> list:
+        """ベクトル検索と転置インデックスによるキーワード検索の結果を Reciprocal Rank Fusion で統合する。
+        CosmosServiceのget_items_by_hybridと同じ形式の結果を返す。
+
+        Args:
+            embedding (list): 検索クエリのベクトル値
+            keywords (list): 検索クエリから抽出したキーワード
+            threshold (float): 類似度のしきい値。キーワードが一致したアイテムには適用しない
+            top_k (int): 取得する件数
+
+        Returns:
+            list: 統合したアイテムのリスト
+        """
+        vector_items = self.search(embedding, threshold, top_k)
+        query = _normalize(np.asarray(embedding, dtype=np.float32))
+        with self._lock:
+            keyword_items = []
+            for row, _ in self._keywords.search(keywords, top_k):
+                result = dict(self._meta[row])
+                result["SimilarityScore"] = float(self._vectors[row] @ query)
+                keyword_items.append(result)
+        return reciprocal_rank_fusion([vector_items, keyword_items], top_k)
+
+    def _search_rows(self, query: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        """検索方式に応じて、類似度の高い行番号と類似度を返す。
+        """
+        if self.mode == "hnsw" and self._ann is not None:
+            self._ann.set_ef(max(VECTOR_INDEX_HNSW_EF, top_k))
+            k = min(top_k, int(self._alive.sum()))
+            if k == 0:
+                return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+            labels, distances = self._ann.knn_query(query, k=k)
+            # hnswlibの内積空間の距離は 1 - 内積
+            return labels[0], 1 - distances[0]
+
+        if self.mode == "ivf" and self._ann is not None:
+            rows = self._ann.candidates(query, VECTOR_INDEX_IVF_NPROBE)
+        else:
+            rows = np.arange(len(self._meta))
+        rows = rows[self._alive[rows]]
+        # int8の行列で候補を絞り込んでから、float32の行列で類似度を計算し直す
+        n_candidates = top_k * VECTOR_INDEX_RESCORE_FACTOR
+        if self._codes is not None and len(rows) > n_candidates:
+            approx_scores = self._approx_scores(rows, query)
+            rows = rows[np.argpartition(-approx_scores, n_candidates)[:n_candidates]]
+        scores = self._vectors[rows] @ query
+        if len(rows) > top_k:
+            top = np.argpartition(-scores, top_k)[:top_k]
+            rows, scores = rows[top], scores[top]
+        order = np.argsort(-scores)
+        return rows[order], scores[order]
+
+    def _approx_scores(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """int8の行列で、指定した行とクエリの類似度の近似値を計算する。
+        """
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), _QUANTIZED_BLOCK_ROWS):
+            block = rows[start:start + _QUANTIZED_BLOCK_ROWS]
+            scores[start:start + len(block)] = \
+                (self._codes[block].astype(np.float32) @ query) * self._scales[block]
+        return scores
+
+    def _set_index(self, vectors: np.ndarray, meta: list, continuation) -> None:
+        """行列とメタデータを差し替え、近似検索のインデックスを作り直す。
+        """
+        self._vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self._alive = np.ones(len(meta), dtype=bool)
+        self._meta = meta
+        self._row_by_id = {item["id"]: row for row, item in enumerate(meta)}
+        self._keywords = KeywordIndex()
+        for row, item in enumerate(meta):
+            self._keywords.add(row, item.get("keywords"))
+        self._continuation = continuation
+        self._loaded_at = time.monotonic()
+        self._ann = self._build_ann(self._vectors)
+        if VECTOR_INDEX_QUANTIZATION == "int8" and len(self._vectors):
+            self._codes, self._scales = _quantize_int8(self._vectors)
+        else:
+            self._codes, self._scales = None, None
+        self.version += 1
+
+    def _build_ann(self, vectors: np.ndarray):
+        """近似検索のインデックスを作成する。
+        """
+        if not len(vectors) or self.mode == "exact":
+            return None
+        if self.mode == "ivf":
+            return _IvfIndex(vectors)
+        if self.mode == "hnsw":
+            try:
+                import hnswlib
+            except ImportError:
+                logging.warning("❌ hnswlib is not installed. Falling back to exact search.")
+                return None
+            index = hnswlib.Index(space="ip", dim=vectors.shape[1])
+            index.init_index(max_elements=max(len(vectors) * 2, 1024), allow_replace_deleted=True)
+            index.add_items(vectors, np.arange(len(vectors)))
+            return index
+        return None
+
+    def _apply_change(self, item: dict) -> None:
+        """変更フィードのアイテムを1件取り込む。ベクトル値が未更新のアイテムは検索対象から外す。
+        """
+        row = self._row_by_id.get(item["id"])
+        vector = item.get(COSMOS_VECTOR_FIELD)
+        if item.get("vector_update_flag") or not vector:
+            if row is not None:
+                self._mark_deleted(row)
+            return
+
+        vector = _normalize(np.asarray(vector, dtype=np.float32))
+        meta = {field: item.get(field) for field in _META_FIELDS}
+        # メモリマップした行列は読み取り専用のため、最初の変更でメモリ上にコピーする
+        if not self._vectors.flags.writeable:
+            self._vectors = np.array(self._vectors)
+
+        if row is None:
+            row = len(self._meta)
+            if self._vectors.size == 0:
+                self._vectors = vector.reshape(1, -1)
+            else:
+                self._vectors = np.vstack([self._vectors, vector])
+            self._alive = np.append(self._alive, True)
+            self._meta.append(meta)
+            self._row_by_id[item["id"]] = row
+            was_alive = True
+        else:
+            was_alive = bool(self._alive[row])
+            self._vectors[row] = vector
+            self._alive[row] = True
+            self._meta[row] = meta
+        self._keywords.add(row, meta["keywords"])
+
+        if VECTOR_INDEX_QUANTIZATION == "int8":
+            codes, scales = _quantize_int8(vector)
+            if self._codes is None:
+                self._codes, self._scales = codes, scales
+            elif row == len(self._codes):
+                self._codes = np.vstack([self._codes, codes])
+                self._scales = np.append(self._scales, scales)
+            else:
+                self._codes[row] = codes[0]
+                self._scales[row] = scales[0]
+
+        if self.mode == "hnsw" and self._ann is not None:
+            if row >= self._ann.get_max_elements():
+                self._ann.resize_index(row * 2)
+            if not was_alive:
+                self._ann.unmark_deleted(row)
+            self._ann.add_items(vector.reshape(1, -1), np.asarray([row]))
+        elif self.mode == "ivf" and self._ann is not None:
+            self._ann.add(row, vector)
+        elif self.mode != "exact" and self._ann is None:
+            self._ann = self._build_ann(self._vectors)
+
+    def _mark_deleted(self, row: int) -> None:
+        """行を検索対象から外す。
+        """
+        if not self._alive[row]:
+            return
+        self._alive[row] = False
+        self._keywords.remove(row)
+        if self.mode == "hnsw" and self._ann is not None:
+            self._ann.mark_deleted(row)
+
+    def _refresh_loop(self) -> None:
+        """変更フィードを定期的に取り込み、一定時間ごとに全件を読み直す。
+        """
+        while True:
+            time.sleep(VECTOR_INDEX_REFRESH_SECONDS)
+            try:
+                if time.monotonic() - self._loaded_at > VECTOR_INDEX_FULL_RELOAD_SECONDS:
+                    self.full_reload()
+                else:
+                    self.refresh()
+            except Exception as e:
+                logging.error(f"❌Error at LocalVectorIndex refresh: {e}")
+
+    def _save_snapshot(self) -> None:
+        """行列とメタデータをスナップショットファイルに保存する。書き込み途中のファイルを読まないよう置き換えで保存する。
+        """
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        vectors_path = os.path.join(self.snapshot_dir, "vectors.npy")
+        meta_path = os.path.join(self.snapshot_dir, "meta.json")
+        np.save(vectors_path + ".tmp.npy", self._vectors[self._alive])
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({
+                "vector_field": COSMOS_VECTOR_FIELD,
+                "continuation": self._continuation,
+                "continuation_format": _CONTINUATION_FORMAT,
+                "items": [meta for meta, alive in zip(self._meta, self._alive) if alive],
+            }, f, ensure_ascii=False)
+        os.replace(vectors_path + ".tmp.npy", vectors_path)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def _load_snapshot(self) -> bool:
+        """スナップショットファイルがあれば、行列をメモリマップで読み込む。
+
+        Returns:
+            bool: 読み込めた場合はTrue
+        """
+        vectors_path = os.path.join(self.snapshot_dir, "vectors.npy")
+        meta_path = os.path.join(self.snapshot_dir, "meta.json")
+        if not (os.path.exists(vectors_path) and os.path.exists(meta_path)):
+            return False
+        with open(meta_path, encoding="utf-8") as f:
+            snapshot = json.load(f)
+        # 検索に使うフィールドを切り替えた場合は、スナップショットを使わずに読み込み直す
+        if snapshot.get("vector_field", "vector") != COSMOS_VECTOR_FIELD:
+            return False
+        # 以前の形式（1つのレスポンスのetag）の継続トークンは、すべてのパーティションの位置を表さないため使わない
+        if snapshot.get("continuation_format") != _CONTINUATION_FORMAT:
+            return False
+        vectors = np.load(vectors_path, mmap_mode="r")
+        with self._lock:
+            self._set_index(vectors, snapshot["items"], snapshot["continuation"])
+        logging.info(f"🚀 Local vector index loaded from snapshot: {len(self._meta)} items")
+        return True
@@ -0,0 +1,394 @@
+import azure.functions as func
+import asyncio
+import inspect
+import json
+import logging
+import os
+
+from util.async_cosmos_service import AsyncCosmosService
+from util.async_openai_service import AsyncAzureOpenAIService
+from util.cosmos_service import FILE_CHUNK_FIELDS
+from util.openai_service import EmbeddingError, EmbeddingScheduler
+from util.blob_stream import BLOB_STREAM_CHUNK_SIZE, adownload_to_tempfile, aiter_text
+from util import telemetry
+from util.clients import (azure_client_options, create_async_azure_transport, get_embedding_cache,
+                          get_event_coalescer, get_event_queue)
+from util.pdf_extractor import aiter_pdf_pages
+from util.chunker import achunk_markdown
+from util.ingest_util import ChunkReconciler, abuild_document_batches, abuild_page_document_batches, lookup_embeddings, raise_if_failed
+from util.event_coalescer import (EVENT_COALESCE_MODE, EVENT_QUEUE_NAME, BlobEvent,
+                                  BlobEventClaimedError)
+from util.vector_updater import (VECTOR_DUAL_WRITE_DEPLOYMENT, VECTOR_DUAL_WRITE_DIMENSIONS, VECTOR_DUAL_WRITE_FIELD,
+                                 EmbeddingOutcome, dual_write_inputs, embedding_groups, finish_vector_updates,
+                                 plan_vector_updates)
+
+# INGEST_ASYNC=true の場合に function_app から登録される、非同期版のトリガー
+bp = func.Blueprint()
+# EVENT_COALESCE_MODE=queue の場合のみ登録する、遅延させたBlobイベントのキュートリガー
+coalesce_bp = func.Blueprint()
+
+# 環境変数
+COSMOS_DATABASE_NAME = os.getenv('COSMOS_DATABASE_NAME')
+COSMOS_CONTAINER_NAME = os.getenv('COSMOS_CONTAINER_NAME')
+BLOB_CONNECTION = os.getenv('BLOB_CONNECTION')
+INGEST_MODE = os.getenv('INGEST_MODE', 'reconcile')
+BULK_WRITE_BATCH_SIZE = int(os.getenv('BULK_WRITE_BATCH_SIZE', '100'))
+# 同時に実行するBlobのダウンロード数と、1ファイルあたりのダウンロードの並列数
+ASYNC_BLOB_CONCURRENCY = int(os.getenv('ASYNC_BLOB_CONCURRENCY', '4'))
+ASYNC_BLOB_DOWNLOAD_CONCURRENCY = int(
+    os.getenv('ASYNC_BLOB_DOWNLOAD_CONCURRENCY', '2'))
+
+# client
+# 非同期クライアントはイベントループ上で作成するため、初回の呼び出し時に作成する
+_clients = {}
+_blob_semaphore = asyncio.Semaphore(ASYNC_BLOB_CONCURRENCY)
+# 埋め込みキャッシュとイベントの集約は同期版と共通（util/clients.py）。状態の更新は同期版のクライアントで行う
+
+
+def _get_clients() -> tuple:
+    """非同期クライアント（AsyncAzureOpenAIService, AsyncCosmosService, aioのBlobServiceClient）を取得する。
+    初回の呼び出し時のみ作成し、CosmosDBとBlob Storageのクライアントは接続プールを共有する。
+    """
+    if not _clients:
+        from azure.storage.blob.aio import BlobServiceClient
+
+        transport = create_async_azure_transport()
+        _clients['openai'] = AsyncAzureOpenAIService()
+        # デュアルライト先のデプロイは、流量の制限を既定のデプロイと共有しない
+        _clients['dual_openai'] = AsyncAzureOpenAIService(
+            VECTOR_DUAL_WRITE_DEPLOYMENT, EmbeddingScheduler(),
+            VECTOR_DUAL_WRITE_DIMENSIONS) if VECTOR_DUAL_WRITE_FIELD else None
+        _clients['cosmos'] = AsyncCosmosService(transport)
+        _clients['blob'] = BlobServiceClient.from_connection_string(
+            BLOB_CONNECTION,
+            max_single_get_size=BLOB_STREAM_CHUNK_SIZE,
+            max_chunk_get_size=BLOB_STREAM_CHUNK_SIZE,
+            **azure_client_options(transport))
+    return _clients['openai'], _clients['cosmos'], _clients['blob']
+
+
+@bp.function_name(name="cosmosdb_trigger")
+@bp.cosmos_db_trigger(arg_name="azcosmosdb", container_name=COSMOS_CONTAINER_NAME,
+                      database_name=COSMOS_DATABASE_NAME, connection="cosmosragdataeventdriven_DOCUMENTDB")
+async def cosmosdb_trigger_async(azcosmosdb: func.DocumentList):
+    """function_app.cosmosdb_trigger の非同期版。
+    分割したEmbeddingリクエストと、CosmosDBへの書き込みを並行に実行する。
+    """
+    logging.info('Python CosmosDB triggered (async).')
+    openai_service, cosmos_service, _ = _get_clients()
+    embedding_cache = get_embedding_cache()
+
+    with telemetry.span('ingest.vector_update', {'ingest.documents': len(azcosmosdb)}) as span:
+        try:
+            # ベクトル更新フラグがTrueのドキュメントのみを対象にする
+            flagged = [doc for doc in azcosmosdb if doc.get('vector_update_flag')]
+            if not flagged:
+                return
+
+            # 現在の状態と比較し、再配信されたリビジョンや処理済みのリビジョンを除く
+            states = await cosmos_service.get_vector_states([doc['id'] for doc in flagged])
+            pending, patches, skipped = plan_vector_updates(flagged, states)
+            span.set('ingest.pending', len(pending))
+            span.set('ingest.skipped', skipped)
+            logging.info(
+                f'🚀 Start update vector: {len(pending)} documents ({len(patches)} flag only, {skipped} skipped)')
+
+            outcome = EmbeddingOutcome()
+            if pending:
+                # 内容のハッシュ値でキャッシュを検索し、キャッシュにないものだけベクトル化する
+                cached, missed = await asyncio.to_thread(
+                    lookup_embeddings, [document for _, document in pending], embedding_cache)
+                logging.info(
+                    f'🚀 Embedding cache: {len(pending) - len(missed)} hits, {len(missed)} misses')
+                outcome.embeddings.update(cached)
+
+                groups = embedding_groups(pending, missed)
+                results = await asyncio.gather(
+                    *(openai_service.get_embeddings(list(group.values())) for group in groups),
+                    return_exceptions=True)
+                for group, result in zip(groups, results):
+                    if isinstance(result, EmbeddingError):
+                        outcome.add(group, error=result)
+                    elif isinstance(result, Exception):
+                        raise result
+                    else:
+                        outcome.add(group, result)
+                # 成功したベクトル値はキャッシュに保存し、ランタイムの再実行時にベクトル化し直さない
+                await asyncio.to_thread(embedding_cache.set_many, {
+                    content_hash: outcome.embeddings[content_hash]
+                    for content_hash in missed if content_hash in outcome.embeddings})
+
+                # モデルの切り替え中は、切り替え先のデプロイのベクトル値も書き込む
+                dual_write_service = _clients['dual_openai']
+                if dual_write_service is not None:
+                    inputs = dual_write_inputs(pending, outcome.embeddings)
+                    try:
+                        outcome.add_dual_write(inputs, await dual_write_service.get_embeddings(list(inputs.values())))
+                    except EmbeddingError as e:
+                        outcome.add_dual_write(inputs, error=e)
+
+            # 成功したアイテムと失敗したアイテムを先に更新し、全体の失敗は最後に送出する
+            vector_patches, dead_letters = finish_vector_updates(
+                pending, outcome.embeddings, outcome.errors, outcome.dual_embeddings, outcome.dual_errors)
+            if outcome.dual_errors:
+                logging.warning(f'❌ Dual-write skipped (left for backfill): {len(outcome.dual_errors)} items')
+            results, _ = await asyncio.gather(
+                cosmos_service.patch_items(patches + vector_patches),
+                cosmos_service.upsert_dead_letters(dead_letters))
+            if dead_letters:
+                logging.warning(f'❌ Dead-lettered: {[record["id"] for record in dead_letters]}')
+            raise_if_failed(results, 'patch vector')
+            if outcome.error is not None:
+                raise outcome.error
+            updated = sum(document.content_hash in outcome.embeddings for _, document in pending)
+            span.set('ingest.updated', updated)
+            logging.info(
+                f'✅ Finish update vector: {updated} documents, {len(pending) - updated} failed')
+
+        except Exception as e:
+            logging.error(f'❌ Error: {e}')
+            raise e
+
+
+@bp.function_name(name="EventGridTrigger")
+@bp.event_grid_trigger(arg_name="azeventgrid")
+async def EventGridTriggerAsync(azeventgrid: func.EventGridEvent):
+    """function_app.EventGridTrigger の非同期版。
+    登録済みアイテムの検索とBlobのダウンロードを並行に実行し、書き込みと削除も並行に実行する。
+    Blobは逐次ダウンロードしてチャンクに分割するため、ファイル全体をメモリに保持しない。
+    """
+    blob_event = BlobEvent.from_event_grid(azeventgrid.event_type, azeventgrid.get_json())
+
+    logging.info(f'🚀Python EventGrid trigger (async): {blob_event.event_type} {blob_event.url}')
+    event_coalescer = get_event_coalescer()
+
+    try:
+        # sequencerがないイベント（手動のテストなど）は集約せずに処理する
+        if event_coalescer is None or not blob_event.sequencer:
+            await _process_blob_event(blob_event)
+            return
+
+        # 同じBlobの古いイベントや処理済みのイベントは破棄する
+        if not await asyncio.to_thread(event_coalescer.offer, blob_event):
+            logging.info(f'🚀 Skipped stale blob event: {blob_event.url} ({blob_event.sequencer})')
+            return
+
+        if EVENT_COALESCE_MODE == 'queue':
+            await asyncio.to_thread(get_event_queue().send, blob_event, event_coalescer.window_seconds)
+            return
+
+        await asyncio.sleep(event_coalescer.window_seconds)
+        await _process_claimed_event(blob_event)
+
+    except Exception as e:
+        logging.error(f'❌Error: {e}')
+        raise e
+
+
+@coalesce_bp.function_name(name="BlobEventQueueTrigger")
+@coalesce_bp.queue_trigger(arg_name="msg", queue_name=EVENT_QUEUE_NAME, connection="BLOB_CONNECTION")
+async def BlobEventQueueTriggerAsync(msg: func.QueueMessage):
+    """function_app.BlobEventQueueTrigger の非同期版。
+    """
+    blob_event = BlobEvent.from_dict(json.loads(msg.get_body().decode('utf-8')))
+    logging.info(f'🚀Python Queue trigger (async): {blob_event}')
+    try:
+        await _process_claimed_event(blob_event)
+    except Exception as e:
+        logging.error(f'❌Error: {e}')
+        raise e
+
+
+async def _process_claimed_event(blob_event: BlobEvent) -> None:
+    """受け付けたイベントがBlobの最新のイベントの場合のみ、処理して完了を記録する。
+    同じBlobの古いイベントを処理中の場合は、queue の場合はキューに送り直し、local の場合は待ってから claim し直す。
+    """
+    event_coalescer = get_event_coalescer()
+    while True:
+        try:
+            latest = await asyncio.to_thread(event_coalescer.claim, blob_event)
+            break
+        except BlobEventClaimedError:
+            # 同じBlobの古いイベントを処理中のため、処理が終わった後に最新の状態を処理する
+            if EVENT_COALESCE_MODE == 'queue':
+                await asyncio.to_thread(get_event_queue().send, blob_event, event_coalescer.window_seconds)
+                return
+            logging.info(f'🚀 Waiting for blob event in progress: {blob_event.url}')
+            await asyncio.sleep(event_coalescer.window_seconds)
+    if latest is None:
+        logging.info(f'🚀 Skipped superseded blob event: {blob_event.url} ({blob_event.sequencer})')
+        return
+    try:
+        await _process_blob_event(latest)
+    except Exception:
+        await asyncio.to_thread(event_coalescer.release, latest)
+        raise
+    await asyncio.to_thread(event_coalescer.complete, latest)
+
+
+async def _process_blob_event(blob_event: BlobEvent) -> None:
+    """Blobの作成、削除イベントを処理する。
+    """
+    _, cosmos_service, _ = _get_clients()
+    event_type = blob_event.event_type
+    blob_url = blob_event.url
+
+    with telemetry.span('ingest.blob_event', {'blob.event_type': event_type, 'blob.url': blob_url}):
+        try:
+            # event_typeがBlobCreatedの場合
+            if event_type == 'Microsoft.Storage.BlobCreated':
+                blob_etag = blob_event.etag
+
+                # 同時に処理するBlobの数を制限し、メモリ使用量を (並列数 x チャンクサイズ) に抑える
+                async with _blob_semaphore:
+                    # 登録済みアイテムの検索とBlobのダウンロードを並行に開始する
+                    query_task = asyncio.create_task(
+                        cosmos_service.query_by_file_path(blob_url, FILE_CHUNK_FIELDS))
+                    download_task = asyncio.create_task(_open_blob(blob_url))
+                    blob_data = None
+                    try:
+                        # BlobのETagが登録済みのアイテムと同じ場合は、ダウンロードを取り消して処理を省略
+                        existing_items = await query_task
+                        if blob_etag and existing_items and all(
+                                item.get('blob_etag') == blob_etag for item in existing_items):
+                            logging.info(f'🚀 Skipped unchanged blob: {blob_url} (eTag: {blob_etag})')
+                            return
+
+                        blob_data = await download_task
+                    finally:
+                        # 検索の失敗や処理の省略でダウンロードを使わない場合は、取り消して後始末する
+                        if blob_data is None:
+                            await _discard_download(download_task)
+
+                    file_name = blob_data.name
+                    file_extension = os.path.splitext(file_name)[1]
+
+                    # ダウンロード、デコード、チャンク分割、登録を逐次処理する
+                    pdf_path = None
+                    if file_extension == ".txt" or file_extension == ".md":
+                        batches = abuild_document_batches(
+                            achunk_markdown(aiter_text(telemetry.atimed_chunks('blob.download', blob_data.chunks()))),
+                            file_name, blob_url, blob_etag, BULK_WRITE_BATCH_SIZE)
+                    elif file_extension == ".pdf":
+                        with telemetry.span('blob.download'):
+                            pdf_path = await adownload_to_tempfile(blob_data, file_extension)
+                        batches = abuild_page_document_batches(
+                            aiter_pdf_pages(pdf_path),
+                            file_name, blob_url, blob_etag, BULK_WRITE_BATCH_SIZE)
+                    else:
+                        logging.warning(
+                            f'❌ Unsupported file type: {file_extension}')
+                        batches = _no_batches()
+
+                    try:
+                        if INGEST_MODE == 'replace':
+                            await _replace_documents(cosmos_service, blob_url, batches)
+                        else:
+                            await _reconcile_documents(cosmos_service, existing_items, batches)
+                    finally:
+                        if pdf_path:
+                            os.remove(pdf_path)
+
+            # event_typeがBlobDeletedの場合
+            elif event_type == 'Microsoft.Storage.BlobDeleted':
+                results = await cosmos_service.delete_by_file_path(blob_url)
+                raise_if_failed(results, 'delete')
+                logging.info(f'🚀Deleted CosmosDB items: {blob_url} ({len(results)} items)')
+
+            else:
+                logging.warning(f'❌Unsupported event type: {event_type}')
+
+        except Exception as e:
+            logging.error(f'❌Error: {e}')
+            raise e
+
+
+async def _open_blob(blob_url: str):
+    """Blobのダウンロードを開始する。内容は返り値の chunks() で逐次取得する。
+
+    Args:
+        blob_url (str): BlobのURL
+
+    Returns:
+        StorageStreamDownloader: ダウンロード中のBlob
+    """
+    _, _, blob_service_client = _get_clients()
+    blob_name = blob_url.split("rag-docs/")[1]
+    blob_client = blob_service_client.get_blob_client(
+        container='rag-docs', blob=blob_name)
+    blob_data = await blob_client.download_blob(
+        max_concurrency=ASYNC_BLOB_DOWNLOAD_CONCURRENCY)
+    logging.info(f'🚀 Blob File Download Started: {blob_data.name}')
+    return blob_data
+
+
+async def _discard_download(download_task: asyncio.Task) -> None:
+    """使わないBlobのダウンロードを取り消し、完了を待つ。
+    開始済みのダウンロードは閉じる。ダウンロードの例外は、未取得の警告が出ないようにここで受け取る。
+
+    Args:
+        download_task (asyncio.Task): _open_blob のタスク
+    """
+    download_task.cancel()
+    blob_data, = await asyncio.gather(download_task, return_exceptions=True)
+    if isinstance(blob_data, BaseException):
+        return
+    # StorageStreamDownloader は最初の範囲をメモリに読み込み済みのため、閉じる処理がない場合は参照を外すだけでよい
+    close = getattr(blob_data, 'close', None)
+    if close is not None:
+        result = close()
+        if inspect.isawaitable(result):
+            await result
+
+
+async def _no_batches():
+    """登録するアイテムがない場合の、空の非同期イテラブル。
+    """
+    return
+    yield
+
+
+async def _replace_documents(cosmos_service: AsyncCosmosService, blob_url: str, batches) -> None:
+    """登録済みのアイテムをすべて削除してから、新しいアイテムを登録する。
+    """
+    items = await cosmos_service.query_by_file_path(blob_url, ('file_path', 'content_hash', 'vector'))
+    existing_vectors = {item['content_hash']: item['vector'] for item in items
+                        if item.get('content_hash') and item.get('vector')}
+    raise_if_failed(await cosmos_service.delete_items(items), 'delete')
+
+    async for batch in batches:
+        for document in batch:
+            vector = existing_vectors.get(document.content_hash)
+            if vector:
+                document.vector = vector
+                document.vector_hash = document.content_hash
+                document.vector_update_flag = False
+        raise_if_failed(await cosmos_service.upsert_items(
+            [document.to_dict() for document in batch]), 'upsert')
+
+
+async def _reconcile_documents(cosmos_service: AsyncCosmosService, existing_items: list, batches) -> None:
+    """登録済みのアイテムと新しいアイテムを比較し、差分のみを並行に更新する。
+    """
+    reconciler = ChunkReconciler(existing_items)
+    async for batch in batches:
+        upserts, patches, moved = reconciler.plan(batch)
+        sources = await asyncio.gather(*(
+            cosmos_service.read_item(source['id'], cosmos_service.partition_key_of(source))
+            for _, source in moved))
+        for (document, _), source in zip(moved, sources):
+            if source.get('vector'):
+                document.vector = source['vector']
+                document.vector_hash = document.content_hash
+                document.vector_update_flag = False
+        upsert_results, patch_results = await asyncio.gather(
+            cosmos_service.upsert_items([document.to_dict() for document in upserts]),
+            cosmos_service.patch_items(patches))
+        raise_if_failed(upsert_results, 'upsert')
+        raise_if_failed(patch_results, 'patch')
+
+    removed = reconciler.removed_items()
+    raise_if_failed(await cosmos_service.delete_items(removed), 'delete')
+
+    logging.info(
+        f'🚀 Reconciled chunks: {reconciler.upserted} upserted, {reconciler.unchanged} unchanged, {len(removed)} deleted')
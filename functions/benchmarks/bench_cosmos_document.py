@@ -0,0 +1,77 @@
+"""CosmosDocument の1アイテムあたりの変換コストを計測するマイクロベンチマーク。
+
+変更フィードのアイテムを CosmosDocument に変換し、辞書に戻すまでの時間を、
+従来の実装（__init__ の上書き、要素ごとのベクトル値の検証、.dict()）と現在の from_dict / to_dict、
+参考として検証を省略する model_construct を比較する。
+
+使い方（functions ディレクトリで実行）:
+    python benchmarks/bench_cosmos_document.py [--number 2000]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+import uuid
+
+from pydantic import BaseModel
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from domain.cosmos_document import CosmosDocument  # noqa: E402
+from util.vector_codec import to_float32  # noqa: E402
+
+SAMPLE_DOC_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sample_doc', 'sample_01.json')
+
+
+class _LegacyCosmosDocument(BaseModel):
+    """比較用の、変更前の CosmosDocument の定義。
+    """
+    id: str
+    page_number: int
+    content: str
+    vector: list
+    keywords: list
+    file_name: str
+    file_path: str
+    delete_flag: bool
+    vector_update_flag: bool
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        if 'id' not in data:
+            self.id = str(uuid.uuid4())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=2000, help='計測する変換の回数')
+    args = parser.parse_args()
+
+    with open(SAMPLE_DOC_PATH, encoding='utf-8') as f:
+        doc = json.load(f)
+    # 変更フィードのアイテムにはシステムプロパティが含まれる
+    doc.update({'_rid': 'rid', '_self': 'self', '_etag': 'etag', '_attachments': 'attachments/', '_ts': 0})
+
+    # トリガーが受け取るベクトル未登録のアイテム、ベクトル値を登録したアイテム（丸め済みのリスト）、
+    # 新しく計算したベクトル値（float32の配列、to_dict で丸める）で計測する
+    for vector in ([], doc['vector'], to_float32(doc['vector'])):
+        data = {**doc, 'vector': vector}
+        cases = {
+            'legacy: CosmosDocument(**doc).dict()': lambda: _LegacyCosmosDocument(**data).model_dump(),
+            'current: from_dict(doc).to_dict()': lambda: CosmosDocument.from_dict(data).to_dict(),
+            'construct: model_construct(**doc).to_dict()': lambda: CosmosDocument.model_construct(**data).to_dict(),
+        }
+        print(f'vector dims: {len(vector)} ({type(vector).__name__}), iterations: {args.number}')
+        for name, case in cases.items():
+            seconds = min(timeit.repeat(case, number=args.number, repeat=3))
+            print(f'  {name:<44} {seconds / args.number * 1e6:10.1f} us/doc')
+        # ベクトル値の桁数を丸めた分、CosmosDBに保存するJSONのサイズも小さくなる
+        legacy_size = len(json.dumps(_LegacyCosmosDocument(**data).model_dump()))
+        current_size = len(json.dumps(CosmosDocument.from_dict(data).to_dict()))
+        print(f'  json bytes: legacy {legacy_size}, current {current_size}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""EmbeddingScheduler を、ローカルの偽のAzure OpenAIサーバーに対して実行するベンチマーク。
+
+サーバーのクォータより小さいTPM/RPMをスケジューラーに設定すると429が発生しないこと、
+大きく設定すると429が発生してもリトライで全件のベクトル値を取得できることを確認する。
+
+使い方（functions ディレクトリで実行）:
+    python benchmarks/bench_embedding_scheduler.py --inputs 500 --server-tpm 60000 --tpm 50000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--inputs', type=int, default=500, help='ベクトル化する文字列の数')
+    parser.add_argument('--text-length', type=int, default=800, help='1文字列あたりの文字数')
+    parser.add_argument('--server-tpm', type=int, default=60000)
+    parser.add_argument('--server-rpm', type=int, default=600)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--tpm', type=int, default=50000, help='スケジューラーのTPM（0は無制限）')
+    parser.add_argument('--rpm', type=int, default=500, help='スケジューラーのRPM（0は無制限）')
+    parser.add_argument('--batch-size', type=int, default=16)
+    args = parser.parse_args()
+
+    from fake_openai_server import start_server
+    server, state = start_server(tpm=args.server_tpm, rpm=args.server_rpm, error_rate=args.error_rate)
+
+    # 環境変数はモジュールの読み込み時に参照されるため、設定してから読み込む
+    os.environ['AOAI_ENDPOINT'] = f'http://127.0.0.1:{server.server_port}'
+    os.environ.setdefault('AOAI_API_VERSION', '2024-02-01')
+    os.environ.setdefault('AOAI_API_KEY', 'fake')
+    os.environ.setdefault('AOAI_EMBEDDING_DEPLOYMENT', 'text-embedding-3-small')
+    os.environ['AOAI_EMBEDDING_MAX_BATCH_SIZE'] = str(args.batch_size)
+    os.environ['AOAI_EMBEDDING_BACKOFF_SECONDS'] = '0.2'
+    from util.openai_service import AzureOpenAIService, EmbeddingScheduler
+
+    service = AzureOpenAIService()
+    service.scheduler = EmbeddingScheduler(tpm=args.tpm, rpm=args.rpm)
+    inputs = [f'{index:06d} ' + 'あいうえお' * (args.text_length // 5) for index in range(args.inputs)]
+
+    started = time.perf_counter()
+    embeddings = service.get_embeddings(inputs)
+    elapsed = time.perf_counter() - started
+
+    print(f'embedded: {sum(embedding is not None for embedding in embeddings)}/{len(inputs)} in {elapsed:.1f}s')
+    print(f'scheduler: {service.scheduler.metrics()}')
+    print(f'server: requests {state.requests}, throttled {state.throttled}, errors {state.errors}')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
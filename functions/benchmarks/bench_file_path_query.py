@@ -0,0 +1,175 @@
+"""ファイルパスでのアイテムの検索方法ごとに、RUと応答時間を比較するベンチマーク。
+
+次の3つを比較する。
+- legacy: SELECT * を文字列の埋め込みで組み立て、パーティションをまたいで検索する（従来の実装）
+- projected: パラメーター化して必要なフィールドのみを取得し、パーティションをまたいで検索する（パーティションキーが /id）
+- single-partition: projected と同じクエリを、/file_path のパーティション内で検索する（推奨の構成）
+
+CosmosDB Emulator（または検証用のアカウント）に計測用のデータベースを作成して計測する。
+--stub を指定した場合はEmulatorを使わず、インメモリのデータで応答のサイズと変換の時間のみを比較する（RUは計測しない）。
+
+使い方（functions ディレクトリで実行）:
+    python benchmarks/bench_file_path_query.py --files 20 --chunks 30
+    python benchmarks/bench_file_path_query.py --stub
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util.cosmos_service import FILE_CHUNK_FIELDS  # noqa: E402
+
+# CosmosDB Emulator の既定のエンドポイントとキー
+EMULATOR_URL = 'https://localhost:8081'
+EMULATOR_KEY = 'C2y6yDjf5/R+ob0N8A7Cgv30VRDJIWEHLM+4QDU5DE2nQ9nDuVTqobD4b8mGGyPMbIZnqyMsEcaGQy67XIw/Jw=='
+INDEXING_POLICY_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cosmos', 'indexing_policy.json')
+PROJECTION = ', '.join(f'c.{field}' for field in FILE_CHUNK_FIELDS)
+
+
+def make_documents(files: int, chunks: int, dimensions: int) -> list:
+    """計測用のチャンクのアイテムを作成する。
+    """
+    rng = random.Random(0)
+    documents = []
+    for file_index in range(files):
+        file_path = f'https://example.blob.core.windows.net/rag-docs/bench/{file_index:04d}.md'
+        for page_number in range(chunks):
+            documents.append({
+                'id': str(uuid.uuid5(uuid.NAMESPACE_URL, f'{file_path}#{page_number}')),
+                'page_number': page_number,
+                'content': f'# {file_index:04d}.md\n\n' + 'あいうえお' * 160,
+                'vector': [round(rng.uniform(-1, 1), 6) for _ in range(dimensions)],
+                'keywords': ['ベンチマーク', f'file{file_index}'],
+                'file_name': f'bench/{file_index:04d}.md',
+                'file_path': file_path,
+                'delete_flag': False,
+                'vector_update_flag': False,
+                'content_hash': uuid.uuid4().hex,
+                'blob_etag': '0x8DCB9F71B061CD3',
+            })
+    return documents
+
+
+def summarize(name: str, charges: list, latencies: list, sizes: list) -> None:
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    charge = f'{statistics.mean(charges):8.2f}' if charges else '     n/a'
+    print(f'{name:<18} RU/query {charge}  p50 {statistics.median(latencies):7.2f} ms  '
+          f'p95 {p95:7.2f} ms  {statistics.mean(sizes) / 1024:8.1f} KB/query')
+
+
+def run_stub(documents: list, queries: int) -> None:
+    """インメモリのデータで、応答のサイズとJSONの変換の時間を比較する。
+    """
+    by_file = {}
+    for document in documents:
+        by_file.setdefault(document['file_path'], []).append(document)
+    file_paths = list(by_file)
+
+    variants = {
+        'legacy': lambda file_path: [d for d in documents if d['file_path'] == file_path],
+        'projected': lambda file_path: [{field: d[field] for field in FILE_CHUNK_FIELDS}
+                                        for d in documents if d['file_path'] == file_path],
+        'single-partition': lambda file_path: [{field: d[field] for field in FILE_CHUNK_FIELDS}
+                                               for d in by_file[file_path]],
+    }
+    for name, query in variants.items():
+        latencies = []
+        sizes = []
+        for index in range(queries):
+            started = time.perf_counter()
+            payload = json.dumps(query(file_paths[index % len(file_paths)]))
+            json.loads(payload)
+            latencies.append((time.perf_counter() - started) * 1000)
+            sizes.append(len(payload.encode('utf-8')))
+        summarize(name, [], latencies, sizes)
+
+
+def run_emulator(documents: list, queries: int, args) -> None:
+    """CosmosDB Emulator に2つのコンテナーを作成し、RUと応答時間を計測する。
+    """
+    from azure.cosmos import CosmosClient, PartitionKey
+
+    client = CosmosClient(
+        os.getenv('COSMOS_URL', EMULATOR_URL),
+        credential=os.getenv('COSMOS_CREDENTIAL', EMULATOR_KEY),
+        connection_verify=False)
+    database = client.create_database_if_not_exists(args.database)
+    with open(INDEXING_POLICY_PATH, encoding='utf-8') as f:
+        indexing_policy = json.load(f)
+    # Emulator はベクトルインデックスに対応していない場合があるため、範囲インデックスのみを比較する
+    indexing_policy.pop('vectorIndexes', None)
+    by_id = database.create_container_if_not_exists('by-id', PartitionKey('/id'))
+    by_file_path = database.create_container_if_not_exists(
+        'by-file-path', PartitionKey('/file_path'), indexing_policy=indexing_policy)
+
+    def last_charge(container) -> float:
+        return float(container.client_connection.last_response_headers.get('x-ms-request-charge', 0))
+
+    if not args.skip_seed:
+        for container in (by_id, by_file_path):
+            charges = []
+            for document in documents:
+                container.upsert_item(document)
+                charges.append(last_charge(container))
+            print(f'seeded {container.id:<14} write RU/item {statistics.mean(charges):8.2f}')
+
+    def measure(container, query, parameters=None, partition_key=None):
+        options = {'partition_key': partition_key} if partition_key else {'enable_cross_partition_query': True}
+        started = time.perf_counter()
+        charge = 0.0
+        items = []
+        for page in container.query_items(query=query, parameters=parameters, **options).by_page():
+            items.extend(page)
+            charge += last_charge(container)
+        elapsed = (time.perf_counter() - started) * 1000
+        return charge, elapsed, len(json.dumps(items).encode('utf-8'))
+
+    file_paths = sorted({document['file_path'] for document in documents})
+    variants = {
+        'legacy': lambda file_path: measure(
+            by_id, f"SELECT * FROM c WHERE c.file_path = '{file_path}'"),
+        'projected': lambda file_path: measure(
+            by_id, f'SELECT {PROJECTION} FROM c WHERE c.file_path = @file_path',
+            [{'name': '@file_path', 'value': file_path}]),
+        'single-partition': lambda file_path: measure(
+            by_file_path, f'SELECT {PROJECTION} FROM c WHERE c.file_path = @file_path',
+            [{'name': '@file_path', 'value': file_path}], file_path),
+    }
+    for name, query in variants.items():
+        results = [query(file_paths[index % len(file_paths)]) for index in range(queries)]
+        summarize(name, [r[0] for r in results], [r[1] for r in results], [r[2] for r in results])
+
+    if args.cleanup:
+        client.delete_database(args.database)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=20, help='ファイル数')
+    parser.add_argument('--chunks', type=int, default=30, help='1ファイルあたりのチャンク数')
+    parser.add_argument('--dimensions', type=int, default=1536, help='ベクトル値の次元数')
+    parser.add_argument('--queries', type=int, default=100, help='検索方法ごとのクエリの回数')
+    parser.add_argument('--database', default='bench-file-path')
+    parser.add_argument('--stub', action='store_true', help='Emulatorを使わずにインメモリで比較する')
+    parser.add_argument('--skip-seed', action='store_true', help='登録済みのデータを使う')
+    parser.add_argument('--cleanup', action='store_true', help='計測後にデータベースを削除する')
+    args = parser.parse_args()
+
+    documents = make_documents(args.files, args.chunks, args.dimensions)
+    print(f'{len(documents)} items ({args.files} files x {args.chunks} chunks, {args.dimensions} dims)')
+    if args.stub:
+        run_stub(documents, args.queries)
+    else:
+        run_emulator(documents, args.queries, args)
+
+
+if __name__ == '__main__':
+    main()
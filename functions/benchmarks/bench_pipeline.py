@@ -0,0 +1,315 @@
+"""EventGridのイベントから検索までを、Blob、CosmosDB、Azure OpenAIのプロセス内の代替に対して実行するベンチマーク。
+
+function_app の EventGridTrigger と cosmosdb_trigger、CosmosService.get_items_by_vector を実際のコードのまま呼び出し、
+クライアントの取得関数だけを代替（fakes.py と fake_openai_server.py）に差し替える。
+ファイルサイズとファイル数（コーパスのサイズ）の組み合わせごとに、次の値を出力する。
+- 1秒あたりの登録アイテム数（Blobイベントの処理からベクトル値の更新まで）
+- 段階ごとの所要時間の p50 / p95 / p99
+- メモリ使用量のピーク（tracemalloc）
+- 段階ごとの呼び出し回数と、429の回数
+
+合成したファイルに加えて、testpost/evgrid.http に記録したイベントを data/ のMarkdownに対して再生する。
+
+使い方（functions ディレクトリで実行）:
+    python benchmarks/bench_pipeline.py --file-kb 4,32,256 --files 5,20
+    python benchmarks/bench_pipeline.py --cosmos-ru 400 --openai-tpm 60000 --output before.json
+"""
+import argparse
+import contextlib
+import glob
+import json
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.dirname(BENCH_DIR)
+DATA_DIR = os.path.join(os.path.dirname(FUNCTIONS_DIR), 'data')
+ACCOUNT_URL = 'https://benchaccount.blob.core.windows.net'
+# 変更フィードのトリガーが1回に受け取るアイテム数
+CHANGE_FEED_BATCH_SIZE = 100
+STAGES = ('event', 'vector', 'search', 'blob.download', 'blob.chunk', 'cosmos.query', 'cosmos.read',
+          'cosmos.write', 'cosmos.batch', 'openai.embeddings')
+
+
+def load_recorded_events(path: str) -> list:
+    """REST Clientの .http ファイルから、EventGridのイベントのJSONを読み込む。
+    """
+    with open(path, encoding='utf-8') as f:
+        sections = f.read().split('###')
+    events = []
+    for section in sections:
+        # URLの {{FUNCTION_NAME}} を除くため、行頭の { から本文とする
+        start, end = section.find('\n{'), section.rfind('}')
+        if start >= 0:
+            events.append(json.loads(section[start:end + 1]))
+    return events
+
+
+def make_event_payload(template: dict, blob_url: str, etag: str, sequence: int,
+                       event_type: str = 'Microsoft.Storage.BlobCreated') -> dict:
+    """記録したイベントをもとに、BlobのURLとETag、sequencerを置き換えたイベントを作成する。
+    """
+    blob_name = blob_url.split('rag-docs/')[1]
+    return {
+        **template,
+        'id': str(uuid.uuid4()),
+        'eventType': event_type,
+        'subject': f'/blobServices/default/containers/rag-docs/blobs/{blob_name}',
+        'data': {**template['data'], 'url': blob_url, 'eTag': etag, 'sequencer': f'{sequence:048X}'},
+    }
+
+
+def load_source_paragraphs() -> list:
+    """合成するファイルの元になる段落。サンプルのアイテムと data/ のMarkdownを使う。
+    """
+    with open(os.path.join(FUNCTIONS_DIR, 'sample_doc', 'sample_01.json'), encoding='utf-8') as f:
+        texts = [json.load(f)['content']]
+    for path in sorted(glob.glob(os.path.join(DATA_DIR, '*.md'))):
+        with open(path, encoding='utf-8') as f:
+            texts.append(f.read())
+    return [paragraph for text in texts for paragraph in text.split('\n\n') if paragraph.strip()]
+
+
+def synthesize_file(paragraphs: list, index: int, size_kb: int) -> bytes:
+    """指定したサイズのMarkdownを作成する。ファイルごとに段落の順序と末尾の番号を変え、チャンクの内容を重複させない。
+    """
+    parts = [f'# 合成資料 {index:04d}']
+    size = len(parts[0].encode('utf-8'))
+    offset = index * 7
+    while size < size_kb * 1024:
+        paragraph = f'{paragraphs[(offset + len(parts)) % len(paragraphs)]} [{index}-{len(parts)}]'
+        parts.append(paragraph)
+        size += len(paragraph.encode('utf-8')) + 2
+    return '\n\n'.join(parts).encode('utf-8')
+
+
+class Pipeline:
+    """1つのシナリオ分の代替のサービスを作成し、function_app の取得関数を差し替える。
+    """
+
+    def __init__(self, args) -> None:
+        import function_app
+        from fakes import FakeBlobServiceClient, FakeDatabase, StageRecorder
+        from util.cosmos_service import CosmosService
+        from util.embedding_cache import create_embedding_cache
+        from util.openai_service import AzureOpenAIService, EmbeddingScheduler
+        from util.blob_stream import BLOB_STREAM_CHUNK_SIZE
+
+        self.function_app = function_app
+        self.recorder = StageRecorder()
+        self.database = FakeDatabase(self.recorder, args.cosmos_latency_ms, args.cosmos_ru)
+        self.blob_service_client = FakeBlobServiceClient(
+            self.recorder, args.blob_latency_ms, BLOB_STREAM_CHUNK_SIZE)
+
+        # クライアントの作成のみを省略し、CosmosService のメソッドは実際のコードを使う
+        self.cosmos_service = CosmosService.__new__(CosmosService)
+        self.cosmos_service.database = self.database
+        self.cosmos_service.container = self.database.get_container_client(os.environ['COSMOS_CONTAINER_NAME'])
+
+        self.openai_service = AzureOpenAIService()
+        self.openai_service.scheduler = EmbeddingScheduler(tpm=args.tpm, rpm=args.rpm)
+        self.openai_service._create = self.recorder.wrap('openai.embeddings', self.openai_service._create)
+        self.embedding_cache = create_embedding_cache()
+
+        function_app.get_cosmos_service = lambda: self.cosmos_service
+        function_app.get_openai_service = lambda: self.openai_service
+        function_app.get_blob_service_client = lambda: self.blob_service_client
+        function_app.get_embedding_cache = lambda: self.embedding_cache
+        self.event_grid_trigger = _user_function(function_app.EventGridTrigger)
+        self.cosmosdb_trigger = _user_function(function_app.cosmosdb_trigger)
+
+    def send_event(self, payload: dict) -> None:
+        import azure.functions as func
+        event = func.EventGridEvent(
+            id=payload['id'], data=payload['data'], topic='', subject=payload['subject'],
+            event_type=payload['eventType'], event_time=None, data_version=payload.get('dataVersion', '1.0'))
+        self._deliver('event', self.event_grid_trigger, event)
+
+    def drain_change_feed(self, max_rounds: int = 5) -> None:
+        """変更フィードのトリガーを、ベクトル値の更新が必要なアイテムがなくなるまで実行する。
+        """
+        import azure.functions as func
+        for _ in range(max_rounds):
+            changes = self.cosmos_service.container.drain_changes()
+            if not any(change.get('vector_update_flag') for change in changes):
+                return
+            for start in range(0, len(changes), CHANGE_FEED_BATCH_SIZE):
+                documents = func.DocumentList(
+                    func.Document.from_dict(change) for change in changes[start:start + CHANGE_FEED_BATCH_SIZE])
+                self._deliver('vector', self.cosmosdb_trigger, documents)
+
+    def _deliver(self, stage: str, trigger, argument, attempts: int = 3) -> None:
+        """トリガーを呼び出す。例外の場合は、ランタイムの再配信と同様に呼び出し直す。
+        """
+        for attempt in range(attempts):
+            try:
+                with self.recorder.timed(stage):
+                    trigger(argument)
+                return
+            except Exception:
+                self.recorder.count(f'{stage}.errors')
+
+    def search(self, query: str, threshold: float) -> list:
+        embedding = self.openai_service.getEmbedding(query)
+        with self.recorder.timed('search'):
+            return self.cosmos_service.get_items_by_vector(embedding, threshold)
+
+
+def _user_function(function):
+    """デコレーターが返した FunctionBuilder から、元の関数を取り出す。
+    """
+    return function.build().get_user_function() if hasattr(function, 'build') else function
+
+
+def run_scenario(name: str, args, server, blobs: list, events: list) -> dict:
+    """Blobを登録し、イベントの処理、ベクトル値の更新、検索を順に実行して計測値を返す。
+
+    Args:
+        name (str): シナリオの名前
+        args (argparse.Namespace): コマンドライン引数
+        server (tuple): fake_openai_server の (サーバー, 状態)
+        blobs (list): (Blob名, 内容) の組のリスト
+        events (list): 再生するイベントのリスト
+    """
+    _, state = server
+    requests_before, throttled_before, errors_before = state.requests, state.throttled, state.errors
+    pipeline = Pipeline(args)
+    for blob_name, data in blobs:
+        pipeline.blob_service_client.upload('rag-docs', blob_name, data)
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    # CosmosService は処理のたびに標準出力に書き込むため、計測中は捨てる
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        for payload in events:
+            pipeline.send_event(payload)
+        ingested = time.perf_counter()
+        pipeline.drain_change_feed()
+        vectorized = time.perf_counter()
+
+        contents = [item['content'] for item in pipeline.cosmos_service.container.items.values()]
+        rng = random.Random(0)
+        for _ in range(args.queries if contents else 0):
+            content = rng.choice(contents)
+            pipeline.search(content[:200], args.threshold)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    documents = len(pipeline.cosmos_service.container.items)
+    elapsed = vectorized - started
+    return {
+        'scenario': name,
+        'files': len(blobs),
+        'bytes': sum(len(data) for _, data in blobs),
+        'documents': documents,
+        'ingest_seconds': ingested - started,
+        'vector_seconds': vectorized - ingested,
+        'docs_per_second': documents / elapsed if elapsed else 0.0,
+        'memory_peak_mb': peak / 1024 / 1024,
+        'stages': {stage: pipeline.recorder.percentiles(stage) for stage in STAGES
+                   if pipeline.recorder.latencies[stage]},
+        'calls': {
+            **dict(pipeline.recorder.calls),
+            'openai.server_requests': state.requests - requests_before,
+            'openai.server_throttled': state.throttled - throttled_before,
+            'openai.server_errors': state.errors - errors_before,
+        },
+        'scheduler': pipeline.openai_service.scheduler.metrics(),
+    }
+
+
+def print_result(result: dict) -> None:
+    print(f"\n== {result['scenario']}: {result['files']} files, {result['bytes'] / 1024:.0f} KB ==")
+    print(f"documents {result['documents']}  ingest {result['ingest_seconds']:.2f}s  "
+          f"vector {result['vector_seconds']:.2f}s  {result['docs_per_second']:.1f} docs/s  "
+          f"memory peak {result['memory_peak_mb']:.1f} MB")
+    print(f"{'stage':<18}{'calls':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, percentiles in result['stages'].items():
+        print(f"{stage:<18}{result['calls'].get(stage, 0):>8}"
+              f"{percentiles['p50']:>10.2f}{percentiles['p95']:>10.2f}{percentiles['p99']:>10.2f}")
+    others = {name: count for name, count in result['calls'].items() if name not in result['stages']}
+    print(f"calls: {others}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--file-kb', default='4,32,256', help='合成するファイルのサイズ（KB、カンマ区切り）')
+    parser.add_argument('--files', default='5,20', help='合成するファイル数（カンマ区切り）')
+    parser.add_argument('--queries', type=int, default=20, help='シナリオごとの検索の回数')
+    parser.add_argument('--threshold', type=float, default=0.0, help='ベクトル検索の類似度のしきい値')
+    parser.add_argument('--events', default=os.path.join(FUNCTIONS_DIR, 'testpost', 'evgrid.http'),
+                        help='再生するEventGridのイベント（.http）')
+    parser.add_argument('--ingest-mode', default='reconcile', choices=('reconcile', 'replace'))
+    parser.add_argument('--dimensions', type=int, default=256, help='ベクトル値の次元数')
+    parser.add_argument('--blob-latency-ms', type=float, default=5)
+    parser.add_argument('--cosmos-latency-ms', type=float, default=2)
+    parser.add_argument('--cosmos-ru', type=float, default=0, help='CosmosDBのRU/秒（0は無制限）')
+    parser.add_argument('--openai-latency-ms', type=float, default=20)
+    parser.add_argument('--openai-tpm', type=int, default=0, help='偽のサーバーのTPM（0は無制限）')
+    parser.add_argument('--openai-rpm', type=int, default=0, help='偽のサーバーのRPM（0は無制限）')
+    parser.add_argument('--openai-error-rate', type=float, default=0.0)
+    parser.add_argument('--tpm', type=int, default=0, help='EmbeddingSchedulerのTPM（0は無制限）')
+    parser.add_argument('--rpm', type=int, default=0, help='EmbeddingSchedulerのRPM（0は無制限）')
+    parser.add_argument('--output', help='結果を保存するJSONファイル')
+    args = parser.parse_args()
+
+    from fake_openai_server import start_server
+    server = start_server(tpm=args.openai_tpm, rpm=args.openai_rpm, dimensions=args.dimensions,
+                          latency_ms=args.openai_latency_ms, error_rate=args.openai_error_rate)
+
+    # 環境変数はモジュールの読み込み時に参照されるため、設定してから読み込む
+    os.environ['AOAI_ENDPOINT'] = f'http://127.0.0.1:{server[0].server_port}'
+    os.environ.setdefault('AOAI_API_VERSION', '2024-02-01')
+    os.environ.setdefault('AOAI_API_KEY', 'fake')
+    os.environ.setdefault('AOAI_EMBEDDING_DEPLOYMENT', 'text-embedding-3-small')
+    os.environ['AOAI_EMBEDDING_BACKOFF_SECONDS'] = '0.2'
+    os.environ['EMBEDDING_DIMENSIONS'] = str(args.dimensions)
+    os.environ['EMBEDDING_CACHE_BACKEND'] = 'lru'
+    os.environ['EVENT_COALESCE_MODE'] = 'off'
+    os.environ['INGEST_ASYNC'] = 'false'
+    os.environ['INGEST_MODE'] = args.ingest_mode
+    os.environ.setdefault('COSMOS_CONTAINER_NAME', 'rag')
+    logging.disable(logging.WARNING)
+
+    template = next(event for event in load_recorded_events(args.events)
+                    if event['eventType'] == 'Microsoft.Storage.BlobCreated')
+    paragraphs = load_source_paragraphs()
+    results = []
+
+    for files in (int(value) for value in args.files.split(',')):
+        for size_kb in (int(value) for value in args.file_kb.split(',')):
+            blobs = [(f'bench/{size_kb}kb/{index:04d}.md', synthesize_file(paragraphs, index, size_kb))
+                     for index in range(files)]
+            events = [make_event_payload(template, f'{ACCOUNT_URL}/rag-docs/{blob_name}', f'0x{index:X}', index + 1)
+                      for index, (blob_name, _) in enumerate(blobs)]
+            results.append(run_scenario(f'synthetic {size_kb}KB x {files}', args, server, blobs, events))
+            print_result(results[-1])
+
+    # data/ のMarkdownを登録してから、記録したイベントをそのまま再生する
+    recorded = load_recorded_events(args.events)
+    blobs = []
+    for path in sorted(glob.glob(os.path.join(DATA_DIR, '*.md'))):
+        with open(path, 'rb') as f:
+            blobs.append((os.path.basename(path), f.read()))
+    account_url = recorded[0]['data']['url'].split('/rag-docs/')[0]
+    events = [make_event_payload(template, f'{account_url}/rag-docs/{blob_name}', '0x1', index + 1)
+              for index, (blob_name, _) in enumerate(blobs)]
+    results.append(run_scenario('recorded evgrid.http', args, server, blobs, events + recorded))
+    print_result(results[-1])
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    server[0].shutdown()
+
+
+if __name__ == '__main__':
+    main()
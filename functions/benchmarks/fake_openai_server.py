@@ -0,0 +1,169 @@
+"""Azure OpenAIのEmbedding APIを模したローカルのHTTPサーバー。
+
+TPM/RPMの上限を超えると retry-after-ms / retry-after ヘッダー付きの429を返し、
+指定した割合で500を返すため、EmbeddingSchedulerの流量制限とリトライを実際のクォータを使わずに確認できる。
+
+使い方（functions ディレクトリで実行）:
+    python benchmarks/fake_openai_server.py --port 8100 --tpm 60000 --rpm 120
+    # 別のターミナルで AOAI_ENDPOINT=http://localhost:8100 を指定して関数やベンチマークを実行する
+"""
+import argparse
+import base64
+import json
+import random
+import re
+import threading
+import time
+from array import array
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_EMBEDDINGS_PATH = re.compile(r'^/openai/deployments/([^/]+)/embeddings')
+
+
+class FakeOpenAIState:
+    """直近60秒間のトークン数とリクエスト数を記録し、上限を超えたかどうかを判定する。
+    """
+
+    def __init__(self, tpm: int, rpm: int, dimensions: int, latency_ms: float, error_rate: float) -> None:
+        self.tpm = tpm
+        self.rpm = rpm
+        self.dimensions = dimensions
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        # (時刻, トークン数) の組
+        self._window = deque()
+        self._lock = threading.Lock()
+
+    def admit(self, tokens: int):
+        """リクエストを受け付けるかどうかを判定する。
+
+        Returns:
+            float | None: 上限を超えた場合はリトライまでの待ち時間（秒）、受け付けた場合はNone
+        """
+        with self._lock:
+            now = time.monotonic()
+            while self._window and now - self._window[0][0] >= 60:
+                self._window.popleft()
+            used_tokens = sum(used for _, used in self._window)
+            over_tokens = self.tpm and used_tokens + tokens > self.tpm
+            over_requests = self.rpm and len(self._window) + 1 > self.rpm
+            if (over_tokens or over_requests) and self._window:
+                self.throttled += 1
+                return max(0.1, 60 - (now - self._window[0][0]))
+            self._window.append((now, tokens))
+            self.requests += 1
+            return None
+
+
+def _count_tokens(texts: list) -> int:
+    """トークン数の近似値。UTF-8のバイト数の1/4とする。
+    """
+    return sum(max(1, len(text.encode('utf-8')) // 4) for text in texts)
+
+
+def _embedding(text: str, dimensions: int) -> array:
+    """文字列から決まる、正規化したランダムなベクトルを返す。
+    """
+    rng = random.Random(text)
+    vector = array('f', (rng.uniform(-1, 1) for _ in range(dimensions)))
+    norm = sum(value * value for value in vector) ** 0.5 or 1
+    return array('f', (value / norm for value in vector))
+
+
+def make_handler(state: FakeOpenAIState):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            match = _EMBEDDINGS_PATH.match(self.path)
+            if not match:
+                self._send_json(404, {'error': {'code': 'NotFound', 'message': self.path}})
+                return
+
+            body = json.loads(self.rfile.read(int(self.headers.get('content-length', 0))))
+            texts = body['input'] if isinstance(body['input'], list) else [body['input']]
+            tokens = _count_tokens(texts)
+
+            retry_after = state.admit(tokens)
+            if retry_after is not None:
+                self._send_json(429, {'error': {'code': '429', 'message': 'Rate limit exceeded.'}}, {
+                    'retry-after-ms': str(int(retry_after * 1000)),
+                    'retry-after': str(int(retry_after) + 1),
+                })
+                return
+            if random.random() < state.error_rate:
+                state.errors += 1
+                self._send_json(500, {'error': {'code': 'InternalServerError', 'message': 'Injected error.'}})
+                return
+
+            time.sleep(state.latency_ms / 1000)
+            dimensions = body.get('dimensions') or state.dimensions
+            data = []
+            for index, text in enumerate(texts):
+                vector = _embedding(text, dimensions)
+                if body.get('encoding_format') == 'base64':
+                    embedding = base64.b64encode(vector.tobytes()).decode('ascii')
+                else:
+                    embedding = vector.tolist()
+                data.append({'object': 'embedding', 'index': index, 'embedding': embedding})
+            self._send_json(200, {
+                'object': 'list',
+                'data': data,
+                'model': match.group(1),
+                'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+            })
+
+        def _send_json(self, status: int, payload: dict, headers: dict = None) -> None:
+            content = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('content-type', 'application/json')
+            self.send_header('content-length', str(len(content)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(port: int = 0, tpm: int = 0, rpm: int = 0, dimensions: int = 1536,
+                 latency_ms: float = 20, error_rate: float = 0.0) -> tuple[ThreadingHTTPServer, FakeOpenAIState]:
+    """バックグラウンドのスレッドでサーバーを起動する。port=0 の場合は空いているポートを使う。
+
+    Returns:
+        tuple[ThreadingHTTPServer, FakeOpenAIState]: サーバーと、リクエスト数などの状態
+    """
+    state = FakeOpenAIState(tpm, rpm, dimensions, latency_ms, error_rate)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--tpm', type=int, default=120000, help='1分あたりのトークン数の上限（0は無制限）')
+    parser.add_argument('--rpm', type=int, default=720, help='1分あたりのリクエスト数の上限（0は無制限）')
+    parser.add_argument('--dimensions', type=int, default=1536)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='500を返す割合')
+    args = parser.parse_args()
+
+    server, state = start_server(args.port, args.tpm, args.rpm, args.dimensions,
+                                 args.latency_ms, args.error_rate)
+    print(f'Fake Azure OpenAI listening on http://127.0.0.1:{server.server_port}')
+    try:
+        while True:
+            time.sleep(10)
+            print(f'requests: {state.requests}, throttled: {state.throttled}, errors: {state.errors}')
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
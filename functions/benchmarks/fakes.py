@@ -0,0 +1,369 @@
+"""ベンチマーク用の、Blob StorageとCosmosDBのプロセス内の代替。
+
+Azure SDKのクライアントのうち、関数のコードが使うメソッドのみを同じ引数で実装する。
+呼び出しごとに指定した遅延を加え、CosmosDBはRU/秒の上限を超えるとSDKのリトライと同様に待ってから実行する。
+Azure OpenAIは fake_openai_server.py を使う。
+"""
+import math
+import re
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from azure.cosmos import exceptions
+
+_SELECT_PATTERN = re.compile(r'^\s*SELECT\s+(?:TOP\s+(\d+)\s+)?(.*?)\s+FROM\s+c\b(.*)$', re.S | re.I)
+_FIELD_PATTERN = re.compile(r'^c\.(\w+)$')
+_CONDITION_PATTERN = re.compile(r"FROM c WHERE c\.(\w+) = '([^']*)'")
+
+
+class StageRecorder:
+    """処理の段階ごとの所要時間と、呼び出し回数を記録する。複数のスレッドから呼び出される。
+    """
+
+    def __init__(self) -> None:
+        self.latencies = defaultdict(list)
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.latencies[stage].append(seconds)
+            self.calls[stage] += 1
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.calls[name] += amount
+
+    @contextmanager
+    def timed(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def wrap(self, stage: str, func):
+        """関数の呼び出しを計測する関数を返す。
+        """
+        def timed_func(*args, **kwargs):
+            with self.timed(stage):
+                return func(*args, **kwargs)
+        return timed_func
+
+    def percentiles(self, stage: str) -> dict:
+        """段階の所要時間（ミリ秒）の p50 / p95 / p99 を返す。
+        """
+        values = sorted(self.latencies[stage])
+        if not values:
+            return {}
+        return {f'p{p}': values[min(len(values) - 1, math.ceil(len(values) * p / 100) - 1)] * 1000
+                for p in (50, 95, 99)}
+
+
+class RequestUnitBucket:
+    """CosmosDBのプロビジョニングスループット（RU/秒）を模したトークンバケット。
+    """
+
+    def __init__(self, ru_per_second: float, recorder: StageRecorder) -> None:
+        self.ru_per_second = ru_per_second
+        self.recorder = recorder
+        self._available = ru_per_second
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def charge(self, request_units: float) -> None:
+        """RUを消費する。上限を超えた場合は、SDKが429をリトライするのと同様に待つ。
+        """
+        if self.ru_per_second <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._available = min(self.ru_per_second,
+                                  self._available + (now - self._updated) * self.ru_per_second)
+            self._updated = now
+            self._available -= request_units
+            wait = -self._available / self.ru_per_second if self._available < 0 else 0.0
+        if wait:
+            self.recorder.count('cosmos.throttled')
+            time.sleep(wait)
+
+
+class FakeClientConnection:
+    """CosmosClientConnection の代替。直前のレスポンスヘッダー（RU）を保持する。
+    """
+
+    def __init__(self) -> None:
+        self.last_response_headers = {}
+
+
+class FakeQueryIterable:
+    """ItemPaged の代替。max_item_count ごとのページに分ける。
+    """
+
+    def __init__(self, results: list, max_item_count: int = None) -> None:
+        self._results = results
+        self._page_size = max_item_count or len(results) or 1
+
+    def __iter__(self):
+        return iter(self._results)
+
+    def by_page(self, continuation_token=None) -> 'FakePageIterator':
+        return FakePageIterator(self._results, self._page_size, int(continuation_token or 0))
+
+
+class FakePageIterator:
+    """PageIterator の代替。継続トークンは次のページの先頭の位置とする。
+    """
+
+    def __init__(self, results: list, page_size: int, start: int) -> None:
+        self._results = results
+        self._page_size = page_size
+        self._start = start
+        self._done = False
+        self.continuation_token = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        end = self._start + self._page_size
+        page = self._results[self._start:end]
+        self._done = end >= len(self._results)
+        self.continuation_token = None if self._done else str(end)
+        self._start = end
+        return iter(page)
+
+
+class FakeContainer:
+    """ContainerProxy の代替。アイテムをメモリに保持し、関数のコードが発行するクエリのみを解釈する。
+    """
+
+    def __init__(self, name: str, recorder: StageRecorder, latency_ms: float = 0.0,
+                 ru_bucket: RequestUnitBucket = None) -> None:
+        self.id = name
+        self.recorder = recorder
+        self.latency = latency_ms / 1000
+        self.ru_bucket = ru_bucket
+        self.items = {}
+        self.client_connection = FakeClientConnection()
+        # 変更フィード（アイテムIDと最新のリビジョンの順序付きの辞書）
+        self._changes = {}
+        self._lock = threading.Lock()
+
+    def drain_changes(self) -> list:
+        """前回の呼び出し以降に登録、更新されたアイテムの最新のリビジョンを返す。
+        """
+        with self._lock:
+            changes, self._changes = list(self._changes.values()), {}
+        return changes
+
+    def query_items(self, query, parameters=None, partition_key=None,
+                    enable_cross_partition_query=None, max_item_count=None, **kwargs):
+        parameters = {p['name']: p['value'] for p in parameters or []}
+        match = _SELECT_PATTERN.match(query)
+        if match is None:
+            raise ValueError(f'Unsupported query: {query}')
+        top, projection, where = match.groups()
+
+        with self._lock:
+            items = list(self.items.values())
+        if '@file_path' in parameters:
+            items = [item for item in items if item.get('file_path') == parameters['@file_path']]
+        if '@ids' in parameters:
+            ids = set(parameters['@ids'])
+            items = [item for item in items if item['id'] in ids]
+
+        if '@embedding' in parameters:
+            # VectorDistance を全件の総当たりで計算する（ベクトルインデックスのない検索に相当）
+            embedding = parameters['@embedding']
+            threshold = float(re.search(r'>\s*([-\d.]+)', where).group(1))
+            scored = [(item, _cosine(item['vector'], embedding)) for item in items if item.get('vector')]
+            scored = sorted((s for s in scored if s[1] > threshold), key=lambda s: s[1], reverse=True)
+            results = [{'file_name': item['file_name'], 'content': item['content'],
+                        'is_contain_image': item.get('is_contain_image'), 'SimilarityScore': score}
+                       for item, score in scored[:int(top or 10)]]
+        else:
+            fields = [_FIELD_PATTERN.match(field.strip()) for field in projection.split(',')]
+            if projection.strip() == '*':
+                results = [dict(item) for item in items]
+            else:
+                results = [{f.group(1): item[f.group(1)] for f in fields if f.group(1) in item}
+                           for item in items]
+
+        scanned = len(self.items) if partition_key is None else len(items)
+        request_units = 2.5 + 0.01 * scanned + 0.1 * len(results)
+        self._request('cosmos.query', request_units)
+        self.client_connection.last_response_headers = {'x-ms-request-charge': str(request_units)}
+        return FakeQueryIterable(results, max_item_count)
+
+    def read_item(self, item, partition_key=None, **kwargs) -> dict:
+        self._request('cosmos.read', 1)
+        with self._lock:
+            if item not in self.items:
+                raise exceptions.CosmosResourceNotFoundError(status_code=404, message=item)
+            return dict(self.items[item])
+
+    def create_item(self, body, **kwargs) -> dict:
+        with self._lock:
+            if body['id'] in self.items:
+                raise exceptions.CosmosResourceExistsError(status_code=409, message=body['id'])
+        return self.upsert_item(body)
+
+    def upsert_item(self, body, **kwargs) -> dict:
+        self._request('cosmos.write', _write_charge(body))
+        with self._lock:
+            return self._store(dict(body))
+
+    def replace_item(self, item, body, **kwargs) -> dict:
+        return self.upsert_item(body)
+
+    def patch_item(self, item, partition_key=None, patch_operations=(), filter_predicate=None, **kwargs) -> dict:
+        self._request('cosmos.write', 10)
+        with self._lock:
+            current = self.items.get(item)
+            if current is None:
+                raise exceptions.CosmosResourceNotFoundError(status_code=404, message=item)
+            condition = _CONDITION_PATTERN.match(filter_predicate or '')
+            if condition and str(current.get(condition.group(1))) != condition.group(2):
+                raise exceptions.CosmosAccessConditionFailedError(status_code=412, message=item)
+            current = dict(current)
+            for operation in patch_operations:
+                current[operation['path'].strip('/')] = operation.get('value')
+            return self._store(current)
+
+    def delete_item(self, item, partition_key=None, **kwargs) -> None:
+        self._request('cosmos.write', 5)
+        with self._lock:
+            if self.items.pop(item, None) is None:
+                raise exceptions.CosmosResourceNotFoundError(status_code=404, message=item)
+            self._changes.pop(item, None)
+
+    def execute_item_batch(self, batch_operations, partition_key=None, **kwargs) -> list:
+        """トランザクションバッチ。1回の往復で実行する。
+        """
+        self.recorder.count('cosmos.batch_operations', len(batch_operations))
+        with self.recorder.timed('cosmos.batch'):
+            time.sleep(self.latency)
+            for kind, args, *_ in batch_operations:
+                if self.ru_bucket is not None:
+                    self.ru_bucket.charge(_write_charge(args[0]) if kind == 'upsert' else 10)
+                with self._lock:
+                    if kind == 'upsert':
+                        self._store(dict(args[0]))
+                    elif kind == 'patch':
+                        current = dict(self.items[args[0]])
+                        for operation in args[1]:
+                            current[operation['path'].strip('/')] = operation.get('value')
+                        self._store(current)
+                    elif kind == 'delete':
+                        self.items.pop(args[0], None)
+                        self._changes.pop(args[0], None)
+        return [{'statusCode': 200} for _ in batch_operations]
+
+    def _request(self, stage: str, request_units: float) -> None:
+        with self.recorder.timed(stage):
+            if self.ru_bucket is not None:
+                self.ru_bucket.charge(request_units)
+            time.sleep(self.latency)
+
+    def _store(self, item: dict) -> dict:
+        item['_etag'] = f'"{uuid.uuid4()}"'
+        item['_ts'] = int(time.time())
+        self.items[item['id']] = item
+        self._changes[item['id']] = dict(item)
+        return item
+
+
+class FakeDatabase:
+    """DatabaseProxy の代替。
+    """
+
+    def __init__(self, recorder: StageRecorder, latency_ms: float = 0.0, ru_per_second: float = 0.0) -> None:
+        self.recorder = recorder
+        self.latency_ms = latency_ms
+        self.ru_bucket = RequestUnitBucket(ru_per_second, recorder)
+        self.containers = {}
+
+    def get_container_client(self, container) -> FakeContainer:
+        if container not in self.containers:
+            self.containers[container] = FakeContainer(
+                container, self.recorder, self.latency_ms, self.ru_bucket)
+        return self.containers[container]
+
+
+class FakeBlobDownloader:
+    """StorageStreamDownloader の代替。chunks() で分割してダウンロードする。
+    """
+
+    def __init__(self, name: str, data: bytes, chunk_size: int, recorder: StageRecorder, latency: float) -> None:
+        self.name = name
+        self.size = len(data)
+        self._data = data
+        self._chunk_size = chunk_size
+        self._recorder = recorder
+        self._latency = latency
+
+    def chunks(self):
+        for start in range(0, self.size, self._chunk_size):
+            with self._recorder.timed('blob.chunk'):
+                time.sleep(self._latency)
+                chunk = self._data[start:start + self._chunk_size]
+            yield chunk
+
+    def readinto(self, stream) -> int:
+        for chunk in self.chunks():
+            stream.write(chunk)
+        return self.size
+
+    def readall(self) -> bytes:
+        return b''.join(self.chunks())
+
+
+class FakeBlobClient:
+
+    def __init__(self, service: 'FakeBlobServiceClient', container: str, blob: str) -> None:
+        self.service = service
+        self.container = container
+        self.blob = blob
+
+    def download_blob(self, **kwargs) -> FakeBlobDownloader:
+        with self.service.recorder.timed('blob.download'):
+            time.sleep(self.service.latency)
+            data = self.service.blobs[(self.container, self.blob)]
+        return FakeBlobDownloader(self.blob, data, self.service.chunk_size,
+                                  self.service.recorder, self.service.latency)
+
+
+class FakeBlobServiceClient:
+    """BlobServiceClient の代替。Blobの内容をメモリに保持する。
+    """
+
+    def __init__(self, recorder: StageRecorder, latency_ms: float = 0.0, chunk_size: int = 4 * 1024 * 1024) -> None:
+        self.recorder = recorder
+        self.latency = latency_ms / 1000
+        self.chunk_size = chunk_size
+        self.blobs = {}
+
+    def upload(self, container: str, blob: str, data: bytes) -> None:
+        self.blobs[(container, blob)] = data
+
+    def get_blob_client(self, container: str, blob: str) -> FakeBlobClient:
+        return FakeBlobClient(self, container, blob)
+
+
+def _write_charge(item: dict) -> float:
+    """書き込みのRUの近似値。アイテムのサイズ1KBあたり約5RUとする。
+    """
+    size = len(item.get('content') or '') * 3 + len(item.get('vector') or []) * 10
+    return 5 + 5 * size / 1024
+
+
+def _cosine(a: list, b: list) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
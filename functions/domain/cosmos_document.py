@@ -1,50 +1,74 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, SkipValidation
 import uuid
 
+from util.vector_codec import encode_vector
+
+# チャンクのIDを生成するための名前空間
+_CHUNK_ID_NAMESPACE = uuid.NAMESPACE_URL
+
 
 class CosmosDocument(BaseModel):
-    id: str
+    """CosmosDBに登録するチャンクのアイテム。
+
+    変更フィードのアイテムごとに作成するため、作成と辞書への変換のコストを抑える。
+    ベクトル値は要素ごとの検証を省略し、それ以外のフィールドはpydanticの検証に任せる。
+    pydantic v2 では検証を省略する model_construct の方が遅いため使わない（benchmarks/bench_cosmos_document.py）。
+    """
+    # idがない場合はuuidを生成
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     page_number: int
     content: str
-    vector: list
+    # ベクトル値は要素ごとの検証を省略し、float32の配列もそのまま保持する
+    vector: SkipValidation[list]
     keywords: list
     file_name: str
     file_path: str
     delete_flag: bool
     vector_update_flag: bool
-
-    def __init__(self, **data):
-        super().__init__(**data)
-        # idがない場合はuuidを生成
-        if 'id' not in data:
-            self.id = str(uuid.uuid4())
+    # Embeddingモデルのデプロイ名とチャンクの内容のハッシュ値
+    content_hash: str = ''
+    # ベクトル値の計算元の content_hash。content_hash と同じ場合はベクトル化済み
+    vector_hash: str = ''
+    # ベクトル化に失敗した回数と、最後の失敗の理由
+    vector_attempts: int = 0
+    vector_error: str = ''
+    # 登録元のBlobのETag
+    blob_etag: str = ''
+    # ページに画像が含まれるかどうか（PDFのみ）
+    is_contain_image: bool = False
 
     def to_dict(self):
-        return {
-            'id': self.id,
-            'page_number': self.page_number,
-            'content': self.content,
-            'vector': self.vector,
-            'keywords': self.keywords,
-            'file_name': self.file_name,
-            'file_path': self.file_path,
-            'delete_flag': self.delete_flag,
-            'vector_update_flag': self.vector_update_flag
-        }
+        # model_dump はフィールドごとにシリアライズするため、属性の辞書をそのまま使う
+        data = dict(self.__dict__)
+        # CosmosDBから読み込んだベクトル値（リスト）は丸め済みのため、そのまま使う。
+        # float32の配列など、新しく計算したベクトル値のみ変換する
+        if not isinstance(self.vector, list):
+            data['vector'] = encode_vector(self.vector)
+        return data
 
     @staticmethod
     def from_dict(data: dict):
-        return CosmosDocument(
-            id=data['id'],
-            page_number=data['page_number'],
-            content=data['content'],
-            vector=data['vector'],
-            keywords=data['keywords'],
-            file_name=data['file_name'],
-            file_path=data['file_path'],
-            delete_flag=data['delete_flag'],
-            vector_update_flag=data['vector_update_flag']
-        )
+        """CosmosDBのアイテムから作成する。システムプロパティ（_rid, _ts など）は無視する。
+        変更フィードのアイテム（func.Document）は辞書ではないため、辞書に変換してから検証する。
+        """
+        return CosmosDocument.model_validate(dict(data))
+
+    @staticmethod
+    def chunk_id(file_path: str, page_number: int, chunk_index: int = 0) -> str:
+        """ファイルパスとページ番号から、再登録しても変わらないチャンクのIDを生成する。
+
+        Args:
+            file_path (str): BlobのURL
+            page_number (int): ページ番号（チャンク番号）
+            chunk_index (int, optional): ページ内のチャンク番号。0の場合はページ番号のみから生成する
+
+        Returns:
+            str: チャンクのID
+        """
+        name = f'{file_path}#{page_number}'
+        if chunk_index:
+            name += f'.{chunk_index}'
+        return str(uuid.uuid5(_CHUNK_ID_NAMESPACE, name))
 
     def __str__(self):
-        return f'CosmosDocument(id={self.id}, page_number={self.page_number}, content={self.content}, vector={self.content_vector}, keywords={self.keywords}, file_name={self.file_name}, file_path={self.file_path}, delete_flag={self.delete_flag}, vector_update_flag={self.vector_update_flag})'
+        return f'CosmosDocument(id={self.id}, page_number={self.page_number}, content={self.content}, vector=<{len(self.vector)} dims>, keywords={self.keywords}, file_name={self.file_name}, file_path={self.file_path}, delete_flag={self.delete_flag}, vector_update_flag={self.vector_update_flag})'
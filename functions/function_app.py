@@ -2,30 +2,46 @@ import azure.functions as func
 import logging
 import os
 import json
-import uuid
+import time
 from io import BytesIO
 
-from azure.storage.blob import BlobServiceClient
-from util.cosmos_service import CosmosService
-from util.openai_service import AzureOpenAIService
-from domain.cosmos_document import CosmosDocument
+from util import telemetry
+from util.clients import (get_blob_service_client, get_cosmos_service, get_dual_write_openai_service,
+                          get_embedding_cache, get_event_coalescer, get_event_queue, get_openai_service)
+from util.cosmos_service import FILE_CHUNK_FIELDS
+from util.openai_service import EmbeddingError
+from util.chunker import chunk_markdown
+from util.blob_stream import download_to_tempfile, iter_text
+from util.pdf_extractor import iter_pdf_pages
+from util.ingest_util import ChunkReconciler, batched, build_documents, build_page_documents, lookup_embeddings, raise_if_failed
+from util.event_coalescer import (EVENT_COALESCE_MODE, EVENT_QUEUE_NAME, BlobEvent,
+                                  BlobEventClaimedError)
+from util.vector_updater import (EmbeddingOutcome, dual_write_inputs, embedding_groups, finish_vector_updates,
+                                 plan_vector_updates)
 
 app = func.FunctionApp()
+# 同期版のトリガー。INGEST_ASYNC=true の場合は async_triggers の非同期版を代わりに登録する
+sync_bp = func.Blueprint()
+# EVENT_COALESCE_MODE=queue の場合のみ登録する、遅延させたBlobイベントのキュートリガー
+coalesce_bp = func.Blueprint()
 
 # 環境変数
 COSMOS_CONNECTION = os.getenv('COSMOS_CONNECTION')
 COSMOS_DATABASE_NAME = os.getenv('COSMOS_DATABASE_NAME')
 COSMOS_CONTAINER_NAME = os.getenv('COSMOS_CONTAINER_NAME')
 BLOB_CONNECTION = os.getenv('BLOB_CONNECTION')
+# Blob更新時の登録方法: reconcile（差分のみ更新）/ replace（全削除して再登録）
+INGEST_MODE = os.getenv('INGEST_MODE', 'reconcile')
+# 一括書き込み1回あたりのアイテム数
+BULK_WRITE_BATCH_SIZE = int(os.getenv('BULK_WRITE_BATCH_SIZE', '100'))
+INGEST_ASYNC = os.getenv('INGEST_ASYNC', 'false').lower() == 'true'
 
 # client
-openai_service = AzureOpenAIService()
-cosmos_service = CosmosService()
-blob_service_client = BlobServiceClient.from_connection_string(BLOB_CONNECTION)
+# コールドスタートを短くするため、クライアントは初回の呼び出し時に作成する（util/clients.py）
 
 
-@app.cosmos_db_trigger(arg_name="azcosmosdb", container_name=COSMOS_CONTAINER_NAME,
-                       database_name=COSMOS_DATABASE_NAME, connection="cosmosragdataeventdriven_DOCUMENTDB")
+@sync_bp.cosmos_db_trigger(arg_name="azcosmosdb", container_name=COSMOS_CONTAINER_NAME,
+                           database_name=COSMOS_DATABASE_NAME, connection="cosmosragdataeventdriven_DOCUMENTDB")
 def cosmosdb_trigger(azcosmosdb: func.DocumentList):
     """
     CosmosDBの登録、更新、削除をトリガーに実行され、vector_update_flagがTrueの場合にベクトル値を更新する
@@ -40,31 +56,74 @@ def cosmosdb_trigger(azcosmosdb: func.DocumentList):
     """
     logging.info('Python CosmosDB triggered.')
 
-    try:
-        for doc in azcosmosdb:
-            doc_document = CosmosDocument(**doc)
-
-            # ベクトル更新フラグがTrueの場合のみベクトル値を更新
-            if doc_document.vector_update_flag:
-                logging.info(
-                    f'🚀 Start update vector: {doc_document.file_name}')
-
-                # ベクトル値を取得
-                embedding = openai_service.getEmbedding(doc_document.content)
-
-                # CosmosDBにベクトル値を更新
-                doc_document.vector = embedding
-                doc_document.vector_update_flag = False
-                cosmos_service.upsert_item(doc_document.dict())
+    with telemetry.span('ingest.vector_update', {'ingest.documents': len(azcosmosdb)}) as span:
+        try:
+            # ベクトル更新フラグがTrueのドキュメントのみを対象にする
+            flagged = [doc for doc in azcosmosdb if doc.get('vector_update_flag')]
+            if not flagged:
+                return
+            cosmos_service = get_cosmos_service()
+            openai_service = get_openai_service()
+            embedding_cache = get_embedding_cache()
+
+            # 現在の状態と比較し、再配信されたリビジョンや処理済みのリビジョンを除く
+            states = cosmos_service.get_vector_states([doc['id'] for doc in flagged])
+            pending, patches, skipped = plan_vector_updates(flagged, states)
+            span.set('ingest.pending', len(pending))
+            span.set('ingest.skipped', skipped)
+            logging.info(
+                f'🚀 Start update vector: {len(pending)} documents ({len(patches)} flag only, {skipped} skipped)')
+
+            outcome = EmbeddingOutcome()
+            if pending:
+                # 内容のハッシュ値でキャッシュを検索し、キャッシュにないものだけベクトル化する
+                cached, missed = lookup_embeddings(
+                    [document for _, document in pending], embedding_cache)
                 logging.info(
-                    f'✅ Finish update vector: {doc_document.file_name}')
-
-    except Exception as e:
-        logging.error(f'❌ Error: {e}')
-        raise e
-
-
-@app.event_grid_trigger(arg_name="azeventgrid")
+                    f'🚀 Embedding cache: {len(pending) - len(missed)} hits, {len(missed)} misses')
+                outcome.embeddings.update(cached)
+
+                for group in embedding_groups(pending, missed):
+                    try:
+                        outcome.add(group, openai_service.get_embeddings(list(group.values())))
+                    except EmbeddingError as e:
+                        outcome.add(group, error=e)
+                # 成功したベクトル値はキャッシュに保存し、ランタイムの再実行時にベクトル化し直さない
+                embedding_cache.set_many({content_hash: outcome.embeddings[content_hash]
+                                          for content_hash in missed if content_hash in outcome.embeddings})
+
+                # モデルの切り替え中は、切り替え先のデプロイのベクトル値も書き込む
+                dual_write_service = get_dual_write_openai_service()
+                if dual_write_service is not None:
+                    inputs = dual_write_inputs(pending, outcome.embeddings)
+                    try:
+                        outcome.add_dual_write(inputs, dual_write_service.get_embeddings(list(inputs.values())))
+                    except EmbeddingError as e:
+                        outcome.add_dual_write(inputs, error=e)
+
+            # 成功したアイテムと失敗したアイテムを先に更新し、全体の失敗は最後に送出する
+            vector_patches, dead_letters = finish_vector_updates(
+                pending, outcome.embeddings, outcome.errors, outcome.dual_embeddings, outcome.dual_errors)
+            if outcome.dual_errors:
+                logging.warning(f'❌ Dual-write skipped (left for backfill): {len(outcome.dual_errors)} items')
+            results = cosmos_service.patch_items(patches + vector_patches)
+            if dead_letters:
+                cosmos_service.upsert_dead_letters(dead_letters)
+                logging.warning(f'❌ Dead-lettered: {[record["id"] for record in dead_letters]}')
+            raise_if_failed(results, 'patch vector')
+            if outcome.error is not None:
+                raise outcome.error
+            updated = sum(document.content_hash in outcome.embeddings for _, document in pending)
+            span.set('ingest.updated', updated)
+            logging.info(
+                f'✅ Finish update vector: {updated} documents, {len(pending) - updated} failed')
+
+        except Exception as e:
+            logging.error(f'❌ Error: {e}')
+            raise e
+
+
+@sync_bp.event_grid_trigger(arg_name="azeventgrid")
 def EventGridTrigger(azeventgrid: func.EventGridEvent):
     """EventGridTriggerで、Blobの作成、削除イベントをトリガーとして、Blobファイルの内容をCosmosDBに登録する
     - Blobの作成イベントの場合、Blobファイルの内容をCosmosDBに登録する。ファイル更新も作成イベントとして扱われるため、同じファイルパスがCosmosDBに登録されている場合はCosmosDBのアイテムを削除する。
@@ -110,86 +169,238 @@ def EventGridTrigger(azeventgrid: func.EventGridEvent):
     })
     # eventを辞書型に変換
     event_dict = json.loads(event)
-    blob_url = event_dict.get('data').get('url')
+    blob_event = BlobEvent.from_event_grid(event_dict.get('event_type'), event_dict.get('data'))
 
     logging.info(f'🚀Python EventGrid trigger: {event_dict}')
+    event_coalescer = get_event_coalescer()
 
     try:
-        # event_typeがBlobCreatedの場合
-        if event_dict.get('event_type') == 'Microsoft.Storage.BlobCreated':
-
-            logging.info(f'🚀 Event Type: {event_dict.get("event_type")}')
-
-            # Blobファイルの内容を取得
-            blob_name = blob_url.split("rag-docs/")[1]
-            logging.info(f'🚀 Blob Name: {blob_name}')
-            blob_client = blob_service_client.get_blob_client(
-                container='rag-docs', blob=blob_name)
-            blob_data = blob_client.download_blob()
-            logging.info(f'🚀 Blob File Downloaded.')
-
-            # ファイル名と拡張子を取得
-            file_name = blob_data.name
-            file_extension = os.path.splitext(file_name)[1]
-
-            logging.info(f'🚀 File Name: {file_name}')
-            logging.info(f'🚀 File Extension: {file_extension}')
-
-            rag_docs = blob_data.content_as_bytes()
-
-            # 同じblob_urlがCosmosDBに登録されている場合はCosmosDBのアイテムを削除
-            query = f"SELECT * FROM c WHERE c.file_path = '{blob_url}'"
-            items = cosmos_service.get_item(query)
-            for item in items:
-                # CosmosDBのアイテムを削除
-                cosmos_service.delete_item(item['id'])
-                logging.info(
-                    f'🚀 Deleted CosmosDB item: {item["file_name"]}')
-
-            # ファイルの内容をCosmosDBに登録
-
-            if file_extension == ".txt" or file_extension == ".md":
-                logging.info("🚀 Trigger blob file is Text or Markdown")
-                content = rag_docs.decode('utf-8')
-                # ファイル名をタイトルとして、コンテンツをMarkdown形式にする
-                content = '# ' + file_name + '\n\n' + content
-
-                # CosmosDBに登録するアイテムのオブジェクト
-                cosmos_obj = CosmosDocument(
-                    id=str(uuid.uuid4()),
-                    file_name=file_name,
-                    file_path=blob_url,
-                    page_number=0,
-                    content=content,
-                    vector=[],
-                    keywords=[],
-                    delete_flag=False,
-                    vector_update_flag=True
-                )
-                cosmos_service.upsert_item(cosmos_obj.to_dict())
+        # sequencerがないイベント（手動のテストなど）は集約せずに処理する
+        if event_coalescer is None or not blob_event.sequencer:
+            _process_blob_event(blob_event)
+            return
 
-            else:
-                logging.warning(
-                    f'❌ Unsupported file type: {file_extension}')
+        # 同じBlobの古いイベントや処理済みのイベントは破棄する
+        if not event_coalescer.offer(blob_event):
+            logging.info(f'🚀 Skipped stale blob event: {blob_event.url} ({blob_event.sequencer})')
+            return
 
-        # event_typeがBlobDeletedの場合
-        elif event_dict.get('event_type') == 'Microsoft.Storage.BlobDeleted':
-            logging.info(f'🚀Event Type: {event_dict.get("event_type")}')
-    
-            # blob_urlがCosmosDBに登録されている場合はCosmosDBのアイテムを削除
-            query = f"SELECT * FROM c WHERE c.file_path = '{blob_url}'"
-            items = cosmos_service.get_item(query)
+        if EVENT_COALESCE_MODE == 'queue':
+            # 待ち時間の後にキュートリガーで処理する
+            get_event_queue().send(blob_event, event_coalescer.window_seconds)
+            return
+
+        # 待ち時間の間に同じBlobの新しいイベントが届いた場合は、新しいイベントの呼び出しに任せる
+        time.sleep(event_coalescer.window_seconds)
+        _process_claimed_event(event_coalescer, blob_event)
+
+    except Exception as e:
+        logging.error(f'❌Error: {e}')
+        raise e
 
-            for item in items:
-                # CosmosDBのアイテムを削除
-                cosmos_service.delete_item(item['id'])
-                logging.info(
-                    f'🚀Deleted CosmosDB item: {item["file_name"]}')
 
-        else:
-            logging.warning(
-                f'❌Unsupported event type: {event_dict.get("event_type")}')
+@coalesce_bp.queue_trigger(arg_name="msg", queue_name=EVENT_QUEUE_NAME, connection="BLOB_CONNECTION")
+def BlobEventQueueTrigger(msg: func.QueueMessage):
+    """EVENT_COALESCE_MODE=queue の場合に、待ち時間だけ遅延させたBlobイベントを処理する。
+    待ち時間の間に同じBlobの新しいイベントが届いた場合は、このイベントは破棄される。
 
+    Args:
+        msg (func.QueueMessage): BlobEvent の辞書のJSON
+    """
+    blob_event = BlobEvent.from_dict(json.loads(msg.get_body().decode('utf-8')))
+    logging.info(f'🚀Python Queue trigger: {blob_event}')
+    try:
+        _process_claimed_event(get_event_coalescer(), blob_event)
     except Exception as e:
         logging.error(f'❌Error: {e}')
         raise e
+
+
+def _process_claimed_event(event_coalescer, blob_event: BlobEvent) -> None:
+    """受け付けたイベントがBlobの最新のイベントの場合のみ、処理して完了を記録する。
+    同じBlobの古いイベントを処理中の場合は、queue の場合はキューに送り直し、local の場合は待ってから claim し直す。
+
+    Args:
+        event_coalescer (BlobEventCoalescer): イベントの集約
+        blob_event (BlobEvent): offer で受け付けたイベント
+    """
+    while True:
+        try:
+            latest = event_coalescer.claim(blob_event)
+            break
+        except BlobEventClaimedError:
+            # 同じBlobの古いイベントを処理中のため、処理が終わった後に最新の状態を処理する
+            if EVENT_COALESCE_MODE == 'queue':
+                get_event_queue().send(blob_event, event_coalescer.window_seconds)
+                return
+            logging.info(f'🚀 Waiting for blob event in progress: {blob_event.url}')
+            time.sleep(event_coalescer.window_seconds)
+    if latest is None:
+        logging.info(f'🚀 Skipped superseded blob event: {blob_event.url} ({blob_event.sequencer})')
+        return
+    try:
+        _process_blob_event(latest)
+    except Exception:
+        event_coalescer.release(latest)
+        raise
+    event_coalescer.complete(latest)
+
+
+def _process_blob_event(blob_event: BlobEvent) -> None:
+    """Blobの作成、削除イベントを処理する。
+
+    Args:
+        blob_event (BlobEvent): Blobイベント
+    """
+    cosmos_service = get_cosmos_service()
+    blob_url = blob_event.url
+    with telemetry.span('ingest.blob_event', {'blob.event_type': blob_event.event_type, 'blob.url': blob_url}):
+        try:
+            # event_typeがBlobCreatedの場合
+            if blob_event.event_type == 'Microsoft.Storage.BlobCreated':
+
+                logging.info(f'🚀 Event Type: {blob_event.event_type}')
+
+                # BlobのETagが登録済みのアイテムと同じ場合は、内容が変わらないため処理を省略
+                blob_etag = blob_event.etag
+                existing_items = cosmos_service.query_by_file_path(blob_url, FILE_CHUNK_FIELDS)
+                if blob_etag and existing_items and all(
+                        item.get('blob_etag') == blob_etag for item in existing_items):
+                    logging.info(f'🚀 Skipped unchanged blob: {blob_url} (eTag: {blob_etag})')
+                    return
+
+                # Blobファイルの内容を取得
+                blob_name = blob_url.split("rag-docs/")[1]
+                logging.info(f'🚀 Blob Name: {blob_name}')
+                blob_client = get_blob_service_client().get_blob_client(
+                    container='rag-docs', blob=blob_name)
+                blob_data = blob_client.download_blob()
+                logging.info(f'🚀 Blob File Download Started.')
+
+                # ファイル名と拡張子を取得
+                file_name = blob_data.name
+                file_extension = os.path.splitext(file_name)[1]
+
+                logging.info(f'🚀 File Name: {file_name}')
+                logging.info(f'🚀 File Extension: {file_extension}')
+
+                # ファイルの内容をチャンクに分割したCosmosDBのアイテム
+                pdf_path = None
+                # ダウンロード、デコード、チャンク分割、登録を逐次処理し、ファイル全体をメモリに保持しない
+                if file_extension == ".txt" or file_extension == ".md":
+                    logging.info("🚀 Trigger blob file is Text or Markdown")
+                    documents = build_documents(
+                        chunk_markdown(iter_text(telemetry.timed_chunks('blob.download', blob_data.chunks()))), file_name, blob_url, blob_etag)
+
+                # PDFはページごとにMarkdownに変換し、抽出が終わったページから登録する
+                elif file_extension == ".pdf":
+                    logging.info("🚀 Trigger blob file is PDF")
+                    with telemetry.span('blob.download'):
+                        pdf_path = download_to_tempfile(blob_data, file_extension)
+                    documents = build_page_documents(
+                        iter_pdf_pages(pdf_path), file_name, blob_url, blob_etag)
+
+                else:
+                    logging.warning(
+                        f'❌ Unsupported file type: {file_extension}')
+                    documents = []
+
+                # 同じblob_urlがCosmosDBに登録されている場合は、新しいチャンクで置き換える
+                try:
+                    if INGEST_MODE == 'replace':
+                        _replace_documents(blob_url, documents)
+                    else:
+                        _reconcile_documents(existing_items, documents)
+                finally:
+                    if pdf_path:
+                        os.remove(pdf_path)
+
+            # event_typeがBlobDeletedの場合
+            elif blob_event.event_type == 'Microsoft.Storage.BlobDeleted':
+                logging.info(f'🚀Event Type: {blob_event.event_type}')
+    
+                # blob_urlがCosmosDBに登録されている場合はCosmosDBのアイテムをまとめて削除
+                results = cosmos_service.delete_by_file_path(blob_url)
+                raise_if_failed(results, 'delete')
+                logging.info(f'🚀Deleted CosmosDB items: {blob_url} ({len(results)} items)')
+
+            else:
+                logging.warning(
+                    f'❌Unsupported event type: {blob_event.event_type}')
+
+        except Exception as e:
+            logging.error(f'❌Error: {e}')
+            raise e
+
+
+def _replace_documents(blob_url: str, documents) -> None:
+    """登録済みのアイテムをすべて削除してから、新しいアイテムを登録する。
+    内容が変わらないチャンクは、削除したアイテムのベクトル値を引き継ぐ。
+
+    Args:
+        blob_url (str): BlobのURL
+        documents (Iterable[CosmosDocument]): 登録するアイテム
+    """
+    cosmos_service = get_cosmos_service()
+    items = cosmos_service.query_by_file_path(blob_url, ('file_path', 'content_hash', 'vector'))
+    existing_vectors = {item['content_hash']: item['vector'] for item in items
+                        if item.get('content_hash') and item.get('vector')}
+
+    # CosmosDBのアイテムをまとめて削除
+    raise_if_failed(cosmos_service.delete_items(items), 'delete')
+    logging.info(f'🚀 Deleted CosmosDB items: {blob_url} ({len(items)} items)')
+
+    chunk_count = 0
+    for batch in batched(documents, BULK_WRITE_BATCH_SIZE):
+        for document in batch:
+            # 内容が変わらないチャンクはベクトル値をコピーし、ベクトル化を省略する
+            vector = existing_vectors.get(document.content_hash)
+            if vector:
+                document.vector = vector
+                document.vector_hash = document.content_hash
+                document.vector_update_flag = False
+        raise_if_failed(cosmos_service.upsert_items(
+            [document.to_dict() for document in batch]), 'upsert')
+        chunk_count += len(batch)
+    logging.info(f'🚀 Registered chunks: {blob_url} ({chunk_count} chunks)')
+
+
+def _reconcile_documents(existing_items: list, documents) -> None:
+    """登録済みのアイテムと新しいアイテムを比較し、差分のみを更新する。
+
+    Args:
+        existing_items (list): 登録済みのアイテム（id, file_name, file_path, content_hash, blob_etag）
+        documents (Iterable[CosmosDocument]): 登録するアイテム
+    """
+    cosmos_service = get_cosmos_service()
+    reconciler = ChunkReconciler(existing_items)
+    for batch in batched(documents, BULK_WRITE_BATCH_SIZE):
+        upserts, patches, moved = reconciler.plan(batch)
+        for document, source in moved:
+            vector = cosmos_service.read_item(
+                source['id'], cosmos_service.partition_key_of(source)).get('vector')
+            if vector:
+                document.vector = vector
+                document.vector_hash = document.content_hash
+                document.vector_update_flag = False
+        raise_if_failed(cosmos_service.upsert_items(
+            [document.to_dict() for document in upserts]), 'upsert')
+        raise_if_failed(cosmos_service.patch_items(patches), 'patch')
+
+    # 新しいチャンクに含まれないアイテムをまとめて削除
+    removed = reconciler.removed_items()
+    raise_if_failed(cosmos_service.delete_items(removed), 'delete')
+
+    logging.info(
+        f'🚀 Reconciled chunks: {reconciler.upserted} upserted, {reconciler.unchanged} unchanged, {len(removed)} deleted')
+
+
+if INGEST_ASYNC:
+    from async_triggers import bp as async_bp, coalesce_bp as async_coalesce_bp
+    app.register_functions(async_bp)
+    if EVENT_COALESCE_MODE == 'queue':
+        app.register_functions(async_coalesce_bp)
+else:
+    app.register_functions(sync_bp)
+    if EVENT_COALESCE_MODE == 'queue':
+        app.register_functions(coalesce_bp)
@@ -0,0 +1,12 @@
+"""テストの共通設定。関数のコードと、benchmarks の偽のサーバーとクライアントを読み込めるようにする。
+
+使い方（functions ディレクトリで実行）:
+    pip install -r requirements.txt -r requirements-dev.txt
+    python -m pytest -q
+"""
+import os
+import sys
+
+_FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(_FUNCTIONS_DIR, 'benchmarks'))
+sys.path.insert(0, _FUNCTIONS_DIR)
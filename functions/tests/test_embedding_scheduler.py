@@ -0,0 +1,115 @@
+"""EmbeddingScheduler を、benchmarks/fake_openai_server.py の偽のAzure OpenAIサーバーに対して確認する。
+"""
+import threading
+from http.server import ThreadingHTTPServer
+
+import openai
+import pytest
+
+from fake_openai_server import FakeOpenAIState, make_handler, start_server
+from util import openai_service
+from util.openai_service import AzureOpenAIService, EmbeddingError, EmbeddingScheduler
+
+_DIMENSIONS = 8
+
+
+class _ThrottleFirstState(FakeOpenAIState):
+    """最初の指定した回数のリクエストに、短い retry-after の429を返す。
+    """
+
+    def __init__(self, throttle_count: int, retry_after: float) -> None:
+        super().__init__(tpm=0, rpm=0, dimensions=_DIMENSIONS, latency_ms=0, error_rate=0.0)
+        self.throttle_count = throttle_count
+        self.retry_after = retry_after
+
+    def admit(self, tokens: int):
+        with self._lock:
+            if self.throttled < self.throttle_count:
+                self.throttled += 1
+                return self.retry_after
+        return super().admit(tokens)
+
+
+@pytest.fixture
+def serve():
+    """偽のサーバーを起動し、そのサーバーに接続するサービスを作成する関数を返す。
+    """
+    servers = []
+
+    def serve(monkeypatch, state: FakeOpenAIState = None, **kwargs) -> tuple[AzureOpenAIService, FakeOpenAIState]:
+        if state is None:
+            server, state = start_server(dimensions=_DIMENSIONS, latency_ms=0, **kwargs)
+        else:
+            server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(state))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        monkeypatch.setenv('AOAI_ENDPOINT', f'http://127.0.0.1:{server.server_port}')
+        monkeypatch.setenv('AOAI_API_VERSION', '2024-02-01')
+        monkeypatch.setenv('AOAI_API_KEY', 'fake')
+        return AzureOpenAIService('text-embedding-3-small', EmbeddingScheduler(tpm=0, rpm=0, max_retries=2)), state
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def small_batches(monkeypatch):
+    monkeypatch.setattr(openai_service, 'AOAI_EMBEDDING_MAX_BATCH_SIZE', 2)
+    monkeypatch.setattr(openai_service, 'AOAI_EMBEDDING_BACKOFF_SECONDS', 0.01)
+
+
+def test_embed_returns_vectors_in_input_order(serve, monkeypatch):
+    service, state = serve(monkeypatch)
+    inputs = [f'text {index}' for index in range(5)]
+
+    embeddings = service.get_embeddings(inputs)
+
+    assert len(embeddings) == len(inputs)
+    assert all(len(embedding) == _DIMENSIONS for embedding in embeddings)
+    # 同じ文字列は同じベクトル値になるため、順序が入れ替わっていないことを確認できる
+    assert list(embeddings[3]) == list(service.get_embeddings(['text 3'])[0])
+    assert state.requests == 4
+    assert service.scheduler.metrics()['queue_depth'] == 0
+
+
+def test_throttled_request_waits_retry_after_and_retries(serve, monkeypatch):
+    service, state = serve(monkeypatch, _ThrottleFirstState(throttle_count=2, retry_after=0.2))
+
+    embeddings = service.get_embeddings([f'text {index}' for index in range(4)])
+
+    assert all(embedding is not None for embedding in embeddings)
+    metrics = service.scheduler.metrics()
+    assert metrics['throttled'] == 2
+    assert metrics['retries'] == 2
+    # retry-after-ms の時間だけ待つ
+    assert metrics['throttle_wait_seconds'] == pytest.approx(0.4)
+    assert metrics['admission_wait_seconds'] >= 0.2
+    assert metrics['failed_batches'] == 0
+    assert state.requests == 2
+
+
+def test_partial_failure_keeps_successful_batches(serve, monkeypatch):
+    good_service, good_state = serve(monkeypatch)
+    bad_service, bad_state = serve(monkeypatch, error_rate=1.0)
+    scheduler = good_service.scheduler
+
+    def create(batch):
+        # 'bad' を含むバッチのみ、常に500を返すサーバーに送信する
+        service = bad_service if any('bad' in text for text in batch) else good_service
+        return service._create(batch)
+
+    inputs = ['ok 0', 'ok 1', 'bad 2', 'bad 3', 'ok 4']
+    with pytest.raises(EmbeddingError) as raised:
+        scheduler.embed(inputs, create)
+
+    embeddings = raised.value.embeddings
+    assert [embedding is None for embedding in embeddings] == [False, False, True, True, False]
+    assert isinstance(raised.value.cause, openai.InternalServerError)
+    # 失敗したバッチのみを上限までリトライする
+    assert bad_state.errors == scheduler.max_retries + 1
+    assert good_state.requests == 2
+    metrics = scheduler.metrics()
+    assert metrics['failed_batches'] == 1
+    assert metrics['queue_depth'] == 0
@@ -0,0 +1,93 @@
+"""BlobEventCoalescer の offer / claim / complete を、プロセス内の状態と偽のCosmosDBのコンテナーで確認する。
+"""
+from types import SimpleNamespace
+
+import pytest
+
+from fakes import FakeDatabase, StageRecorder
+from util import event_coalescer
+from util.event_coalescer import (BlobEvent, BlobEventClaimedError, BlobEventCoalescer, CosmosEventStateStore,
+                                  InMemoryEventStateStore)
+
+_URL = 'https://example.blob.core.windows.net/docs/guide.md'
+
+
+def _event(sequencer: str) -> BlobEvent:
+    return BlobEvent(url=_URL, event_type='Microsoft.Storage.BlobCreated', sequencer=sequencer)
+
+
+@pytest.fixture(params=['memory', 'cosmos'])
+def coalescer(request):
+    if request.param == 'memory':
+        store = InMemoryEventStateStore()
+    else:
+        store = CosmosEventStateStore(SimpleNamespace(database=FakeDatabase(StageRecorder())))
+    return BlobEventCoalescer(store, window_seconds=0, max_wait_seconds=60)
+
+
+def test_latest_event_is_claimed_once(coalescer):
+    first, second = _event('0001'), _event('0002')
+    assert coalescer.offer(first)
+    assert coalescer.offer(second)
+
+    # 新しいイベントに置き換えられたイベントは処理しない
+    assert coalescer.claim(first) is None
+    claimed = coalescer.claim(second)
+    assert claimed.sequencer == '0002'
+    # 同じイベントの再配信は、処理中のため破棄する
+    assert coalescer.claim(second) is None
+    assert not coalescer.offer(second)
+
+
+def test_old_and_processed_events_are_discarded(coalescer):
+    event = _event('0002')
+    coalescer.offer(event)
+    coalescer.complete(coalescer.claim(event))
+
+    assert not coalescer.offer(_event('0001'))
+    assert not coalescer.offer(event)
+    assert coalescer.claim(event) is None
+
+
+def test_newer_event_waits_while_claimed(coalescer):
+    first, second = _event('0001'), _event('0002')
+    coalescer.offer(first)
+    claimed = coalescer.claim(first)
+
+    assert coalescer.offer(second)
+    with pytest.raises(BlobEventClaimedError):
+        coalescer.claim(second)
+
+    # 完了すると claim が解除され、処理中に届いたイベントを処理できる
+    coalescer.complete(claimed)
+    assert coalescer.claim(second).sequencer == '0002'
+
+
+def test_released_event_can_be_claimed_again(coalescer):
+    event = _event('0001')
+    coalescer.offer(event)
+    coalescer.release(coalescer.claim(event))
+
+    assert coalescer.offer(event)
+    assert coalescer.claim(event).sequencer == '0001'
+
+
+def test_expired_claim_can_be_taken_over(coalescer, monkeypatch):
+    first, second = _event('0001'), _event('0002')
+    coalescer.offer(first)
+    coalescer.claim(first)
+    coalescer.offer(second)
+
+    # 処理が異常終了し、リース期間を過ぎた場合
+    monkeypatch.setattr(event_coalescer, 'EVENT_COALESCE_CLAIM_LEASE_SECONDS', 0)
+    assert coalescer.claim(second).sequencer == '0002'
+
+
+def test_events_are_claimed_after_max_wait(coalescer):
+    coalescer.max_wait_seconds = 0
+    first, second = _event('0001'), _event('0002')
+    coalescer.offer(first)
+    coalescer.offer(second)
+
+    # 更新が続いて最大の待ち時間を超えた場合は、古いイベントの呼び出しで最新の状態を処理する
+    assert coalescer.claim(first).sequencer == '0002'
@@ -0,0 +1,92 @@
+"""ChunkReconciler が、登録済みのアイテムと新しいアイテムから必要な書き込みを決めることを確認する。
+"""
+from domain.cosmos_document import CosmosDocument
+from fakes import FakeDatabase, StageRecorder
+from util.cosmos_service import FILE_CHUNK_FIELDS
+from util.ingest_util import ChunkReconciler, build_documents, build_page_documents
+from util.pdf_extractor import PdfPage
+
+_URL = 'https://example.blob.core.windows.net/docs/guide.md'
+
+
+def _existing_items(chunks: list, blob_etag: str = 'etag-1') -> list:
+    """チャンクを偽のコンテナーに登録し、CosmosService.get_items_by_file_path と同じフィールドで読み直す。
+    """
+    container = FakeDatabase(StageRecorder()).get_container_client('docs')
+    for document in build_documents(chunks, 'guide.md', _URL, blob_etag):
+        container.upsert_item(document.to_dict())
+    return [{field: item[field] for field in FILE_CHUNK_FIELDS} for item in container.items.values()]
+
+
+def test_unchanged_chunks_are_skipped():
+    reconciler = ChunkReconciler(_existing_items(['a', 'b']))
+
+    upserts, patches, moved = reconciler.plan(list(build_documents(['a', 'b'], 'guide.md', _URL, 'etag-1')))
+
+    assert (upserts, patches, moved) == ([], [], [])
+    assert reconciler.unchanged == 2
+    assert reconciler.removed_items() == []
+
+
+def test_new_etag_patches_unchanged_chunks():
+    reconciler = ChunkReconciler(_existing_items(['a', 'b']))
+
+    upserts, patches, moved = reconciler.plan(list(build_documents(['a', 'b'], 'guide.md', _URL, 'etag-2')))
+
+    assert upserts == [] and moved == []
+    assert [operations for _, operations in patches] == [
+        [{'op': 'set', 'path': '/blob_etag', 'value': 'etag-2'}]] * 2
+
+
+def test_changed_and_removed_chunks():
+    existing = _existing_items(['a', 'b', 'c'])
+    reconciler = ChunkReconciler(existing)
+
+    upserts, patches, moved = reconciler.plan(list(build_documents(['a', 'B'], 'guide.md', _URL, 'etag-2')))
+
+    assert [document.page_number for document in upserts] == [1]
+    assert len(patches) == 1 and moved == []
+    assert reconciler.upserted == 1
+    # 3番目のチャンクは新しいチャンクに含まれないため削除する
+    removed = reconciler.removed_items()
+    assert [item['id'] for item in removed] == [existing[2]['id']]
+
+
+def test_moved_chunk_copies_vector_from_previous_position():
+    existing = _existing_items(['a', 'b', 'c'])
+    reconciler = ChunkReconciler(existing)
+
+    # 先頭のチャンクを削除し、'b' と 'c' が1つずつ前にずれる
+    upserts, patches, moved = reconciler.plan(list(build_documents(['b', 'c'], 'guide.md', _URL, 'etag-1')))
+
+    assert [document.page_number for document in upserts] == [0, 1]
+    assert patches == []
+    assert [(document.page_number, source['id']) for document, source in moved] == [
+        (0, existing[1]['id']), (1, existing[2]['id'])]
+    assert [item['id'] for item in reconciler.removed_items()] == [existing[2]['id']]
+
+
+def test_moved_chunk_does_not_copy_from_overwritten_source():
+    existing = _existing_items(['a', 'b'])
+    reconciler = ChunkReconciler(existing)
+
+    # 1回目のバッチで位置0を上書きした後、2回目のバッチで位置0にあった内容が現れる
+    reconciler.plan(list(build_documents(['b'], 'guide.md', _URL, 'etag-1')))
+    second = list(build_documents(['x', 'a'], 'guide.md', _URL, 'etag-1'))[1:]
+    upserts, _, moved = reconciler.plan(second)
+
+    assert [document.page_number for document in upserts] == [1]
+    assert moved == []
+
+
+def test_split_pdf_page_chunks_have_unique_ids():
+    pages = [PdfPage(1, 'first page', False), PdfPage(2, '## Heading\n\n' + 'long text. ' * 2000, True)]
+
+    documents = list(build_page_documents(pages, 'guide.pdf', _URL, 'etag-1'))
+
+    assert len(documents) > 2
+    assert {document.page_number for document in documents} == {1, 2}
+    assert len({document.id for document in documents}) == len(documents)
+    # ページの先頭のチャンクは、分割する前と同じIDを使う
+    assert documents[0].id == CosmosDocument.chunk_id(_URL, 1)
+    assert documents[1].id == CosmosDocument.chunk_id(_URL, 2)
@@ -0,0 +1,92 @@
+"""plan_vector_updates が、変更フィードのアイテムのうち処理済みのものを除くことを確認する。
+アイテムの状態は、偽のコンテナーに対して CosmosService.get_vector_states で取得する。
+"""
+import pytest
+
+from fakes import FakeDatabase, StageRecorder
+from util.cosmos_service import CosmosService
+from util.embedding_cache import compute_content_hash
+from util.ingest_util import build_documents
+from util.vector_updater import plan_vector_updates
+
+_URL = 'https://example.blob.core.windows.net/docs/guide.md'
+
+
+@pytest.fixture
+def cosmos_service():
+    # クライアントの作成のみを省略し、CosmosService のメソッドは実際のコードを使う
+    service = CosmosService.__new__(CosmosService)
+    service.database = FakeDatabase(StageRecorder())
+    service.container = service.database.get_container_client('docs')
+    return service
+
+
+def _register(cosmos_service, chunks: list) -> list:
+    """チャンクを登録し、変更フィードのアイテムを返す。
+    """
+    for document in build_documents(chunks, 'guide.md', _URL, 'etag-1'):
+        cosmos_service.container.upsert_item(document.to_dict())
+    return cosmos_service.container.drain_changes()
+
+
+def _plan(cosmos_service, feed_docs: list):
+    states = cosmos_service.get_vector_states([doc['id'] for doc in feed_docs])
+    return plan_vector_updates(feed_docs, states)
+
+
+def test_new_items_are_pending(cosmos_service):
+    feed_docs = _register(cosmos_service, ['a', 'b'])
+
+    pending, patches, skipped = _plan(cosmos_service, feed_docs)
+
+    assert [doc['id'] for doc, _ in pending] == [doc['id'] for doc in feed_docs]
+    assert [document.content_hash for _, document in pending] == [
+        compute_content_hash(doc['content']) for doc in feed_docs]
+    assert patches == [] and skipped == 0
+
+
+def test_deleted_and_stale_revisions_are_skipped(cosmos_service):
+    feed_docs = _register(cosmos_service, ['a', 'b', 'c'])
+    deleted, updated, current = feed_docs
+    cosmos_service.container.delete_item(deleted['id'])
+    # 変更フィードの配信より後に更新されたアイテムは、新しいリビジョンの配信で処理する
+    cosmos_service.container.patch_item(updated['id'], patch_operations=[
+        {'op': 'set', 'path': '/blob_etag', 'value': 'etag-2'}])
+
+    pending, patches, skipped = _plan(cosmos_service, feed_docs)
+
+    assert [doc['id'] for doc, _ in pending] == [current['id']]
+    assert patches == []
+    assert skipped == 2
+
+
+def test_already_embedded_content_only_clears_flag(cosmos_service):
+    feed_docs = _register(cosmos_service, ['a', 'b'])
+    embedded = dict(feed_docs[0])
+    embedded['vector'] = [0.1, 0.2]
+    embedded['vector_hash'] = compute_content_hash(embedded['content'])
+    feed_docs = [cosmos_service.container.upsert_item(embedded), feed_docs[1]]
+
+    pending, patches, skipped = _plan(cosmos_service, feed_docs)
+
+    assert [doc['id'] for doc, _ in pending] == [feed_docs[1]['id']]
+    assert len(patches) == 1
+    doc, operations, condition = patches[0]
+    assert doc['id'] == embedded['id']
+    assert operations == [
+        {'op': 'set', 'path': '/vector_update_flag', 'value': False},
+        {'op': 'set', 'path': '/content_hash', 'value': embedded['vector_hash']},
+    ]
+    # パッチはアイテムの内容が変わっていない場合のみ適用する
+    assert condition == f"FROM c WHERE c.content_hash = '{doc['content_hash']}'"
+    assert skipped == 0
+
+
+def test_redelivered_revision_is_skipped_after_processing(cosmos_service):
+    feed_docs = _register(cosmos_service, ['a'])
+    cosmos_service.container.patch_item(feed_docs[0]['id'], patch_operations=[
+        {'op': 'set', 'path': '/vector_update_flag', 'value': False}])
+
+    pending, patches, skipped = _plan(cosmos_service, feed_docs)
+
+    assert (pending, patches, skipped) == ([], [], 1)
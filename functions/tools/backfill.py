@@ -0,0 +1,269 @@
+"""Embeddingモデルを変更した場合に、コンテナーのすべてのチャンクのベクトル値を作成し直すバックフィル。
+
+cosmosdb_trigger は変更フィードを呼び出しごとに処理するため、vector_update_flag を全件に立てて再ベクトル化すると時間がかかる。
+このコマンドはコンテナーを継続トークンでページごとに読み込み、複数のワーカーでまとめてベクトル化して、一括で書き込む。
+
+- ページの継続トークンと件数をチェックポイントファイルに保存し、中断した場合は同じコマンドで続きから再開する
+- --field に新しいフィールド（vector_v2 など）を指定すると、検索に使っている vector を残したまま書き込む（デュアルライト）。
+  実行前に関数アプリに VECTOR_DUAL_WRITE_FIELD と VECTOR_DUAL_WRITE_DEPLOYMENT を設定し、
+  実行中に登録、更新されたチャンクにも新しいフィールドを書き込む。切り替えの手順は cosmos/README.md を参照
+- {field}_hash が新しいデプロイでの内容のハッシュ値と同じアイテムは、処理済みとして省く。
+  失敗したアイテムは --restart で実行し直すと、処理済みのアイテムを省いて再試行できる
+- 流量は、Embeddingのクォータ（--tpm、--rpm）と、1分あたりの書き込み件数（--items-per-minute）で制限する
+
+使い方（functions ディレクトリで実行）:
+    python tools/backfill.py --deployment text-embedding-3-large --field vector_v2
+    python tools/backfill.py --deployment text-embedding-3-large --field vector_v2 --workers 8 --tpm 300000
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import openai  # noqa: E402
+
+from util import telemetry  # noqa: E402
+from util.cosmos_service import COSMOS_PARTITION_KEY_PATH, CosmosService  # noqa: E402
+from util.embedding_cache import compute_content_hash  # noqa: E402
+from util.openai_service import (AOAI_EMBEDDING_RPM, AOAI_EMBEDDING_TPM, AzureOpenAIService,  # noqa: E402
+                                 EmbeddingError, EmbeddingScheduler, TokenBucket)
+from util.vector_codec import EMBEDDING_DIMENSIONS  # noqa: E402
+from util.vector_updater import vector_field_operations  # noqa: E402
+
+
+@dataclass
+class BackfillCheckpoint:
+    """バックフィルの進捗。ページの処理が終わるたびにファイルに保存する。
+    """
+    field: str
+    deployment: str
+    dimensions: int
+    # 処理が終わったページの次のページの継続トークン。Noneの場合は先頭から
+    continuation: str = None
+    pages: int = 0
+    scanned: int = 0
+    updated: int = 0
+    skipped: int = 0
+    failed: int = 0
+    completed: bool = False
+    updated_at: str = ''
+
+    @classmethod
+    def load(cls, path: str):
+        """チェックポイントファイルを読み込む。ファイルがない場合はNone。
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as f:
+            return cls(**json.load(f))
+
+    def save(self, path: str) -> None:
+        """一時ファイルに書き込んでから置き換え、書き込み中に中断しても前回の内容が残るようにする。
+        """
+        self.updated_at = datetime.now(timezone.utc).isoformat()
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(asdict(self), f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, path)
+
+    def matches(self, other: 'BackfillCheckpoint') -> bool:
+        return (self.field, self.deployment, self.dimensions) == (other.field, other.deployment, other.dimensions)
+
+
+@dataclass
+class PageResult:
+    """1ページの処理の件数。
+    """
+    scanned: int = 0
+    updated: int = 0
+    skipped: int = 0
+    failed: int = 0
+
+
+def backfill_query(field: str) -> str:
+    """バックフィルに必要なフィールドのみを取得するクエリを返す。ベクトル値は取得しない。
+    """
+    partition_key_field = COSMOS_PARTITION_KEY_PATH.strip('/').split('/')[0]
+    fields = dict.fromkeys(['id', 'content', 'content_hash', f'{field}_hash', partition_key_field])
+    return (f"SELECT {', '.join(f'c.{name}' for name in fields)} FROM c "
+            "WHERE IS_STRING(c.content) AND LENGTH(c.content) > 0")
+
+
+class VectorBackfill:
+    """コンテナーのページを読み込みながら、ベクトル化と書き込みをワーカーのスレッドで並行に実行する。
+    """
+
+    def __init__(self, cosmos_service: CosmosService, openai_service: AzureOpenAIService,
+                 checkpoint: BackfillCheckpoint, checkpoint_path: str, workers: int = 4,
+                 items_per_minute: int = 0) -> None:
+        """
+        Args:
+            cosmos_service (CosmosService): 読み込みと書き込みに使うサービス
+            openai_service (AzureOpenAIService): 新しいデプロイのサービス
+            checkpoint (BackfillCheckpoint): 進捗。continuation から読み込みを始める
+            checkpoint_path (str): チェックポイントファイルのパス
+            workers (int, optional): ページを並行に処理するスレッド数
+            items_per_minute (int, optional): 1分あたりに書き込むアイテム数の上限。0の場合は制限しない
+        """
+        self.cosmos_service = cosmos_service
+        self.openai_service = openai_service
+        self.checkpoint = checkpoint
+        self.checkpoint_path = checkpoint_path
+        self.workers = workers
+        self.item_bucket = TokenBucket(items_per_minute)
+
+    def run(self, page_size: int = 100) -> BackfillCheckpoint:
+        """最後のページまで処理する。
+        ページは並行に処理するが、チェックポイントは読み込んだ順に処理が終わったページまで進める。
+        再開した場合に、処理が終わっていたページを読み込み直すことがあるが、{field}_hash で処理済みとして省く。
+
+        Args:
+            page_size (int, optional): 1ページあたりの最大件数
+
+        Returns:
+            BackfillCheckpoint: 最終的な進捗
+        """
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='backfill') as executor:
+            pages = self.cosmos_service.query_pages(
+                backfill_query(self.checkpoint.field), page_size=page_size,
+                continuation=self.checkpoint.continuation)
+            for page, continuation in pages:
+                in_flight.append((executor.submit(self.process_page, page), continuation))
+                # 先読みするページ数を制限し、処理が終わったページからチェックポイントを進める
+                while len(in_flight) >= self.workers * 2 or (in_flight and in_flight[0][0].done()):
+                    self._complete(*in_flight.popleft())
+            while in_flight:
+                self._complete(*in_flight.popleft())
+
+        self.checkpoint.completed = True
+        self.checkpoint.save(self.checkpoint_path)
+        return self.checkpoint
+
+    def process_page(self, page: list) -> PageResult:
+        """1ページ分のアイテムをベクトル化し、新しいフィールドに書き込む。
+
+        Args:
+            page (list): アイテムのリスト
+
+        Returns:
+            PageResult: 処理の件数
+
+        Raises:
+            EmbeddingError: 入力の内容以外の原因（レート制限、認証など）でベクトル化に失敗した場合
+        """
+        field = self.checkpoint.field
+        result = PageResult(scanned=len(page))
+        targets = []
+        for item in page:
+            vector_hash = compute_content_hash(item['content'], self.checkpoint.deployment, self.checkpoint.dimensions)
+            if item.get(f'{field}_hash') == vector_hash:
+                result.skipped += 1
+                continue
+            targets.append((item, vector_hash))
+        if not targets:
+            return result
+
+        with telemetry.span('backfill.page', {'backfill.items': len(targets)}):
+            time.sleep(self.item_bucket.reserve(len(targets)))
+            try:
+                embeddings = self.openai_service.get_embeddings([item['content'] for item, _ in targets])
+            except EmbeddingError as e:
+                # 入力の内容が原因の失敗（400）は件数に数えて続け、それ以外は中断してチェックポイントから再開する
+                if not isinstance(e.cause, openai.BadRequestError):
+                    raise e
+                embeddings = e.embeddings
+
+            patches = []
+            for (item, vector_hash), embedding in zip(targets, embeddings):
+                if embedding is None:
+                    result.failed += 1
+                    continue
+                operations = vector_field_operations(field, embedding, vector_hash)
+                if field == 'vector':
+                    # 同じフィールドを書き換える場合は、関数アプリが処理済みと判断できるよう内容のハッシュ値も更新する
+                    operations.append({'op': 'set', 'path': '/content_hash', 'value': vector_hash})
+                # 読み込んだ後に内容が更新されたアイテムは、関数アプリのデュアルライトに任せて書き込まない
+                condition = f"FROM c WHERE c.content_hash = '{item['content_hash']}'" \
+                    if item.get('content_hash') else None
+                patches.append((item, operations, condition))
+
+            for bulk_result in self.cosmos_service.patch_items(patches):
+                if not bulk_result.succeeded:
+                    result.failed += 1
+                elif bulk_result.status_code == 200:
+                    result.updated += 1
+                else:
+                    result.skipped += 1
+        return result
+
+    def _complete(self, future, continuation: str) -> None:
+        """ページの処理の結果をチェックポイントに加えて保存する。
+        """
+        result = future.result()
+        checkpoint = self.checkpoint
+        checkpoint.pages += 1
+        checkpoint.scanned += result.scanned
+        checkpoint.updated += result.updated
+        checkpoint.skipped += result.skipped
+        checkpoint.failed += result.failed
+        checkpoint.continuation = continuation
+        checkpoint.save(self.checkpoint_path)
+        logging.info(f'🚀 Backfill: {checkpoint.pages} pages, {checkpoint.scanned} scanned, '
+                     f'{checkpoint.updated} updated, {checkpoint.skipped} skipped, {checkpoint.failed} failed')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--deployment', default=os.getenv('AOAI_EMBEDDING_DEPLOYMENT'),
+                        help='新しいEmbeddingモデルのデプロイ名')
+    parser.add_argument('--dimensions', type=int, default=EMBEDDING_DIMENSIONS,
+                        help='新しいモデルの次元数（0はモデルの既定値）')
+    parser.add_argument('--field', default='vector',
+                        help='書き込むフィールド。vector 以外を指定した場合はデュアルライトになる')
+    parser.add_argument('--checkpoint', help='チェックポイントファイル（既定: backfill_<field>.json）')
+    parser.add_argument('--restart', action='store_true', help='チェックポイントを無視して先頭から処理する')
+    parser.add_argument('--page-size', type=int, default=200, help='1ページあたりの最大件数')
+    parser.add_argument('--workers', type=int, default=4, help='ページを並行に処理するスレッド数')
+    parser.add_argument('--tpm', type=int, default=AOAI_EMBEDDING_TPM, help='新しいデプロイのTPM（0は無制限）')
+    parser.add_argument('--rpm', type=int, default=AOAI_EMBEDDING_RPM, help='新しいデプロイのRPM（0は無制限）')
+    parser.add_argument('--items-per-minute', type=int, default=0,
+                        help='1分あたりに書き込むアイテム数の上限（0は無制限）。CosmosDBのRUの消費を抑える')
+    args = parser.parse_args()
+    if not args.deployment:
+        parser.error('--deployment (or AOAI_EMBEDDING_DEPLOYMENT) is required')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    checkpoint_path = args.checkpoint or f'backfill_{args.field}.json'
+    checkpoint = BackfillCheckpoint(args.field, args.deployment, args.dimensions)
+    saved = None if args.restart else BackfillCheckpoint.load(checkpoint_path)
+    if saved is not None:
+        if not saved.matches(checkpoint):
+            parser.error(f'{checkpoint_path} was created for {saved.field} / {saved.deployment} '
+                         f'(dimensions {saved.dimensions}). Use --restart or another --checkpoint')
+        if saved.completed:
+            logging.info(f'✅ Backfill already completed: {saved}')
+            return
+        logging.info(f'🚀 Resuming backfill from page {saved.pages + 1}')
+        checkpoint = saved
+
+    openai_service = AzureOpenAIService(
+        args.deployment, EmbeddingScheduler(tpm=args.tpm, rpm=args.rpm), args.dimensions)
+    backfill = VectorBackfill(CosmosService(), openai_service, checkpoint, checkpoint_path,
+                              workers=args.workers, items_per_minute=args.items_per_minute)
+    result = backfill.run(page_size=args.page_size)
+    logging.info(f'✅ Backfill completed: {result.scanned} scanned, {result.updated} updated, '
+                 f'{result.skipped} skipped, {result.failed} failed')
+    logging.info(f'🚀 Embedding scheduler metrics: {openai_service.scheduler.metrics()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+from azure.cosmos import exceptions
+from azure.cosmos.aio import CosmosClient
+import asyncio
+import os
+
+from util import telemetry
+from util.clients import HTTP_READ_TIMEOUT_SECONDS, cosmos_connection_policy
+from util.cosmos_service import (BulkResult, CosmosService, COSMOS_BULK_MAX_RETRIES,
+                                 COSMOS_DEADLETTER_CONTAINER_NAME)
+
+# 同時に実行するCosmosDBへのリクエスト数
+COSMOS_ASYNC_CONCURRENCY = int(os.getenv('COSMOS_ASYNC_CONCURRENCY', '16'))
+# 操作の種類ごとに、成功として扱うステータスコード（条件の不一致の412と、削除済みの404）
+_HANDLED_STATUS_CODES = {'patch': (404, 412), 'delete': (404,)}
+
+
+class AsyncCosmosService:
+    """CosmosServiceの非同期版。azure.cosmos.aio を使い、一括処理をセマフォで制限しながら並行に実行する。
+    """
+
+    partition_key_of = staticmethod(CosmosService.partition_key_of)
+    file_path_query = staticmethod(CosmosService.file_path_query)
+    file_path_partition_key = staticmethod(CosmosService.file_path_partition_key)
+    vector_state_query = staticmethod(CosmosService.vector_state_query)
+
+    def __init__(self, transport=None) -> None:
+        """CosmosDBの非同期クライアントを初期化する。
+
+        Args:
+            transport (AsyncHttpTransport, optional): 他のクライアントと共有するトランスポート
+        """
+        self.client = CosmosClient(
+            url=os.getenv('COSMOS_URL'),
+            credential=os.getenv('COSMOS_CREDENTIAL'),
+            connection_timeout=HTTP_READ_TIMEOUT_SECONDS,
+            connection_policy=cosmos_connection_policy(),
+            **({'transport': transport} if transport else {})
+        )
+        self.database = self.client.get_database_client(
+            os.getenv('COSMOS_DATABASE_NAME'))
+        self.container = self.database.get_container_client(
+            os.getenv('COSMOS_CONTAINER_NAME'))
+        self._semaphore = asyncio.Semaphore(COSMOS_ASYNC_CONCURRENCY)
+
+    async def get_item(self, query, parameters=None, partition_key=None) -> list:
+        """CosmosDBからアイテムを取得する。
+
+        Args:
+            query (_type_): クエリ
+            parameters (list, optional): クエリのパラメーター
+            partition_key (_type_, optional): パーティションキーの値。指定した場合は1つのパーティションのみを検索する
+
+        Returns:
+            list: CosmosDBから取得したアイテムのリスト
+        """
+        try:
+            async with self._semaphore:
+                items = self.container.query_items(
+                    query=query, parameters=parameters,
+                    **({'partition_key': partition_key} if partition_key is not None else {}))
+                return [item async for item in items]
+
+        except exceptions.CosmosHttpResponseError as e:
+            print(f'❌CosmosHttpResponseError at get_item: {e}')
+            raise e
+
+    async def read_item(self, item_id, partition_key=None) -> dict:
+        """CosmosDBからIDを指定してアイテムを取得する。
+
+        Args:
+            item_id (_type_): 取得するアイテムのID
+            partition_key (_type_, optional): パーティションキーの値。省略時はitem_id
+
+        Returns:
+            dict: CosmosDBから取得したアイテム
+        """
+        try:
+            async with self._semaphore:
+                with telemetry.span('cosmos.read') as span:
+                    charge = telemetry.RequestCharge()
+                    item = await self.container.read_item(
+                        item_id, partition_key=partition_key or item_id, response_hook=charge)
+                    span.set(telemetry.REQUEST_CHARGE, charge.total)
+                    return item
+
+        except exceptions.CosmosHttpResponseError as e:
+            print(f'❌CosmosHttpResponseError at read_item: {e}')
+            raise e
+
+    async def upsert_items(self, items: list) -> list[BulkResult]:
+        """複数のアイテムを並行に追加または更新する。
+
+        Args:
+            items (list): 追加または更新するアイテムのリスト
+
+        Returns:
+            list[BulkResult]: アイテムごとの結果
+        """
+        return await asyncio.gather(*(
+            self._execute(item['id'], 'upsert', lambda hook, item=item: self.container.upsert_item(
+                item, response_hook=hook))
+            for item in items))
+
+    async def patch_items(self, patches: list) -> list[BulkResult]:
+        """複数のアイテムの一部のフィールドを並行に更新する。
+
+        条件（filter_predicate）に一致しない場合（412）と、アイテムが削除済みの場合（404）も成功として扱う。
+
+        Args:
+            patches (list): (アイテム, パッチ操作のリスト) または (アイテム, パッチ操作のリスト, 条件) の組のリスト。
+                アイテムにはidとパーティションキーが必要。条件は 'FROM c WHERE ...' の形式
+
+        Returns:
+            list[BulkResult]: アイテムごとの結果
+        """
+        return await asyncio.gather(*(
+            self._execute(item['id'], 'patch', lambda hook, item=item, operations=operations, condition=condition:
+                          self.container.patch_item(
+                              item=item['id'], partition_key=self.partition_key_of(item),
+                              patch_operations=operations, response_hook=hook,
+                              **({'filter_predicate': condition[0]} if condition and condition[0] else {})))
+            for item, operations, *condition in patches))
+
+    async def delete_items(self, items: list) -> list[BulkResult]:
+        """複数のアイテムを並行に削除する。削除済み（404）のアイテムは成功として扱う。
+
+        Args:
+            items (list): 削除するアイテムのリスト。アイテムにはidとパーティションキーが必要
+
+        Returns:
+            list[BulkResult]: アイテムごとの結果
+        """
+        return await asyncio.gather(*(
+            self._execute(item['id'], 'delete', lambda hook, item=item: self.container.delete_item(
+                item['id'], partition_key=self.partition_key_of(item), response_hook=hook))
+            for item in items))
+
+    async def delete_by_file_path(self, file_path: str) -> list[BulkResult]:
+        """ファイルパスに一致するアイテムをすべて削除する。
+
+        Args:
+            file_path (str): 削除するファイルのBlobのURL
+
+        Returns:
+            list[BulkResult]: アイテムごとの結果
+        """
+        return await self.delete_items(await self.query_by_file_path(file_path))
+
+    async def query_by_file_path(self, file_path: str, fields=('id',)) -> list:
+        """ファイルパスに一致するアイテムの、指定したフィールドのみを取得する。
+        パーティションキーが /file_path の場合は、1つのパーティションのみを検索する。
+
+        Args:
+            file_path (str): BlobのURL
+            fields (Iterable[str], optional): 取得するフィールド。idとパーティションキーは常に取得する
+
+        Returns:
+            list: アイテムのリスト
+        """
+        return await self._query_all(
+            'query_by_file_path',
+            self.file_path_query(fields),
+            parameters=[{'name': '@file_path', 'value': file_path}],
+            partition_key=self.file_path_partition_key(file_path)
+        )
+
+    async def get_vector_states(self, item_ids: list) -> dict:
+        """アイテムのベクトル値の更新状態を取得する。ベクトル値と本文は取得しない。
+
+        Args:
+            item_ids (list): アイテムのIDのリスト
+
+        Returns:
+            dict: アイテムのIDと状態（id, _etag, content_hash, vector_hash, vector_update_flag）の辞書
+        """
+        if not item_ids:
+            return {}
+        items = await self._query_all(
+            'get_vector_states',
+            self.vector_state_query(),
+            parameters=[{'name': '@ids', 'value': list(item_ids)}]
+        )
+        return {item['id']: item for item in items}
+
+    async def upsert_dead_letters(self, records: list) -> None:
+        """ベクトル化に繰り返し失敗したアイテムの記録を、デッドレターのコンテナーに登録する。
+
+        Args:
+            records (list): 記録のリスト（idは元のアイテムのID）
+        """
+        container = self.database.get_container_client(COSMOS_DEADLETTER_CONTAINER_NAME)
+        results = await asyncio.gather(*(
+            self._execute(record['id'], 'upsert', lambda hook, record=record: container.upsert_item(
+                record, response_hook=hook))
+            for record in records))
+        errors = [result.error for result in results if not result.succeeded]
+        if errors:
+            raise errors[0]
+
+    async def _query_all(self, operation: str, query, parameters=None, partition_key=None) -> list:
+        """CosmosService._query_all の非同期版。
+        並行に実行するリクエストとレスポンスヘッダーを共有するため、RUは近似値になる。
+        """
+        with telemetry.span('cosmos.query', {'cosmos.operation': operation}) as span:
+            items = await self.get_item(query, parameters, partition_key)
+            charge = telemetry.RequestCharge()
+            charge.add_headers(self.container.client_connection.last_response_headers)
+            span.set(telemetry.REQUEST_CHARGE, charge.total)
+            span.set('cosmos.item_count', len(items))
+            return items
+
+    async def _execute(self, item_id: str, kind: str, operation) -> BulkResult:
+        """1件の操作をセマフォの範囲内で実行し、429の場合はサーバーが指定した時間待ってリトライする。
+
+        Args:
+            item_id (str): アイテムのID
+            kind (str): 操作の種類（upsert / patch / delete）。スパンの名前に使う
+            operation (Callable[[RequestCharge], Awaitable]): RUを合計する response_hook を受け取り、操作を実行する関数
+        """
+        for attempt in range(COSMOS_BULK_MAX_RETRIES + 1):
+            try:
+                async with self._semaphore:
+                    with telemetry.span(f'cosmos.{kind}') as span:
+                        charge = telemetry.RequestCharge()
+                        try:
+                            await operation(charge)
+                        finally:
+                            span.set(telemetry.REQUEST_CHARGE, charge.total)
+                return BulkResult(item_id, 200)
+            except exceptions.CosmosHttpResponseError as e:
+                # CosmosService._execute_single と同じく、削除済み（404）と条件の不一致（412）は操作の種類に応じて成功として扱う
+                if e.status_code in _HANDLED_STATUS_CODES.get(kind, ()):
+                    return BulkResult(item_id, e.status_code)
+                if e.status_code != 429 or attempt == COSMOS_BULK_MAX_RETRIES:
+                    print(f'❌CosmosHttpResponseError at bulk operation: {e}')
+                    return BulkResult(item_id, e.status_code, e)
+                headers = getattr(e, 'headers', None) or {}
+                await asyncio.sleep(float(headers.get('x-ms-retry-after-ms', '1000')) / 1000)
+
+    async def close(self) -> None:
+        """クライアントの接続を閉じる。
+        """
+        await self.client.close()
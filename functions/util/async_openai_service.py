@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import os
+
+import openai
+from openai import AsyncAzureOpenAI
+
+from util import telemetry
+from util.clients import create_async_http_client
+from util.openai_service import EmbeddingError, EmbeddingScheduler, embedding_scheduler, pack_batches
+from util.vector_codec import embedding_options
+
+# 同時に実行するEmbeddingリクエスト数
+AOAI_ASYNC_CONCURRENCY = int(os.getenv('AOAI_ASYNC_CONCURRENCY', '4'))
+
+
+class AsyncAzureOpenAIService:
+    """AzureOpenAIServiceの非同期版。分割したEmbeddingリクエストをセマフォで制限しながら並行に実行する。
+    TPMとRPMの制限とリトライは、同期版と共有する EmbeddingScheduler で行う。
+    """
+
+    def __init__(self, deployment: str = None, scheduler: EmbeddingScheduler = None,
+                 dimensions: int = None) -> None:
+        """引数は AzureOpenAIService と同じ。
+        """
+        self.deployment = deployment or os.getenv("AOAI_EMBEDDING_DEPLOYMENT")
+        self.embedding_options = embedding_options(dimensions)
+        self.client = AsyncAzureOpenAI(
+            azure_endpoint=os.getenv("AOAI_ENDPOINT"),
+            api_version=os.getenv("AOAI_API_VERSION"),
+            api_key=os.getenv("AOAI_API_KEY"),
+            # リトライは EmbeddingScheduler で行うため、SDKのリトライは無効にする
+            max_retries=0,
+            http_client=create_async_http_client()
+        )
+        self.scheduler = scheduler or embedding_scheduler
+        self._semaphore = asyncio.Semaphore(AOAI_ASYNC_CONCURRENCY)
+
+    async def get_embeddings(self, inputs: list[str]) -> list:
+        """複数の文字列のベクトル値をまとめて取得する。
+
+        Args:
+            inputs (list[str]): ベクトル化する文字列のリスト
+
+        Returns:
+            list[array]: 入力と同じ順序のベクトル値（float32の配列）のリスト
+
+        Raises:
+            EmbeddingError: リトライしても失敗したバッチがある場合。成功したバッチのベクトル値を保持する
+        """
+        batches = list(pack_batches(inputs))
+        self.scheduler.add_queue_depth(len(batches))
+        results = await asyncio.gather(
+            *(self._embed_batch(batch, tokens) for batch, tokens in batches),
+            return_exceptions=True)
+        logging.info(f'🚀 Embedding scheduler metrics: {self.scheduler.metrics()}')
+
+        embeddings = []
+        error = None
+        for (batch, _), result in zip(batches, results):
+            if isinstance(result, Exception):
+                error = result
+                embeddings.extend([None] * len(batch))
+            else:
+                embeddings.extend(result)
+        if error is not None:
+            logging.error(f'❌Error at get_embeddings: {error}')
+            raise EmbeddingError(embeddings, error)
+        return embeddings
+
+    async def _embed_batch(self, batch: list[str], tokens: int) -> list:
+        """1リクエスト分の文字列をベクトル化する。失敗した場合はこのバッチのみをリトライする。
+        """
+        try:
+            attempt = 0
+            while True:
+                await asyncio.sleep(self.scheduler.admit(tokens))
+                try:
+                    async with self._semaphore:
+                        with telemetry.span('openai.embeddings', {'openai.inputs': len(batch)}) as span:
+                            response = await self.client.embeddings.create(
+                                input=batch,
+                                model=self.deployment,
+                                **self.embedding_options
+                            )
+                            for key, value in telemetry.token_usage(response).items():
+                                span.set(key, value)
+                    return self.scheduler.complete(response, batch, tokens)
+                except Exception as e:
+                    delay = self.scheduler.retry_delay(e, attempt)
+                    if delay is None:
+                        raise e
+                    # 429の場合はスケジューラーが以降の予約を待たせるため、ここでは待たない
+                    if not isinstance(e, openai.RateLimitError):
+                        await asyncio.sleep(delay)
+                    attempt += 1
+        finally:
+            self.scheduler.add_queue_depth(-1)
+
+    async def close(self) -> None:
+        """クライアントの接続を閉じる。
+        """
+        await self.client.close()
@@ -0,0 +1,91 @@
+import codecs
+import os
+import tempfile
+import time
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator
+
+from util import telemetry
+
+# Blobを分割してダウンロードする際の1回あたりのサイズ（バイト）
+BLOB_STREAM_CHUNK_SIZE = int(os.getenv('BLOB_STREAM_CHUNK_SIZE', str(4 * 1024 * 1024)))
+
+
+def iter_text(chunks: Iterable[bytes], encoding: str = 'utf-8-sig') -> Iterator[str]:
+    """バイト列の断片を逐次デコードして文字列の断片を返す。
+    マルチバイト文字が断片の境界で分かれても正しくデコードできる。
+
+    Args:
+        chunks (Iterable[bytes]): バイト列の断片（StorageStreamDownloader.chunks() など）
+        encoding (str): 文字コード。既定ではBOMを取り除く
+
+    Yields:
+        str: 文字列の断片
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    # デコードにかかった時間のみを合計する（ダウンロードと後続の処理の時間は含めない）
+    elapsed = 0.0
+    for chunk in chunks:
+        started = time.perf_counter()
+        text = decoder.decode(chunk)
+        elapsed += time.perf_counter() - started
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    telemetry.record_stage('blob.decode', elapsed)
+    if text:
+        yield text
+
+
+async def aiter_text(chunks: AsyncIterable[bytes], encoding: str = 'utf-8-sig') -> AsyncIterator[str]:
+    """iter_text の非同期版。
+
+    Args:
+        chunks (AsyncIterable[bytes]): バイト列の断片（aio の StorageStreamDownloader.chunks() など）
+        encoding (str): 文字コード。既定ではBOMを取り除く
+
+    Yields:
+        str: 文字列の断片
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    elapsed = 0.0
+    async for chunk in chunks:
+        started = time.perf_counter()
+        text = decoder.decode(chunk)
+        elapsed += time.perf_counter() - started
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    telemetry.record_stage('blob.decode', elapsed)
+    if text:
+        yield text
+
+
+def download_to_tempfile(blob_data, suffix: str = '') -> str:
+    """ダウンロード中のBlobを一時ファイルに書き出す。ファイル全体をメモリに保持しない。
+    PDFのようにランダムアクセスが必要なファイルに使う。呼び出し側で削除すること。
+
+    Args:
+        blob_data (StorageStreamDownloader): ダウンロード中のBlob
+        suffix (str): 一時ファイルの拡張子
+
+    Returns:
+        str: 一時ファイルのパス
+    """
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+        blob_data.readinto(f)
+    return f.name
+
+
+async def adownload_to_tempfile(blob_data, suffix: str = '') -> str:
+    """download_to_tempfile の非同期版。
+
+    Args:
+        blob_data (StorageStreamDownloader): aio のダウンロード中のBlob
+        suffix (str): 一時ファイルの拡張子
+
+    Returns:
+        str: 一時ファイルのパス
+    """
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+        await blob_data.readinto(f)
+    return f.name
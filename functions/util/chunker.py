@@ -0,0 +1,254 @@
+import os
+import re
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator
+
+from util.token_counter import count_tokens, split_by_tokens
+
+# チャンクの最大トークン数と、前のチャンクと重複させるトークン数
+CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', '800'))
+CHUNK_OVERLAP = int(os.getenv('CHUNK_OVERLAP', '100'))
+
+# 見出しの位置でチャンクを区切る場合の、チャンクの最小トークン数の割合
+_MIN_CHUNK_RATIO = 0.5
+# 作成中のブロックと改行で終わっていない行を保持する最大文字数（チャンクの最大トークン数に対する倍率）。
+# 空行や改行のない長い文字列でも、超えた分はチャンクに追加してメモリの使用量を抑える
+_MAX_BUFFER_CHARS_PER_TOKEN = 4
+
+_HEADING_PATTERN = re.compile(r'^#{1,6}\s')
+_FENCE_PATTERN = re.compile(r'^(```|~~~)')
+_SENTENCE_PATTERN = re.compile(r'[^。．！？!?\n]*(?:[。．！？!?]+|\n|$)')
+
+
+class MarkdownChunker:
+    """MarkdownやテキストをRAG用のチャンクに分割する。
+    見出し、段落、トークン数の順に区切り位置を選び、前のチャンクの末尾を重複させる。
+    文字列の断片を feed で順に渡すと、確定したチャンクから返すため、保持するのは作成中のチャンクのみとなる。
+    空行や改行がなくても、ブロックと行はチャンクの最大トークン数に応じた文字数で区切るため、保持する量は入力の大きさによらない。
+    """
+
+    def __init__(self, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP) -> None:
+        """
+        Args:
+            chunk_size (int): チャンクの最大トークン数
+            chunk_overlap (int): 前のチャンクと重複させる最大トークン数
+        """
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self._max_buffer_chars = max(1, chunk_size * _MAX_BUFFER_CHARS_PER_TOKEN)
+        # 改行で終わっていない行の断片
+        self._rest = []
+        self._rest_chars = 0
+        # 改行で終わっていない行の先頭を、上限を超えたためチャンクに追加済みかどうか
+        self._line_continued = False
+        # 作成中のブロックの行
+        self._block = []
+        self._block_chars = 0
+        self._is_heading = False
+        self._in_fence = False
+        # 上限を超えて途中で確定したブロックの続きの場合の、前のユニットとの区切り文字
+        self._continued_sep = None
+        # 作成中のチャンクの (文字列, トークン数, 前のユニットとの区切り文字) の組
+        self._units: list[tuple[str, int, str]] = []
+        self._tokens = 0
+
+    def feed(self, text: str) -> Iterator[str]:
+        """文字列の断片を追加し、確定したチャンクを返す。
+
+        Args:
+            text (str): 文字列の断片
+
+        Yields:
+            str: チャンクの文字列
+        """
+        lines = text.split('\n')
+        tail = lines.pop()
+        if lines:
+            self._rest.append(lines[0])
+            lines[0] = ''.join(self._rest)
+            self._rest = []
+            self._rest_chars = 0
+            for line in lines:
+                yield from self._feed_line(line)
+        if tail:
+            self._rest.append(tail)
+            self._rest_chars += len(tail)
+            if self._rest_chars > self._max_buffer_chars:
+                yield from self._flush_rest()
+
+    def close(self) -> Iterator[str]:
+        """残りの文字列からチャンクを作成して返す。
+
+        Yields:
+            str: チャンクの文字列
+        """
+        if self._rest:
+            yield from self._feed_line(''.join(self._rest))
+            self._rest = []
+            self._rest_chars = 0
+        self._line_continued = False
+        yield from self._end_block()
+        yield from self._flush(with_overlap=False)
+
+    def _flush_rest(self) -> Iterator[str]:
+        """改行で終わっていない行が上限を超えた場合に、ここまでの文字列をブロックとしてチャンクに追加する。
+        行の続きは、区切り文字なしで連結する。
+        """
+        partial = ''.join(self._rest)
+        self._rest = []
+        self._rest_chars = 0
+        if self._line_continued:
+            self._append_line(partial)
+        else:
+            yield from self._feed_line(partial)
+        self._line_continued = True
+        yield from self._end_block(continued_sep='')
+
+    def _feed_line(self, line: str) -> Iterator[str]:
+        """行をMarkdownのブロック（見出し、段落、コードブロック）にまとめる。
+        """
+        if self._line_continued:
+            # 先頭をチャンクに追加済みの行の続き
+            self._line_continued = False
+            if line:
+                self._append_line(line)
+            else:
+                self._continued_sep = '\n'
+        elif self._in_fence:
+            self._append_line(line)
+            if _FENCE_PATTERN.match(line):
+                self._in_fence = False
+        elif _FENCE_PATTERN.match(line):
+            self._in_fence = True
+            self._append_line(line)
+        elif _HEADING_PATTERN.match(line):
+            # 見出しは次のブロックの先頭にする
+            yield from self._end_block()
+            self._append_line(line)
+            self._is_heading = True
+        elif not line.strip():
+            # 空行で段落を区切る
+            yield from self._end_block()
+        else:
+            self._append_line(line)
+
+        # 空行などで区切られないブロックは、上限を超えたら行の区切りで確定する
+        if self._block_chars > self._max_buffer_chars:
+            yield from self._end_block(continued_sep='\n')
+
+    def _append_line(self, line: str) -> None:
+        self._block.append(line)
+        self._block_chars += len(line) + 1
+
+    def _end_block(self, continued_sep: str = None) -> Iterator[str]:
+        """作成中のブロックを確定し、チャンクに追加する。
+
+        Args:
+            continued_sep (str, optional): ブロックの途中で確定する場合の、続きとの区切り文字
+        """
+        if self._block:
+            sep = '\n\n' if self._continued_sep is None else self._continued_sep
+            yield from self._add_block('\n'.join(self._block), self._is_heading, sep)
+            self._continued_sep = continued_sep
+        elif continued_sep is None:
+            self._continued_sep = None
+        self._block = []
+        self._block_chars = 0
+        self._is_heading = False
+
+    def _add_block(self, block: str, is_heading: bool, sep: str = '\n\n') -> Iterator[str]:
+        """ブロックをチャンクに追加し、上限を超えたらチャンクを確定する。
+        """
+        # 見出しで始まるブロックは、作成中のチャンクが十分大きければ新しいチャンクにする
+        if is_heading and self._tokens >= self.chunk_size * _MIN_CHUNK_RATIO:
+            yield from self._flush(with_overlap=False)
+
+        block_tokens = count_tokens(block)
+        if block_tokens > self.chunk_size:
+            # 同じブロック内の文は区切り文字なしで連結する
+            pieces = [(piece, count_tokens(piece), sep if i == 0 else '')
+                      for i, piece in enumerate(_split_large_block(block, self.chunk_size))]
+        else:
+            pieces = [(block, block_tokens, sep)]
+
+        for piece, piece_tokens, sep in pieces:
+            if self._units and self._tokens + piece_tokens > self.chunk_size:
+                yield from self._flush(with_overlap=True)
+                # 重複分と合わせて上限を超える場合は重複分を捨てる
+                if self._tokens + piece_tokens > self.chunk_size:
+                    self._units = []
+                    self._tokens = 0
+            self._units.append((piece, piece_tokens, sep))
+            self._tokens += piece_tokens
+
+    def _flush(self, with_overlap: bool) -> Iterator[str]:
+        """作成中のチャンクを確定し、必要に応じて末尾を次のチャンクに引き継ぐ。
+        """
+        units = self._units
+        if not units:
+            return
+        chunk = units[0][0] + ''.join(sep + text for text, _, sep in units[1:])
+        if chunk.strip():
+            yield chunk.strip()
+
+        # 末尾のユニットを重複分として次のチャンクに引き継ぐ
+        carried = []
+        carried_tokens = 0
+        if with_overlap:
+            for unit in reversed(units):
+                unit_tokens = unit[1]
+                if carried_tokens + unit_tokens > self.chunk_overlap:
+                    break
+                carried.insert(0, unit)
+                carried_tokens += unit_tokens
+        self._units = carried
+        self._tokens = carried_tokens
+
+
+def _split_large_block(block: str, chunk_size: int) -> Iterator[str]:
+    """チャンクの上限を超えるブロックを文単位、トークン単位に分割する。
+    """
+    for sentence in _SENTENCE_PATTERN.findall(block):
+        if not sentence:
+            continue
+        if count_tokens(sentence) > chunk_size:
+            yield from split_by_tokens(sentence, chunk_size)
+        else:
+            yield sentence
+
+
+def chunk_markdown(texts: Iterable[str], chunk_size: int = CHUNK_SIZE,
+                   chunk_overlap: int = CHUNK_OVERLAP) -> Iterator[str]:
+    """文字列の断片をMarkdownChunkerでチャンクに分割するジェネレーター。
+
+    Args:
+        texts (Iterable[str]): 文字列の断片。ファイル全体を1つの文字列で渡してもよい
+        chunk_size (int): チャンクの最大トークン数
+        chunk_overlap (int): 前のチャンクと重複させる最大トークン数
+
+    Yields:
+        str: チャンクの文字列
+    """
+    chunker = MarkdownChunker(chunk_size, chunk_overlap)
+    for text in texts:
+        yield from chunker.feed(text)
+    yield from chunker.close()
+
+
+async def achunk_markdown(texts: AsyncIterable[str], chunk_size: int = CHUNK_SIZE,
+                          chunk_overlap: int = CHUNK_OVERLAP) -> AsyncIterator[str]:
+    """chunk_markdown の非同期版。非同期に受け取る文字列の断片をチャンクに分割する。
+
+    Args:
+        texts (AsyncIterable[str]): 文字列の断片
+        chunk_size (int): チャンクの最大トークン数
+        chunk_overlap (int): 前のチャンクと重複させる最大トークン数
+
+    Yields:
+        str: チャンクの文字列
+    """
+    chunker = MarkdownChunker(chunk_size, chunk_overlap)
+    async for text in texts:
+        for chunk in chunker.feed(text):
+            yield chunk
+    for chunk in chunker.close():
+        yield chunk
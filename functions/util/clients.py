@@ -0,0 +1,175 @@
+"""プロセス内で共有するクライアントとサービスを、初回の呼び出し時に作成する。
+
+モジュールの読み込み時にはクライアントを作成せず、重いライブラリも読み込まないため、コールドスタートが短くなる。
+HTTPの接続プールはサービス間で共有し、keep-aliveで接続を使い回してTLSハンドシェイクの回数を減らす。
+"""
+import os
+import threading
+from functools import wraps
+
+# 接続プールの最大接続数と、keep-aliveで保持する接続数、保持する時間（秒）
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv('HTTP_POOL_MAX_CONNECTIONS', '100'))
+HTTP_POOL_MAX_KEEPALIVE = int(os.getenv('HTTP_POOL_MAX_KEEPALIVE', '20'))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv('HTTP_KEEPALIVE_SECONDS', '60'))
+# 接続と読み取りのタイムアウト（秒）
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv('HTTP_CONNECT_TIMEOUT_SECONDS', '5'))
+HTTP_READ_TIMEOUT_SECONDS = float(os.getenv('HTTP_READ_TIMEOUT_SECONDS', '60'))
+# requestsの接続プールを保持するホスト数（CosmosDB、Blob、Queueなど）
+_POOL_HOSTS = 10
+
+
+def lazy_singleton(factory):
+    """引数のない関数を、初回の呼び出し時に1回だけ実行し、以降は同じ値を返すようにする。
+    トリガーは複数のスレッドから同時に呼び出されるため、作成はロックで1回に制限する。
+    """
+    lock = threading.Lock()
+    instance = []
+
+    @wraps(factory)
+    def get():
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
+    return get
+
+
+@lazy_singleton
+def get_http_client():
+    """OpenAIの同期クライアントで共有する、接続プールを設定したhttpxのクライアント。
+    """
+    import httpx
+    return httpx.Client(limits=_httpx_limits(httpx), timeout=_httpx_timeout(httpx))
+
+
+def create_async_http_client():
+    """OpenAIの非同期クライアントが使う、接続プールを設定したhttpxのクライアント。
+    非同期のクライアントはイベントループに紐づくため、イベントループ上で作成する。
+    """
+    import httpx
+    return httpx.AsyncClient(limits=_httpx_limits(httpx), timeout=_httpx_timeout(httpx))
+
+
+def _httpx_limits(httpx):
+    return httpx.Limits(
+        max_connections=HTTP_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_SECONDS)
+
+
+def _httpx_timeout(httpx):
+    return httpx.Timeout(HTTP_READ_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS)
+
+
+@lazy_singleton
+def get_azure_transport():
+    """CosmosDBとBlob Storageの同期クライアントで共有する、接続プールを設定したトランスポート。
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from azure.core.pipeline.transport import RequestsTransport
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=_POOL_HOSTS, pool_maxsize=HTTP_POOL_MAX_CONNECTIONS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    # セッションは複数のクライアントで共有するため、クライアントを閉じてもセッションは閉じない
+    return RequestsTransport(session=session, session_owner=False)
+
+
+def create_async_azure_transport():
+    """CosmosDBとBlob Storageの非同期クライアントで共有する、接続プールを設定したトランスポート。
+    イベントループ上で作成する。
+    """
+    import aiohttp
+    from azure.core.pipeline.transport import AioHttpTransport
+
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+        limit=HTTP_POOL_MAX_CONNECTIONS, keepalive_timeout=HTTP_KEEPALIVE_SECONDS))
+    return AioHttpTransport(session=session, session_owner=False)
+
+
+def azure_client_options(transport) -> dict:
+    """Azure SDKのクライアントに渡す、トランスポートとタイムアウトの引数を返す。
+    """
+    return {
+        'transport': transport,
+        'connection_timeout': HTTP_CONNECT_TIMEOUT_SECONDS,
+        'read_timeout': HTTP_READ_TIMEOUT_SECONDS,
+    }
+
+
+def cosmos_connection_policy():
+    """CosmosDBのクライアントに渡す、SDKによる429（Too Many Requests）のリトライを無効にした接続ポリシー。
+    429はサービス側の _with_retry と _execute でリトライするため、SDKのリトライ（既定で9回）と重ねない。
+    retry_throttle_total=0 は既定値として扱われるため、リトライの設定を直接指定する。
+    クライアントの作成時に設定が書き換えられるため、クライアントごとに作成する。
+    """
+    from azure.cosmos.documents import ConnectionPolicy, RetryOptions
+
+    policy = ConnectionPolicy()
+    policy.RetryOptions = RetryOptions(max_retry_attempt_count=0)
+    return policy
+
+
+@lazy_singleton
+def get_cosmos_service():
+    from util.cosmos_service import CosmosService
+    return CosmosService()
+
+
+@lazy_singleton
+def get_openai_service():
+    from util.openai_service import AzureOpenAIService
+    return AzureOpenAIService()
+
+
+@lazy_singleton
+def get_dual_write_openai_service():
+    """デュアルライト先のデプロイのサービス。VECTOR_DUAL_WRITE_FIELD が空の場合はNone。
+    デプロイのクォータは別のため、流量の制限は既定のデプロイと共有しない。
+    """
+    from util.openai_service import AzureOpenAIService, EmbeddingScheduler
+    from util.vector_updater import (VECTOR_DUAL_WRITE_DEPLOYMENT, VECTOR_DUAL_WRITE_DIMENSIONS,
+                                     VECTOR_DUAL_WRITE_FIELD)
+    if not VECTOR_DUAL_WRITE_FIELD:
+        return None
+    return AzureOpenAIService(
+        VECTOR_DUAL_WRITE_DEPLOYMENT, EmbeddingScheduler(), VECTOR_DUAL_WRITE_DIMENSIONS)
+
+
+@lazy_singleton
+def get_blob_service_client():
+    """1回のリクエストでダウンロードするサイズを制限し、ファイルサイズによらずメモリ使用量を抑える。
+    """
+    from azure.storage.blob import BlobServiceClient
+    from util.blob_stream import BLOB_STREAM_CHUNK_SIZE
+    return BlobServiceClient.from_connection_string(
+        os.getenv('BLOB_CONNECTION'),
+        max_single_get_size=BLOB_STREAM_CHUNK_SIZE,
+        max_chunk_get_size=BLOB_STREAM_CHUNK_SIZE,
+        **azure_client_options(get_azure_transport()))
+
+
+@lazy_singleton
+def get_embedding_cache():
+    from util.embedding_cache import EMBEDDING_CACHE_BACKEND, create_embedding_cache
+    return create_embedding_cache(
+        get_cosmos_service() if EMBEDDING_CACHE_BACKEND == 'cosmos' else None)
+
+
+@lazy_singleton
+def get_event_coalescer():
+    """同じBlobに対する連続したイベントを、最新の状態1件にまとめる。off の場合はNone。
+    """
+    from util.event_coalescer import EVENT_COALESCE_MODE, create_event_coalescer
+    return create_event_coalescer(
+        get_cosmos_service() if EVENT_COALESCE_MODE == 'queue' else None)
+
+
+@lazy_singleton
+def get_event_queue():
+    from util.event_coalescer import BlobEventQueue
+    return BlobEventQueue(
+        os.getenv('BLOB_CONNECTION'), **azure_client_options(get_azure_transport()))
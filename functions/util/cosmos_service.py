@@ -1,39 +1,88 @@
 from azure.cosmos import CosmosClient, exceptions
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import groupby
+import json
+import logging
 import os
+import time
+
+from util import telemetry
+from util.clients import HTTP_READ_TIMEOUT_SECONDS, cosmos_connection_policy, get_azure_transport
+
+# コンテナーのパーティションキーのパス
+COSMOS_PARTITION_KEY_PATH = os.getenv('COSMOS_PARTITION_KEY_PATH', '/id')
+# 一括処理の並列数と、429（Too Many Requests）の最大リトライ回数
+COSMOS_BULK_MAX_WORKERS = int(os.getenv('COSMOS_BULK_MAX_WORKERS', '8'))
+COSMOS_BULK_MAX_RETRIES = int(os.getenv('COSMOS_BULK_MAX_RETRIES', '5'))
+# ベクトル化に繰り返し失敗したアイテムを記録するコンテナー（パーティションキーは /id）
+COSMOS_DEADLETTER_CONTAINER_NAME = os.getenv(
+    'COSMOS_DEADLETTER_CONTAINER_NAME', 'deadletter')
+# ファイルパスで検索する場合に取得するフィールド
+FILE_CHUNK_FIELDS = ('id', 'file_name', 'file_path', 'content_hash', 'blob_etag')
+# トランザクションバッチ1回あたりの最大操作数（CosmosDBの上限）
+_TRANSACTIONAL_BATCH_MAX_OPERATIONS = 100
+# トランザクションバッチ1回あたりの操作の合計サイズ（CosmosDBの上限の2MBに対して余裕を持たせる）
+_TRANSACTIONAL_BATCH_MAX_BYTES = 1_800_000
+
+
+@dataclass
+class BulkResult:
+    """一括処理のアイテムごとの結果。
+    """
+    id: str
+    status_code: int
+    error: Exception = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
 
 
 class CosmosService:
 
     def __init__(self) -> None:
-        """CosmosDBのクライアントを初期化する。
+        """CosmosDBのクライアントを初期化する。接続プールは他のクライアントと共有する。
         """
         self.client = CosmosClient(
             url=os.getenv('COSMOS_URL'),
-            credential=os.getenv('COSMOS_CREDENTIAL')
+            credential=os.getenv('COSMOS_CREDENTIAL'),
+            transport=get_azure_transport(),
+            connection_timeout=HTTP_READ_TIMEOUT_SECONDS,
+            connection_policy=cosmos_connection_policy()
         )
         self.database = self.client.get_database_client(
             os.getenv('COSMOS_DATABASE_NAME'))
         self.container = self.database.get_container_client(
             os.getenv('COSMOS_CONTAINER_NAME'))
 
-    def get_item(self, query) -> dict:
+    def get_item(self, query, parameters=None, partition_key=None) -> dict:
         """CosmosDBからアイテムを取得する。
 
         Args:
             query (_type_): クエリ
+            parameters (list, optional): クエリのパラメーター
+            partition_key (_type_, optional): パーティションキーの値。指定した場合は1つのパーティションのみを検索する
 
         Returns:
             dict: CosmosDBから取得したアイテム
         """
         try:
-            print('🚀Querying CosmosDB.')
-            print(f'🚀query: {query}')
+            # クエリの文字列は本文を含む場合があるため、DEBUGの場合のみ出力する
+            logging.debug(f'🚀Querying CosmosDB: {query}')
 
-            items = self.container.query_items(
-                query=query,
-                enable_cross_partition_query=True
-                
-            )
+            if partition_key is not None:
+                items = self.container.query_items(
+                    query=query,
+                    parameters=parameters,
+                    partition_key=partition_key
+                )
+            else:
+                items = self.container.query_items(
+                    query=query,
+                    parameters=parameters,
+                    enable_cross_partition_query=True
+                )
 
             return items
 
@@ -45,6 +94,56 @@ class CosmosService:
             print(f'❌Error at get_item: {e}')
             raise e
 
+    def read_item(self, item_id, partition_key=None) -> dict:
+        """CosmosDBからIDを指定してアイテムを取得する。
+
+        Args:
+            item_id (_type_): 取得するアイテムのID
+            partition_key (_type_, optional): パーティションキーの値。省略時はitem_id
+
+        Returns:
+            dict: CosmosDBから取得したアイテム
+        """
+        try:
+            logging.debug('🚀Reading CosmosDB.')
+            with telemetry.span('cosmos.read') as span:
+                charge = telemetry.RequestCharge()
+                item = self.container.read_item(
+                    item_id, partition_key=partition_key or item_id, response_hook=charge)
+                span.set(telemetry.REQUEST_CHARGE, charge.total)
+                return item
+
+        except exceptions.CosmosHttpResponseError as e:
+            print(f'❌CosmosHttpResponseError at read_item: {e}')
+            raise e
+
+        except Exception as e:
+            print(f'❌Error at read_item: {e}')
+            raise e
+
+    def patch_item(self, item_id, operations: list, partition_key=None) -> None:
+        """CosmosDBのアイテムの一部のフィールドを更新する。
+
+        Args:
+            item_id (_type_): 更新するアイテムのID
+            operations (list): パッチ操作のリスト（例: [{'op': 'set', 'path': '/blob_etag', 'value': '0x...'}]）
+            partition_key (_type_, optional): パーティションキーの値。省略時はitem_id
+        """
+        try:
+            logging.debug('🚀Patching CosmosDB.')
+            self.container.patch_item(
+                item=item_id, partition_key=partition_key or item_id,
+                patch_operations=operations)
+            logging.debug('🚀Patched CosmosDB.')
+
+        except exceptions.CosmosHttpResponseError as e:
+            print(f'❌CosmosHttpResponseError at patch_item: {e}')
+            raise e
+
+        except Exception as e:
+            print(f'❌Error at patch_item: {e}')
+            raise e
+
     def upsert_item(self, item) -> None:
         """CosmosDBにアイテムを追加または更新する。
 
@@ -52,9 +151,9 @@ class CosmosService:
             item (_type_): 追加または更新するアイテム
         """
         try:
-            print('🚀Upserting CosmosDB.')
+            logging.debug('🚀Upserting CosmosDB.')
             self.container.upsert_item(item)
-            print('🚀Upserted CosmosDB.')
+            logging.debug('🚀Upserted CosmosDB.')
 
         except exceptions.CosmosHttpResponseError as e:
             print(f'❌CosmosHttpResponseError at upsert_item: {e}')
@@ -64,16 +163,18 @@ class CosmosService:
             print(f'❌Error at upsert_item: {e}')
             raise
 
-    def delete_item(self, item_id) -> None:
+    def delete_item(self, item_id, partition_key=None) -> None:
         """CosmosDBからアイテムを削除する。
 
         Args:
             item_id (_type_): 削除するアイテムのID
+            partition_key (_type_, optional): パーティションキーの値。省略時はitem_id
         """
         try:
-            print('🚀Deleting CosmosDB.')
-            self.container.delete_item(item_id, partition_key=item_id)
-            print('🚀Deleted CosmosDB.')
+            logging.debug('🚀Deleting CosmosDB.')
+            self.container.delete_item(
+                item_id, partition_key=partition_key or item_id)
+            logging.debug('🚀Deleted CosmosDB.')
 
         except exceptions.CosmosHttpResponseError as e:
             print(f'❌CosmosHttpResponseError at delete_data: {e}')
@@ -83,6 +184,333 @@ class CosmosService:
             print(f'❌Error at delete_data: {e}')
             raise e
 
+    @staticmethod
+    def partition_key_of(item: dict):
+        """アイテムからパーティションキーの値を取得する。
+
+        Args:
+            item (dict): アイテム
+
+        Returns:
+            _type_: パーティションキーの値
+        """
+        value = item
+        for key in COSMOS_PARTITION_KEY_PATH.strip('/').split('/'):
+            value = value[key]
+        return value
+
+    def upsert_items(self, items: list) -> list[BulkResult]:
+        """複数のアイテムをまとめて追加または更新する。
+
+        Args:
+            items (list): 追加または更新するアイテムのリスト
+
+        Returns:
+            list[BulkResult]: アイテムごとの結果
+        """
+        operations = [(self.partition_key_of(item), item['id'], ('upsert', (item,)))
+                      for item in items]
+        return self._execute_bulk(operations)
+
+    def patch_items(self, patches: list) -> list[BulkResult]:
+        """複数のアイテムの一部のフィールドをまとめて更新する。
+        条件（filter_predicate）に一致しない場合（412）と、アイテムが削除済みの場合（404）も成功として扱う。
+
+        Args:
+            patches (list): (アイテム, パッチ操作のリスト) または (アイテム, パッチ操作のリスト, 条件) の組のリスト。
+                アイテムにはidとパーティションキーが必要。条件は 'FROM c WHERE ...' の形式
+
+        Returns:
+            list[BulkResult]: アイテムごとの結果
+        """
+        operations = []
+        for item, patch_operations, *condition in patches:
+            operation = ('patch', (item['id'], patch_operations))
+            if condition and condition[0]:
+                operation += ({'filter_predicate': condition[0]},)
+            operations.append((self.partition_key_of(item), item['id'], operation))
+        return self._execute_bulk(operations)
+
+    def delete_items(self, items: list) -> list[BulkResult]:
+        """複数のアイテムをまとめて削除する。削除済み（404）のアイテムは成功として扱う。
+
+        Args:
+            items (list): 削除するアイテムのリスト。アイテムにはidとパーティションキーが必要
+
+        Returns:
+            list[BulkResult]: アイテムごとの結果
+        """
+        operations = [(self.partition_key_of(item), item['id'], ('delete', (item['id'],)))
+                      for item in items]
+        return self._execute_bulk(operations)
+
+    def delete_by_file_path(self, file_path: str) -> list[BulkResult]:
+        """ファイルパスに一致するアイテムをすべて削除する。
+
+        Args:
+            file_path (str): 削除するファイルのBlobのURL
+
+        Returns:
+            list[BulkResult]: アイテムごとの結果
+        """
+        return self.delete_items(self.query_by_file_path(file_path))
+
+    def query_by_file_path(self, file_path: str, fields=('id',)) -> list:
+        """ファイルパスに一致するアイテムの、指定したフィールドのみを取得する。
+        パーティションキーが /file_path の場合は、1つのパーティションのみを検索する。
+
+        Args:
+            file_path (str): BlobのURL
+            fields (Iterable[str], optional): 取得するフィールド。idとパーティションキーは常に取得する
+
+        Returns:
+            list: アイテムのリスト
+        """
+        return self._query_all(
+            'query_by_file_path',
+            self.file_path_query(fields),
+            parameters=[{'name': '@file_path', 'value': file_path}],
+            partition_key=self.file_path_partition_key(file_path)
+        )
+
+    def get_vector_states(self, item_ids: list) -> dict:
+        """アイテムのベクトル値の更新状態を取得する。ベクトル値と本文は取得しない。
+
+        Args:
+            item_ids (list): アイテムのIDのリスト
+
+        Returns:
+            dict: アイテムのIDと状態（id, _etag, content_hash, vector_hash, vector_update_flag）の辞書
+        """
+        if not item_ids:
+            return {}
+        items = self._query_all(
+            'get_vector_states',
+            self.vector_state_query(),
+            parameters=[{'name': '@ids', 'value': list(item_ids)}]
+        )
+        return {item['id']: item for item in items}
+
+    @staticmethod
+    def vector_state_query() -> str:
+        """IDに一致するアイテムの、ベクトル値の更新状態のみを取得するクエリを返す。
+        """
+        return ("SELECT c.id, c._etag, c.content_hash, c.vector_hash, c.vector_update_flag "
+                "FROM c WHERE ARRAY_CONTAINS(@ids, c.id)")
+
+    def upsert_dead_letters(self, records: list) -> None:
+        """ベクトル化に繰り返し失敗したアイテムの記録を、デッドレターのコンテナーに登録する。
+
+        Args:
+            records (list): 記録のリスト（idは元のアイテムのID）
+        """
+        container = self.database.get_container_client(COSMOS_DEADLETTER_CONTAINER_NAME)
+        for record in records:
+            try:
+                self._with_retry(lambda: container.upsert_item(record))
+            except exceptions.CosmosHttpResponseError as e:
+                print(f'❌CosmosHttpResponseError at upsert_dead_letters: {e}')
+                raise e
+
+    @staticmethod
+    def file_path_query(fields=('id',)) -> str:
+        """ファイルパスに一致するアイテムの、指定したフィールドとパーティションキーのみを取得するクエリを返す。
+        ファイルパスはパラメーター @file_path で渡す。
+        """
+        partition_key_field = COSMOS_PARTITION_KEY_PATH.strip('/').split('/')[0]
+        fields = list(dict.fromkeys(['id', *fields, partition_key_field]))
+        return f"SELECT {', '.join(f'c.{field}' for field in fields)} FROM c WHERE c.file_path = @file_path"
+
+    @staticmethod
+    def file_path_partition_key(file_path: str):
+        """パーティションキーが /file_path の場合は、ファイルパスを検索するパーティションキーとして返す。
+        それ以外の場合はNone（すべてのパーティションを検索する）。
+        """
+        return file_path if COSMOS_PARTITION_KEY_PATH == '/file_path' else None
+
+    def query_pages(self, query, parameters=None, page_size: int = 100, continuation: str = None):
+        """クエリの結果をページごとに取得する。中断した位置から再開できるよう、ページごとに継続トークンを返す。
+
+        Args:
+            query (_type_): クエリ
+            parameters (list, optional): クエリのパラメーター
+            page_size (int, optional): 1ページあたりの最大件数
+            continuation (str, optional): 前回の取得で返された継続トークン。省略時は先頭から取得する
+
+        Yields:
+            tuple[list, str]: ページのアイテムのリストと、次のページの継続トークン（最後のページではNone）
+        """
+        try:
+            pages = self.container.query_items(
+                query=query,
+                parameters=parameters,
+                enable_cross_partition_query=True,
+                max_item_count=page_size
+            ).by_page(continuation)
+            while True:
+                with telemetry.span('cosmos.query', {'cosmos.operation': 'query_pages'}) as span:
+                    try:
+                        page = list(next(pages))
+                    except StopIteration:
+                        return
+                    charge = telemetry.RequestCharge()
+                    charge.add_headers(self.container.client_connection.last_response_headers)
+                    span.set(telemetry.REQUEST_CHARGE, charge.total)
+                    span.set('cosmos.item_count', len(page))
+                yield page, pages.continuation_token
+
+        except exceptions.CosmosHttpResponseError as e:
+            print(f'❌CosmosHttpResponseError at query_pages: {e}')
+            raise e
+
+    def _query_all(self, operation: str, query, parameters=None, partition_key=None) -> list:
+        """クエリの結果をすべて取得し、ページごとのRUの合計と件数をスパンに記録する。
+
+        Args:
+            operation (str): スパンに記録する操作の名前
+            query (_type_): クエリ
+            parameters (list, optional): クエリのパラメーター
+            partition_key (_type_, optional): パーティションキーの値
+
+        Returns:
+            list: アイテムのリスト
+        """
+        with telemetry.span('cosmos.query', {'cosmos.operation': operation}) as span:
+            charge = telemetry.RequestCharge()
+            items = []
+            for page in self.get_item(query, parameters, partition_key).by_page():
+                items.extend(page)
+                charge.add_headers(self.container.client_connection.last_response_headers)
+            span.set(telemetry.REQUEST_CHARGE, charge.total)
+            span.set('cosmos.item_count', len(items))
+            return items
+
+    def _execute_bulk(self, operations: list) -> list[BulkResult]:
+        """操作をパーティションキーごとにまとめて、並列に実行する。
+        同じパーティションキーの操作が複数ある場合はトランザクションバッチで実行する。
+
+        Args:
+            operations (list): (パーティションキー, アイテムID, (操作の種類, 引数)) の組のリスト
+
+        Returns:
+            list[BulkResult]: アイテムごとの結果（入力と同じ順序）
+        """
+        if not operations:
+            return []
+
+        # パーティションキーごとに、トランザクションバッチの上限（操作数とサイズ）で分割する
+        groups = []
+        keyed = sorted(enumerate(operations), key=lambda o: str(o[1][0]))
+        for _, group in groupby(keyed, key=lambda o: str(o[1][0])):
+            groups.extend(self._split_batches(list(group)))
+
+        results = [None] * len(operations)
+        with ThreadPoolExecutor(max_workers=COSMOS_BULK_MAX_WORKERS) as executor:
+            for group_results in executor.map(self._execute_group, groups):
+                for index, result in group_results:
+                    results[index] = result
+
+        failed = [result for result in results if not result.succeeded]
+        logging.debug(f'🚀Bulk operations: {len(results) - len(failed)} succeeded, {len(failed)} failed')
+        return results
+
+    @staticmethod
+    def _split_batches(group: list) -> list:
+        """同じパーティションキーの操作を、トランザクションバッチの操作数とサイズの上限で分割する。
+        """
+        batches, batch, batch_bytes = [], [], 0
+        for entry in group:
+            _, (_, _, operation) = entry
+            size = len(json.dumps(operation[1], ensure_ascii=False, default=str).encode('utf-8'))
+            if batch and (len(batch) >= _TRANSACTIONAL_BATCH_MAX_OPERATIONS
+                          or batch_bytes + size > _TRANSACTIONAL_BATCH_MAX_BYTES):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(entry)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _execute_group(self, group: list) -> list:
+        """同じパーティションキーの操作を実行する。
+        バッチが失敗した場合は、404（削除済み）などを個別に判定できるよう1件ずつ実行し直す。
+        """
+        partition_key = group[0][1][0]
+        # 条件付きの操作は1件の不一致でバッチ全体が失敗するため、1件ずつ実行する
+        if len(group) == 1 or any(len(operation) > 2 for _, (_, _, operation) in group):
+            return [self._execute_one(index, item_id, operation, partition_key)
+                    for index, (_, item_id, operation) in group]
+
+        try:
+            batch_operations = [operation for _, (_, _, operation) in group]
+            with telemetry.span('cosmos.batch', {'cosmos.operation_count': len(group)}) as span:
+                charge = telemetry.RequestCharge()
+                responses = self._with_retry(lambda: self.container.execute_item_batch(
+                    batch_operations=batch_operations, partition_key=partition_key, response_hook=charge))
+                span.set(telemetry.REQUEST_CHARGE, charge.total)
+            return [(index, BulkResult(item_id, response.get('statusCode', 200)))
+                    for (index, (_, item_id, _)), response in zip(group, responses)]
+
+        except (exceptions.CosmosHttpResponseError, exceptions.CosmosBatchOperationError) as e:
+            print(f'❌CosmosHttpResponseError at bulk operation. Retrying one by one: {e}')
+            return [self._execute_one(index, item_id, operation, partition_key)
+                    for index, (_, item_id, operation) in group]
+
+    def _execute_one(self, index: int, item_id: str, operation: tuple, partition_key) -> tuple:
+        """1件の操作をリトライ付きで実行し、(入力の位置, 結果) の組を返す。
+        """
+        try:
+            status_code = self._with_retry(
+                lambda: self._execute_single(operation, partition_key))
+            return index, BulkResult(item_id, status_code)
+        except exceptions.CosmosHttpResponseError as e:
+            print(f'❌CosmosHttpResponseError at bulk operation: {e}')
+            return index, BulkResult(item_id, e.status_code, e)
+
+    def _execute_single(self, operation: tuple, partition_key) -> int:
+        """1件の操作を実行し、ステータスコードを返す。
+        """
+        kind, args, *options = operation
+        with telemetry.span(f'cosmos.{kind}') as span:
+            charge = telemetry.RequestCharge()
+            try:
+                if kind == 'upsert':
+                    self.container.upsert_item(*args, response_hook=charge)
+                elif kind == 'patch':
+                    try:
+                        self.container.patch_item(
+                            item=args[0], partition_key=partition_key, patch_operations=args[1],
+                            response_hook=charge, **(options[0] if options else {}))
+                    except exceptions.CosmosAccessConditionFailedError:
+                        # 条件に一致しない（アイテムが更新済み）
+                        return 412
+                    except exceptions.CosmosResourceNotFoundError:
+                        # アイテムが削除済み
+                        return 404
+                elif kind == 'delete':
+                    try:
+                        self.container.delete_item(args[0], partition_key=partition_key, response_hook=charge)
+                    except exceptions.CosmosResourceNotFoundError:
+                        return 404
+                return 200
+            finally:
+                span.set(telemetry.REQUEST_CHARGE, charge.total)
+
+    @staticmethod
+    def _with_retry(func):
+        """429（Too Many Requests）の場合に、サーバーが指定した時間待ってからリトライする。
+        """
+        for attempt in range(COSMOS_BULK_MAX_RETRIES + 1):
+            try:
+                return func()
+            except exceptions.CosmosHttpResponseError as e:
+                if e.status_code != 429 or attempt == COSMOS_BULK_MAX_RETRIES:
+                    raise
+                headers = getattr(e, 'headers', None) or {}
+                retry_after_ms = headers.get('x-ms-retry-after-ms', '1000')
+                time.sleep(float(retry_after_ms) / 1000)
+
     def get_items_by_vector(self, embedding, VECTOR_SCORE_THRESHOLD) -> list:
         """ベクトル検索でCosmosDBからアイテムを取得する。
 
@@ -94,8 +522,7 @@ class CosmosService:
             list: CosmosDBから取得したアイテムのリスト
         """
         try:
-            print('🚀Querying CosmosDB.')
-            print(f'🚀vectorScore: {VECTOR_SCORE_THRESHOLD}')
+            logging.debug(f'🚀vectorScore: {VECTOR_SCORE_THRESHOLD}')
 
             query = f"""SELECT TOP 10 c.file_name, c.content, c.is_contain_image, 
             VectorDistance(c.vector, @embedding) AS SimilarityScore 
@@ -106,16 +533,12 @@ class CosmosService:
                 {'name': '@embedding', 'value': embedding}
             ]
 
-            items = self.container.query_items(
-                query=query,
-                parameters=parameters,
-                enable_cross_partition_query=True
-            )
-
-            resources = [item for item in items]
-            for item in resources:
-                print(
-                    f'🚀{item["file_name"]}, {item["content"]}, {item["SimilarityScore"]} is a capitol \n')
+            resources = self._query_all('vector_search', query, parameters)
+            # 検索結果の本文は大きいため、DEBUGの場合のみ出力する
+            if telemetry.content_logging_enabled():
+                for item in resources:
+                    logging.debug(
+                        f'🚀{item["file_name"]}, {item["content"]}, {item["SimilarityScore"]} is a capitol \n')
 
             return resources
 
@@ -0,0 +1,197 @@
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+from azure.cosmos import exceptions
+
+from util.vector_codec import embedding_model_key, encode_vector, to_float32
+
+# キャッシュの種類: none / lru / sqlite / cosmos
+EMBEDDING_CACHE_BACKEND = os.getenv('EMBEDDING_CACHE_BACKEND', 'lru')
+EMBEDDING_CACHE_MAX_ENTRIES = int(
+    os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', '10000'))
+EMBEDDING_CACHE_SQLITE_PATH = os.getenv(
+    'EMBEDDING_CACHE_SQLITE_PATH', '/tmp/embedding_cache.sqlite3')
+COSMOS_EMBEDDING_CACHE_CONTAINER_NAME = os.getenv(
+    'COSMOS_EMBEDDING_CACHE_CONTAINER_NAME', 'embedding-cache')
+
+_TRAILING_SPACE_PATTERN = re.compile(r'[ \t　]+$', re.MULTILINE)
+
+
+def normalize_text(text: str) -> str:
+    """ハッシュ計算用に文字列を正規化する。
+    Unicodeの正規化と、改行コードや行末の空白の違いを吸収する。
+
+    Args:
+        text (str): 正規化する文字列
+
+    Returns:
+        str: 正規化した文字列
+    """
+    text = unicodedata.normalize('NFC', text)
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    text = _TRAILING_SPACE_PATTERN.sub('', text)
+    return text.strip()
+
+
+def compute_content_hash(text: str, deployment: str = None, dimensions: int = None) -> str:
+    """Embeddingモデルのデプロイ名と次元数、正規化したチャンクの内容からハッシュ値を計算する。
+
+    Args:
+        text (str): チャンクの内容
+        deployment (str, optional): Embeddingモデルのデプロイ名。省略時は環境変数の値
+        dimensions (int, optional): 次元数。省略時は EMBEDDING_DIMENSIONS
+
+    Returns:
+        str: SHA-256のハッシュ値（16進数）
+    """
+    if deployment is None:
+        deployment = os.getenv('AOAI_EMBEDDING_DEPLOYMENT', '')
+    key = embedding_model_key(deployment, dimensions) + '\n' + normalize_text(text)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """ハッシュ値をキーにベクトル値を保持するキャッシュの基底クラス。
+    何も保持しないため、キャッシュを無効にする場合にそのまま使う。
+    """
+
+    def get_many(self, content_hashes: list[str]) -> dict:
+        """ハッシュ値に対応するベクトル値を取得する。
+
+        Args:
+            content_hashes (list[str]): ハッシュ値のリスト
+
+        Returns:
+            dict: キャッシュに存在したハッシュ値とベクトル値の辞書
+        """
+        return {}
+
+    def set_many(self, embeddings: dict) -> None:
+        """ハッシュ値とベクトル値をキャッシュに登録する。
+
+        Args:
+            embeddings (dict): ハッシュ値とベクトル値の辞書
+        """
+        pass
+
+
+class LruEmbeddingCache(EmbeddingCache):
+    """プロセス内に保持するLRUキャッシュ。ベクトル値はfloat32の配列で保持する。
+    """
+
+    def __init__(self, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES) -> None:
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, content_hashes: list[str]) -> dict:
+        found = {}
+        with self._lock:
+            for content_hash in content_hashes:
+                if content_hash in self._entries:
+                    self._entries.move_to_end(content_hash)
+                    found[content_hash] = self._entries[content_hash]
+        return found
+
+    def set_many(self, embeddings: dict) -> None:
+        with self._lock:
+            for content_hash, vector in embeddings.items():
+                self._entries[content_hash] = to_float32(vector)
+                self._entries.move_to_end(content_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SqliteEmbeddingCache(EmbeddingCache):
+    """ローカルのSQLiteファイルに保持するキャッシュ。ベクトル値はfloat32のバイト列で保存する。
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_SQLITE_PATH) -> None:
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS embedding_cache '
+            '(content_hash TEXT PRIMARY KEY, vector BLOB NOT NULL)')
+        self._conn.commit()
+
+    def get_many(self, content_hashes: list[str]) -> dict:
+        found = {}
+        if not content_hashes:
+            return found
+        with self._lock:
+            # SQLiteのパラメーター数の上限を超えないように分割して問い合わせる
+            for start in range(0, len(content_hashes), 500):
+                keys = content_hashes[start:start + 500]
+                placeholders = ','.join('?' * len(keys))
+                rows = self._conn.execute(
+                    'SELECT content_hash, vector FROM embedding_cache '
+                    f'WHERE content_hash IN ({placeholders})', keys)
+                for content_hash, blob in rows:
+                    found[content_hash] = array('f', blob)
+        return found
+
+    def set_many(self, embeddings: dict) -> None:
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO embedding_cache (content_hash, vector) VALUES (?, ?)',
+                [(content_hash, array('f', vector).tobytes())
+                 for content_hash, vector in embeddings.items()])
+            self._conn.commit()
+
+
+class CosmosEmbeddingCache(EmbeddingCache):
+    """CosmosDBのコンテナーに保持するキャッシュ。関数のインスタンス間で共有できる。
+    コンテナーのパーティションキーは /id とする。
+    """
+
+    def __init__(self, container) -> None:
+        self.container = container
+
+    def get_many(self, content_hashes: list[str]) -> dict:
+        found = {}
+        if not content_hashes:
+            return found
+        items = self.container.query_items(
+            query='SELECT c.id, c.vector FROM c WHERE ARRAY_CONTAINS(@ids, c.id)',
+            parameters=[{'name': '@ids', 'value': list(content_hashes)}],
+            enable_cross_partition_query=True
+        )
+        for item in items:
+            found[item['id']] = item['vector']
+        return found
+
+    def set_many(self, embeddings: dict) -> None:
+        for content_hash, vector in embeddings.items():
+            try:
+                self.container.upsert_item(
+                    {'id': content_hash, 'vector': encode_vector(vector)})
+            except exceptions.CosmosHttpResponseError as e:
+                # キャッシュの書き込み失敗でベクトル更新を止めない
+                logging.warning(f'❌Error at CosmosEmbeddingCache.set_many: {e}')
+
+
+def create_embedding_cache(cosmos_service=None) -> EmbeddingCache:
+    """環境変数 EMBEDDING_CACHE_BACKEND に応じたキャッシュを作成する。
+
+    Args:
+        cosmos_service (CosmosService, optional): cosmos を指定する場合に使うCosmosServiceのインスタンス
+
+    Returns:
+        EmbeddingCache: キャッシュ
+    """
+    if EMBEDDING_CACHE_BACKEND == 'lru':
+        return LruEmbeddingCache()
+    if EMBEDDING_CACHE_BACKEND == 'sqlite':
+        return SqliteEmbeddingCache()
+    if EMBEDDING_CACHE_BACKEND == 'cosmos':
+        return CosmosEmbeddingCache(
+            cosmos_service.database.get_container_client(
+                COSMOS_EMBEDDING_CACHE_CONTAINER_NAME))
+    return EmbeddingCache()
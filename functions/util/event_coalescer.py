@@ -0,0 +1,301 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass
+
+from azure.core import MatchConditions
+from azure.cosmos import exceptions
+
+# イベントの集約方法: off（集約しない）/ local（プロセス内で待つ）/ queue（Storageキューで遅延させる）
+# local は状態をプロセス内に保持し、待ち時間の間ワーカーのスレッドを占有するため、1インスタンスでの実行とローカルの開発用
+EVENT_COALESCE_MODE = os.getenv('EVENT_COALESCE_MODE', 'off')
+# 同じBlobのイベントを待つ時間（秒）。この間に届いた新しいイベントで古いイベントを置き換える
+EVENT_COALESCE_WINDOW_SECONDS = float(os.getenv('EVENT_COALESCE_WINDOW_SECONDS', '3'))
+# 更新が続く場合に、最初のイベントから処理を始めるまでの最大の待ち時間（秒）
+EVENT_COALESCE_MAX_WAIT_SECONDS = float(os.getenv('EVENT_COALESCE_MAX_WAIT_SECONDS', '60'))
+# claim したイベントを他の呼び出しが処理しない時間（秒）。処理が異常終了した場合は、この時間の後に再配信で処理し直す
+EVENT_COALESCE_CLAIM_LEASE_SECONDS = float(os.getenv('EVENT_COALESCE_CLAIM_LEASE_SECONDS', '600'))
+# queue の場合の、イベントを遅延させるStorageキューと、Blobごとの状態を保持するコンテナー
+EVENT_QUEUE_NAME = os.getenv('EVENT_QUEUE_NAME', 'blob-events')
+COSMOS_EVENT_STATE_CONTAINER_NAME = os.getenv('COSMOS_EVENT_STATE_CONTAINER_NAME', 'blob-events')
+# 状態の更新が競合した場合の最大リトライ回数
+_MAX_UPDATE_ATTEMPTS = 10
+# claim の返り値として、他の呼び出しが処理中であることを表す値
+_CLAIMED = object()
+
+
+@dataclass
+class BlobEvent:
+    """EventGridのBlobイベントのうち、集約に使う値。
+    """
+    url: str
+    event_type: str
+    # Blobごとのイベントの順序を表す文字列。文字列として比較する
+    sequencer: str = ''
+    etag: str = ''
+
+    @staticmethod
+    def from_event_grid(event_type: str, data: dict) -> 'BlobEvent':
+        """EventGridのイベントから作成する。
+
+        Args:
+            event_type (str): イベントの種類
+            data (dict): イベントのdata
+
+        Returns:
+            BlobEvent: Blobイベント
+        """
+        return BlobEvent(
+            url=data.get('url'),
+            event_type=event_type,
+            sequencer=data.get('sequencer', ''),
+            etag=data.get('eTag', ''))
+
+    @staticmethod
+    def from_dict(data: dict) -> 'BlobEvent':
+        return BlobEvent(**{key: data.get(key, '') for key in ('url', 'event_type', 'sequencer', 'etag')})
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def _sequence_key(sequencer: str) -> tuple:
+    """sequencerを比較するためのキー。桁数が異なる場合に備えて、長さを先に比較する。
+    """
+    return len(sequencer or ''), sequencer or ''
+
+
+def _is_claimed(state: dict, sequencer: str = None) -> bool:
+    """Blobのイベントを、他の呼び出しがリース期間内に claim 済みかどうか。
+
+    Args:
+        state (dict): Blobの状態
+        sequencer (str, optional): 指定した場合は、このsequencerのイベントを claim 済みかどうか
+    """
+    claimed = state.get('claimed_sequencer')
+    if not claimed or (sequencer is not None and claimed != sequencer):
+        return False
+    return time.time() - (state.get('claimed_at') or 0) < EVENT_COALESCE_CLAIM_LEASE_SECONDS
+
+
+class BlobEventClaimedError(Exception):
+    """同じBlobのイベントを他の呼び出しが処理中のため、claim できない。
+    処理が終わった後に、最新の状態を処理し直す必要がある。
+    """
+
+
+class InMemoryEventStateStore:
+    """Blobごとの状態をプロセス内に保持する。1インスタンスで動かす場合とローカル実行用。
+    """
+
+    def __init__(self) -> None:
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def update(self, url: str, func):
+        """Blobの状態を読み取り、func の返り値で更新する。
+
+        Args:
+            url (str): BlobのURL
+            func (Callable[[dict | None], tuple[dict | None, Any]]): 現在の状態を受け取り、
+                (新しい状態, 返り値) を返す関数。新しい状態がNoneの場合は更新しない
+
+        Returns:
+            Any: func の返り値
+        """
+        with self._lock:
+            state, result = func(dict(self._states[url]) if url in self._states else None)
+            if state is not None:
+                self._states[url] = state
+            return result
+
+
+class CosmosEventStateStore:
+    """Blobごとの状態をCosmosDBのコンテナー（パーティションキーは /id）に保持する。
+    複数のインスタンスで同時に更新されるため、ETagで楽観的に排他制御する。
+    """
+
+    def __init__(self, cosmos_service) -> None:
+        self.container = cosmos_service.database.get_container_client(
+            COSMOS_EVENT_STATE_CONTAINER_NAME)
+
+    def update(self, url: str, func):
+        """InMemoryEventStateStore.update と同じ。競合した場合は読み直してリトライする。
+        """
+        item_id = str(uuid.uuid5(uuid.NAMESPACE_URL, url))
+        for _ in range(_MAX_UPDATE_ATTEMPTS):
+            try:
+                current = self.container.read_item(item_id, partition_key=item_id)
+            except exceptions.CosmosResourceNotFoundError:
+                current = None
+
+            state, result = func(current)
+            if state is None:
+                return result
+            state['id'] = item_id
+            try:
+                if current is None:
+                    self.container.create_item(state)
+                else:
+                    self.container.replace_item(
+                        item_id, state, etag=current['_etag'],
+                        match_condition=MatchConditions.IfNotModified)
+                return result
+            except (exceptions.CosmosResourceExistsError, exceptions.CosmosAccessConditionFailedError):
+                # 他のインスタンスが先に更新したため、読み直す
+                continue
+        raise RuntimeError(f'Failed to update event state: {url}')
+
+
+class BlobEventCoalescer:
+    """同じBlobに対する連続したイベントを、最新の状態1件にまとめる。
+
+    - sequencer が処理済みまたは受付済みのものより古いイベントは破棄する
+    - 受け付けたイベントは待ち時間の後に claim し、その間により新しいイベントが届いていれば破棄する
+    - claim したsequencerは状態に記録し、処理が終わるまで同じBlobの他のイベントを claim させない
+    - 更新が続いて最大の待ち時間を超えた場合は、その時点の最新の状態を処理する
+    """
+
+    def __init__(self, store, window_seconds: float = EVENT_COALESCE_WINDOW_SECONDS,
+                 max_wait_seconds: float = EVENT_COALESCE_MAX_WAIT_SECONDS) -> None:
+        self.store = store
+        self.window_seconds = window_seconds
+        self.max_wait_seconds = max_wait_seconds
+
+    def offer(self, event: BlobEvent) -> bool:
+        """イベントを受け付ける。
+
+        Args:
+            event (BlobEvent): Blobイベント
+
+        Returns:
+            bool: 受け付けた場合はTrue。古いイベントや処理済み、処理中のイベントの場合はFalse
+        """
+        def func(state):
+            if state is not None:
+                processed = _sequence_key(state.get('processed_sequencer'))
+                latest = _sequence_key(state.get('sequencer'))
+                if _sequence_key(event.sequencer) <= processed or _sequence_key(event.sequencer) < latest:
+                    return None, False
+                # 受付済みのイベントの再配信は、状態を変えずに受け付ける。処理中の場合は破棄する
+                if _sequence_key(event.sequencer) == latest:
+                    return None, not _is_claimed(state, event.sequencer)
+            pending_since = (state or {}).get('pending_since') or time.time()
+            return {
+                **(state or {}),
+                **event.to_dict(),
+                'pending_since': pending_since,
+                'processed_sequencer': (state or {}).get('processed_sequencer', ''),
+            }, True
+
+        return self.store.update(event.url, func)
+
+    def claim(self, event: BlobEvent):
+        """待ち時間の後に、イベントを処理するかどうかを決める。
+        処理する場合は、claim したことを状態に記録する（CosmosDBの場合はETagで排他制御する）。
+
+        Args:
+            event (BlobEvent): offer で受け付けたイベント
+
+        Returns:
+            BlobEvent | None: 処理する最新のイベント。新しいイベントに置き換えられた場合や処理済みの場合はNone
+
+        Raises:
+            BlobEventClaimedError: 同じBlobの別のイベントを他の呼び出しが処理中の場合
+        """
+        def func(state):
+            if state is None or _sequence_key(event.sequencer) <= _sequence_key(state.get('processed_sequencer')):
+                return None, None
+            # 更新が続く場合は、最大の待ち時間を超えたら最新の状態を処理する
+            if (state.get('sequencer') != event.sequencer
+                    and time.time() - (state.get('pending_since') or 0) < self.max_wait_seconds):
+                return None, None
+            # 同じイベントの再配信や古いイベントを、他の呼び出しが処理中の場合
+            if _is_claimed(state, state.get('sequencer')):
+                return None, None
+            if _is_claimed(state):
+                return None, _CLAIMED
+            return {**state, 'claimed_sequencer': state.get('sequencer'), 'claimed_at': time.time()}, \
+                BlobEvent.from_dict(state)
+
+        result = self.store.update(event.url, func)
+        if result is _CLAIMED:
+            raise BlobEventClaimedError(f'Blob event is being processed: {event.url}')
+        return result
+
+    def complete(self, event: BlobEvent) -> None:
+        """イベントの処理が完了したことを記録し、claim を解除する。以降、同じか古いイベントは破棄する。
+
+        Args:
+            event (BlobEvent): claim が返したイベント
+        """
+        def func(state):
+            state = state or event.to_dict()
+            released = state.get('claimed_sequencer') == event.sequencer
+            if released:
+                state['claimed_sequencer'] = ''
+                state['claimed_at'] = None
+            if _sequence_key(event.sequencer) <= _sequence_key(state.get('processed_sequencer')):
+                return (state if released else None), None
+            state['processed_sequencer'] = event.sequencer
+            # 処理中に新しいイベントが届いた場合は、その待ち時間を計り直す
+            state['pending_since'] = None if state.get('sequencer') == event.sequencer else time.time()
+            return state, None
+
+        self.store.update(event.url, func)
+
+    def release(self, event: BlobEvent) -> None:
+        """処理に失敗したイベントの claim を取り消し、再配信されたイベントで処理し直せるようにする。
+
+        Args:
+            event (BlobEvent): claim が返したイベント
+        """
+        def func(state):
+            if state is None or state.get('claimed_sequencer') != event.sequencer:
+                return None, None
+            return {**state, 'claimed_sequencer': '', 'claimed_at': None}, None
+
+        self.store.update(event.url, func)
+
+
+class BlobEventQueue:
+    """受け付けたイベントを、待ち時間だけ遅延させてStorageキューに送信する。
+    キュートリガーは既定でBase64のメッセージを受け取るため、Base64でエンコードする。
+    """
+
+    def __init__(self, connection_string: str, queue_name: str = EVENT_QUEUE_NAME, **kwargs) -> None:
+        """
+        Args:
+            connection_string (str): Storageアカウントの接続文字列
+            queue_name (str, optional): キューの名前
+            **kwargs: QueueClient に渡す追加の引数（トランスポートなど）
+        """
+        from azure.storage.queue import QueueClient, TextBase64EncodePolicy
+        self.client = QueueClient.from_connection_string(
+            connection_string, queue_name, message_encode_policy=TextBase64EncodePolicy(), **kwargs)
+
+    def send(self, event: BlobEvent, delay_seconds: float = EVENT_COALESCE_WINDOW_SECONDS) -> None:
+        self.client.send_message(
+            json.dumps(event.to_dict(), ensure_ascii=False),
+            visibility_timeout=max(0, int(round(delay_seconds))))
+        logging.info(f'🚀 Queued blob event: {event.url} ({event.sequencer})')
+
+
+def create_event_coalescer(cosmos_service=None):
+    """EVENT_COALESCE_MODE に応じたイベントの集約を作成する。
+
+    Args:
+        cosmos_service (CosmosService, optional): queue の場合に状態を保持するCosmosDBのサービス
+
+    Returns:
+        BlobEventCoalescer | None: off の場合はNone
+    """
+    if EVENT_COALESCE_MODE == 'off':
+        return None
+    if EVENT_COALESCE_MODE == 'queue':
+        # キュートリガーは複数のインスタンスで実行されるため、状態をCosmosDBで共有する
+        return BlobEventCoalescer(CosmosEventStateStore(cosmos_service))
+    return BlobEventCoalescer(InMemoryEventStateStore())
@@ -0,0 +1,223 @@
+from domain.cosmos_document import CosmosDocument
+from util.chunker import chunk_markdown
+from util.embedding_cache import compute_content_hash
+from util.keyword_extractor import extract_keywords
+
+
+def build_document(chunk: str, page_number: int, file_name: str, blob_url: str,
+                   blob_etag: str, is_contain_image: bool = False, chunk_index: int = 0) -> CosmosDocument:
+    """チャンクからCosmosDBに登録するアイテムを作成する。
+
+    Args:
+        chunk (str): チャンクの文字列
+        page_number (int): ページ番号（チャンク番号）
+        file_name (str): ファイル名
+        blob_url (str): BlobのURL
+        blob_etag (str): BlobのETag
+        is_contain_image (bool, optional): ページに画像が含まれるかどうか
+        chunk_index (int, optional): ページ内のチャンク番号
+
+    Returns:
+        CosmosDocument: CosmosDBに登録するアイテム
+    """
+    # ファイル名をタイトルとして、チャンクをMarkdown形式にする
+    chunk_content = '# ' + file_name + '\n\n' + chunk
+
+    return CosmosDocument(
+        id=CosmosDocument.chunk_id(blob_url, page_number, chunk_index),
+        file_name=file_name,
+        file_path=blob_url,
+        page_number=page_number,
+        content=chunk_content,
+        vector=[],
+        keywords=extract_keywords(chunk),
+        delete_flag=False,
+        vector_update_flag=True,
+        content_hash=compute_content_hash(chunk_content),
+        blob_etag=blob_etag,
+        is_contain_image=is_contain_image
+    )
+
+
+def build_documents(chunks, file_name: str, blob_url: str, blob_etag: str):
+    """チャンクのイテラブルから、CosmosDBに登録するアイテムを順に作成する。
+
+    Yields:
+        CosmosDocument: CosmosDBに登録するアイテム
+    """
+    for page_number, chunk in enumerate(chunks):
+        yield build_document(chunk, page_number, file_name, blob_url, blob_etag)
+
+
+def build_page_chunk_documents(page, file_name: str, blob_url: str, blob_etag: str) -> list:
+    """PDFの1ページをチャンクに分割し、CosmosDBに登録するアイテムを作成する。
+    大きなページは.mdや.txtと同様に分割し、どのチャンクにもPDFのページ番号を設定する。
+    文字を含まないページも、画像の有無を残すため1件のアイテムにする。
+
+    Args:
+        page (PdfPage): PDFのページ
+
+    Returns:
+        list[CosmosDocument]: CosmosDBに登録するアイテムのリスト
+    """
+    chunks = list(chunk_markdown([page.markdown])) or [page.markdown]
+    return [build_document(chunk, page.page_number, file_name, blob_url, blob_etag,
+                           page.is_contain_image, chunk_index)
+            for chunk_index, chunk in enumerate(chunks)]
+
+
+def build_page_documents(pages, file_name: str, blob_url: str, blob_etag: str):
+    """PDFのページから、CosmosDBに登録するアイテムを順に作成する。ページ番号はPDFのページ番号を使う。
+
+    Args:
+        pages (Iterable[PdfPage]): PDFのページ
+
+    Yields:
+        CosmosDocument: CosmosDBに登録するアイテム
+    """
+    for page in pages:
+        yield from build_page_chunk_documents(page, file_name, blob_url, blob_etag)
+
+
+async def abuild_page_document_batches(pages, file_name: str, blob_url: str, blob_etag: str, size: int):
+    """非同期に受け取るPDFのページから、CosmosDBに登録するアイテムを指定した件数ごとに作成する。
+
+    Yields:
+        list[CosmosDocument]: CosmosDBに登録するアイテムのリスト
+    """
+    batch = []
+    async for page in pages:
+        for document in build_page_chunk_documents(page, file_name, blob_url, blob_etag):
+            batch.append(document)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+async def abuild_document_batches(chunks, file_name: str, blob_url: str, blob_etag: str, size: int):
+    """非同期に受け取るチャンクから、CosmosDBに登録するアイテムを指定した件数ごとに作成する。
+
+    Yields:
+        list[CosmosDocument]: CosmosDBに登録するアイテムのリスト
+    """
+    batch = []
+    page_number = 0
+    async for chunk in chunks:
+        batch.append(build_document(
+            chunk, page_number, file_name, blob_url, blob_etag))
+        page_number += 1
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def batched(iterable, size: int):
+    """イテラブルを指定した件数ごとのリストに分割する。
+    """
+    batch = []
+    for value in iterable:
+        batch.append(value)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def raise_if_failed(results: list, operation: str) -> None:
+    """一括処理の結果に失敗したアイテムがあれば例外を送出する。
+    """
+    failed = [result for result in results if not result.succeeded]
+    if failed:
+        raise RuntimeError(
+            f'Failed to {operation} {len(failed)} items: '
+            + ', '.join(f'{result.id} ({result.status_code})' for result in failed[:10]))
+
+
+class ChunkReconciler:
+    """登録済みのアイテムと新しいアイテムをIDとハッシュ値で比較し、必要な書き込みを決める。
+    変更・追加されたチャンクを登録してから不要になったチャンクを削除するため、更新中もファイルを検索できる。
+    """
+
+    def __init__(self, existing_items: list) -> None:
+        """
+        Args:
+            existing_items (list): 登録済みのアイテム（id, file_name, file_path, content_hash, blob_etag）
+        """
+        self.existing_by_id = {item['id']: item for item in existing_items}
+        self.existing_id_by_hash = {item.get('content_hash'): item['id']
+                                    for item in existing_items if item.get('content_hash')}
+        self.new_ids = set()
+        self.overwritten_ids = set()
+        self.upserted = 0
+        self.unchanged = 0
+
+    def plan(self, documents: list) -> tuple[list, list, list]:
+        """新しいアイテムのバッチに対して、必要な書き込みを決める。
+
+        Args:
+            documents (list[CosmosDocument]): 新しいアイテムのバッチ
+
+        Returns:
+            tuple[list, list, list]: 登録するアイテム、ETagを更新する (アイテム, パッチ操作) の組、
+                ベクトル値をコピーする (アイテム, コピー元のアイテム) の組。コピーは登録より先に行うこと
+        """
+        upserts = []
+        patches = []
+        moved = []
+        for document in documents:
+            self.new_ids.add(document.id)
+            existing = self.existing_by_id.get(document.id)
+
+            # 同じ位置に同じ内容のチャンクがある場合は、ETagのみ更新する
+            if existing and existing.get('content_hash') == document.content_hash:
+                if existing.get('blob_etag') != document.blob_etag:
+                    patches.append((existing, [
+                        {'op': 'set', 'path': '/blob_etag', 'value': document.blob_etag}]))
+                self.unchanged += 1
+                continue
+
+            # 別の位置に同じ内容のチャンクがある場合は、ベクトル値をコピーする
+            # コピー元がこの処理中に上書き済みの場合は、埋め込みキャッシュに任せる
+            moved_id = self.existing_id_by_hash.get(document.content_hash)
+            if moved_id and moved_id not in self.overwritten_ids:
+                moved.append((document, self.existing_by_id[moved_id]))
+
+            upserts.append(document)
+            if existing:
+                self.overwritten_ids.add(document.id)
+        self.upserted += len(upserts)
+        return upserts, patches, moved
+
+    def removed_items(self) -> list:
+        """新しいチャンクに含まれない登録済みのアイテムを返す。
+        """
+        return [item for item_id, item in self.existing_by_id.items()
+                if item_id not in self.new_ids]
+
+
+def lookup_embeddings(documents: list, embedding_cache) -> tuple[dict, dict]:
+    """ドキュメントのハッシュ値を計算し直し、埋め込みキャッシュを検索する。
+    デプロイ名が変わった場合に備えて、ハッシュ値は常に計算し直す。
+
+    Args:
+        documents (list[CosmosDocument]): ベクトル化するドキュメント
+        embedding_cache (EmbeddingCache): 埋め込みキャッシュ
+
+    Returns:
+        tuple[dict, dict]: キャッシュに存在したハッシュ値とベクトル値の辞書、
+            キャッシュになかったハッシュ値とベクトル化する文字列の辞書
+    """
+    for document in documents:
+        document.content_hash = compute_content_hash(document.content)
+    cached = embedding_cache.get_many(
+        list({document.content_hash for document in documents}))
+    missed = {}
+    for document in documents:
+        if document.content_hash not in cached:
+            missed[document.content_hash] = document.content
+    return cached, missed
@@ -0,0 +1,68 @@
+import os
+import re
+import unicodedata
+from collections import Counter
+
+# 1チャンクあたりに抽出するキーワードの最大数。型番やコードなどの識別子は数えない
+KEYWORD_MAX_COUNT = int(os.getenv('KEYWORD_MAX_COUNT', '20'))
+
+_KANJI = '㐀-䶿一-鿿豈-﫿々〆ヶ'
+# 漢字と数字の並び（令和6年度、540兆円、1.5%）、カタカナの並び、英数字の単語をキーワードの候補にする
+_KEYWORD_PATTERN = re.compile(
+    rf'(?:[0-9]+(?:[.,][0-9]+)*%?|[{_KANJI}])+'
+    r'|[ァ-ヺー]{2,}'
+    r'|[a-z][a-z0-9]*(?:[-_.][a-z0-9]+)*'
+)
+# 英字と数字、または記号でつながった英数字の識別子（x509、err-1024、gpt-4o、api_key）
+_IDENTIFIER_PATTERN = re.compile(r'(?=[a-z0-9_.-]*[a-z])(?=[a-z0-9_.-]*[0-9_.-])[a-z0-9]+(?:[-_.][a-z0-9]+)*')
+# 漢字と数字が混ざったキーワードを分割する。令和6年度 は 令和、6、年度 になる
+_KEYWORD_PART_PATTERN = re.compile(rf'[{_KANJI}]+|[0-9]+(?:[.,][0-9]+)*%?')
+# キーワードとして意味の薄い語
+_STOPWORDS = {
+    '場合', '以下', '以上', '今回', '本件', '前述', '後述', '当該', '各種', '一部', '全体',
+    'the', 'and', 'for', 'with', 'from', 'this', 'that', 'are', 'was', 'not', 'of', 'to', 'in', 'on', 'is', 'it', 'be', 'as', 'by', 'or', 'an',
+}
+
+
+def extract_keywords(text: str, max_keywords: int = KEYWORD_MAX_COUNT) -> list[str]:
+    """文字列からキーワードを抽出する。
+    全角・半角と大文字・小文字を正規化し、出現回数の多い順に返す。
+    型番やコードなどの識別子は出現回数が少なくても検索で重要なため、最大数を超えても含める。
+
+    Args:
+        text (str): キーワードを抽出する文字列
+        max_keywords (int, optional): 抽出する識別子以外のキーワードの最大数。0以下の場合は制限しない
+
+    Returns:
+        list[str]: キーワードのリスト
+    """
+    text = unicodedata.normalize('NFKC', text).lower()
+    counts = Counter()
+    for match in _KEYWORD_PATTERN.finditer(text):
+        keyword = match.group().rstrip('.,')
+        parts = _KEYWORD_PART_PATTERN.findall(keyword)
+        # 複合語のまま一致しない検索語にも一致するよう、複合語を構成する語も候補にする
+        for candidate in [keyword, *parts] if len(parts) > 1 else [keyword]:
+            if _is_keyword(candidate):
+                counts[candidate] += 1
+    keywords = [keyword for keyword, _ in counts.most_common()]
+    if max_keywords <= 0:
+        return keywords
+    ranked = []
+    remaining = max_keywords
+    for keyword in keywords:
+        if _IDENTIFIER_PATTERN.fullmatch(keyword):
+            ranked.append(keyword)
+        elif remaining > 0:
+            ranked.append(keyword)
+            remaining -= 1
+    return ranked
+
+
+def _is_keyword(candidate: str) -> bool:
+    """キーワードの候補が、キーワードとして意味を持つかどうかを判定する。
+    1文字の語、意味の薄い語、3桁以下の数字は除く。
+    """
+    if len(candidate) < 2 or candidate in _STOPWORDS:
+        return False
+    return not (candidate.replace(',', '').isdigit() and len(candidate) < 4)
@@ -1,16 +1,289 @@
 import logging
 import os
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass
+
 import openai
 
+from util import telemetry
+from util.clients import get_http_client
+from util.token_counter import count_tokens
+from util.vector_codec import embedding_options, to_float32
+
+# 1リクエストあたりの入力件数とトークン数の上限
+AOAI_EMBEDDING_MAX_BATCH_SIZE = int(
+    os.getenv("AOAI_EMBEDDING_MAX_BATCH_SIZE", "256"))
+AOAI_EMBEDDING_MAX_BATCH_TOKENS = int(
+    os.getenv("AOAI_EMBEDDING_MAX_BATCH_TOKENS", "32000"))
+# Embeddingモデルのデプロイのクォータ（1分あたりのトークン数とリクエスト数）。0の場合は制限しない
+AOAI_EMBEDDING_TPM = int(os.getenv("AOAI_EMBEDDING_TPM", "120000"))
+AOAI_EMBEDDING_RPM = int(os.getenv("AOAI_EMBEDDING_RPM", "720"))
+# 1バッチあたりの最大リトライ回数と、retry-afterが返されない場合の初回の待ち時間（秒）
+AOAI_EMBEDDING_MAX_RETRIES = int(os.getenv("AOAI_EMBEDDING_MAX_RETRIES", "6"))
+AOAI_EMBEDDING_BACKOFF_SECONDS = float(
+    os.getenv("AOAI_EMBEDDING_BACKOFF_SECONDS", "1"))
+
+
+class TokenBucket:
+    """1分あたりの上限をトークンバケットで制限する。
+    バケットの容量は10秒分とし、Azure OpenAIのクォータの評価単位に合わせて短時間の集中を抑える。
+    """
+
+    def __init__(self, per_minute: int) -> None:
+        self.rate = per_minute / 60
+        self.capacity = per_minute / 6
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """指定した量を予約し、予約した量を使えるまでの待ち時間を返す。
+        容量を超える量も予約できるよう、残量は負の値になることを許す。
+
+        Args:
+            amount (float): 予約する量
+
+        Returns:
+            float: 待ち時間（秒）
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+@dataclass
+class EmbeddingMetrics:
+    """EmbeddingSchedulerの累計の計測値。
+    """
+    requests: int = 0
+    inputs: int = 0
+    tokens: int = 0
+    retries: int = 0
+    # 429が返された回数と、429により待った時間の合計
+    throttled: int = 0
+    throttle_wait_seconds: float = 0.0
+    # 送信前に待った時間の合計（429による待ち時間を含む）
+    admission_wait_seconds: float = 0.0
+    # リトライ回数の上限を超えて失敗したバッチ数
+    failed_batches: int = 0
+    # 送信待ちのバッチ数（現在値）
+    queue_depth: int = 0
+
+
+class EmbeddingError(Exception):
+    """一部のバッチのベクトル化に失敗した場合の例外。成功したバッチのベクトル値を保持する。
+    """
+
+    def __init__(self, embeddings: list, cause: Exception) -> None:
+        super().__init__(
+            f'Failed to embed {embeddings.count(None)} of {len(embeddings)} inputs: {cause}')
+        # 入力と同じ順序のベクトル値のリスト。失敗した入力はNone
+        self.embeddings = embeddings
+        self.cause = cause
+
+
+class EmbeddingScheduler:
+    """Embeddingリクエストを、TPMとRPMのトークンバケットで流量を制限しながら送信する。
+    429が返された場合は retry-after の時間だけ以降のリクエストを止め、失敗したバッチのみをリトライする。
+    同期版と非同期版のサービスで共有し、同じデプロイへのリクエストの合計を制限する。
+    """
+
+    def __init__(self, tpm: int = AOAI_EMBEDDING_TPM, rpm: int = AOAI_EMBEDDING_RPM,
+                 max_retries: int = AOAI_EMBEDDING_MAX_RETRIES) -> None:
+        self.token_bucket = TokenBucket(tpm)
+        self.request_bucket = TokenBucket(rpm)
+        self.max_retries = max_retries
+        # 429が返された場合に、以降のリクエストを再開する時刻
+        self._resume_at = 0.0
+        self._metrics = EmbeddingMetrics()
+        self._lock = threading.Lock()
+
+    def metrics(self) -> dict:
+        """計測値のスナップショットを返す。
+        """
+        with self._lock:
+            return asdict(self._metrics)
+
+    def embed(self, inputs: list[str], create) -> list:
+        """文字列をバッチに分割してベクトル化する。
+
+        Args:
+            inputs (list[str]): ベクトル化する文字列のリスト
+            create (Callable[[list[str]], Any]): 1バッチ分のEmbedding APIを呼び出す関数
+
+        Returns:
+            list[array]: 入力と同じ順序のベクトル値（float32の配列）のリスト
+
+        Raises:
+            EmbeddingError: リトライ回数の上限を超えて失敗したバッチがある場合
+        """
+        batches = list(pack_batches(inputs))
+        results = [None] * len(batches)
+        pending = deque((index, 0) for index in range(len(batches)))
+        self.add_queue_depth(len(batches))
+        error = None
+        try:
+            while pending:
+                index, attempt = pending.popleft()
+                batch, tokens = batches[index]
+                time.sleep(self.admit(tokens))
+                try:
+                    results[index] = self.complete(create(batch), batch, tokens)
+                    self.add_queue_depth(-1)
+                except Exception as e:
+                    delay = self.retry_delay(e, attempt)
+                    if delay is None:
+                        self.add_queue_depth(-1)
+                        error = e
+                        continue
+                    # 429以外のエラーはこのバッチのみ待つ
+                    if not isinstance(e, openai.RateLimitError):
+                        time.sleep(delay)
+                    pending.append((index, attempt + 1))
+        finally:
+            self.add_queue_depth(-len(pending))
+
+        embeddings = []
+        for (batch, _), result in zip(batches, results):
+            embeddings.extend(result if result is not None else [None] * len(batch))
+        if error is not None:
+            raise EmbeddingError(embeddings, error)
+        return embeddings
+
+    def admit(self, tokens: int) -> float:
+        """1リクエスト分のトークン数とリクエスト数を予約し、送信までの待ち時間を返す。
+        """
+        wait = max(self.token_bucket.reserve(tokens), self.request_bucket.reserve(1))
+        with self._lock:
+            wait = max(wait, self._resume_at - time.monotonic())
+            self._metrics.admission_wait_seconds += wait
+        return wait
+
+    def complete(self, response, batch: list[str], tokens: int) -> list:
+        """成功したレスポンスを計測値に記録し、入力と同じ順序のベクトル値を返す。
+        """
+        with self._lock:
+            self._metrics.requests += 1
+            self._metrics.inputs += len(batch)
+            self._metrics.tokens += tokens
+        logging.info(f'🚀 Embedded batch: {len(batch)} inputs')
+        # レスポンスの順序は保証されないため、indexで並べ替える
+        return [to_float32(d.embedding) for d in sorted(response.data, key=lambda d: d.index)]
+
+    def retry_delay(self, error: Exception, attempt: int):
+        """エラーがリトライできる場合は、リトライまでの待ち時間を返す。
+        429の場合は retry-after の時間だけ、以降のすべてのリクエストを止める。
+
+        Args:
+            error (Exception): リクエストのエラー
+            attempt (int): このバッチのリトライ回数
+
+        Returns:
+            float | None: 待ち時間（秒）。リトライしない場合はNone
+        """
+        retryable = isinstance(error, (openai.RateLimitError, openai.APIConnectionError)) or (
+            isinstance(error, openai.APIStatusError) and error.status_code >= 500)
+        if not retryable or attempt >= self.max_retries:
+            logging.error(f'❌Error at EmbeddingScheduler: {error}')
+            with self._lock:
+                self._metrics.failed_batches += 1
+            return None
+
+        delay = _retry_after_seconds(error)
+        if delay is None:
+            delay = AOAI_EMBEDDING_BACKOFF_SECONDS * 2 ** attempt
+        with self._lock:
+            self._metrics.retries += 1
+            if isinstance(error, openai.RateLimitError):
+                self._metrics.throttled += 1
+                self._metrics.throttle_wait_seconds += delay
+                self._resume_at = max(self._resume_at, time.monotonic() + delay)
+        logging.warning(
+            f'❌ Embedding request failed ({type(error).__name__}), retrying in {delay:.1f}s')
+        return delay
+
+    def add_queue_depth(self, count: int) -> None:
+        with self._lock:
+            self._metrics.queue_depth += count
+
+
+def _retry_after_seconds(error: Exception):
+    """エラーのレスポンスヘッダーから、リトライまでの待ち時間（秒）を取得する。
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        if response.headers.get('retry-after-ms'):
+            return float(response.headers['retry-after-ms']) / 1000
+        if response.headers.get('retry-after'):
+            return float(response.headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+
+def pack_batches(inputs: list[str]):
+    """入力を件数とトークン数の上限に収まるバッチに分割する。
+
+    Args:
+        inputs (list[str]): ベクトル化する文字列のリスト
+
+    Yields:
+        tuple[list[str], int]: 1リクエストで送信する文字列のリストと、その合計トークン数
+    """
+    batch = []
+    batch_tokens = 0
+    for text in inputs:
+        tokens = count_tokens(text)
+        if batch and (len(batch) >= AOAI_EMBEDDING_MAX_BATCH_SIZE
+                      or batch_tokens + tokens > AOAI_EMBEDDING_MAX_BATCH_TOKENS):
+            yield batch, batch_tokens
+            batch = []
+            batch_tokens = 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        yield batch, batch_tokens
+
+
+# 同じデプロイへのリクエストを、プロセス内のすべてのサービスで共有して制限する
+embedding_scheduler = EmbeddingScheduler()
+
 
 class AzureOpenAIService:
 
-    def __init__(self) -> None:
-        self.openai = openai
-        self.openai.api_type = "azure"
-        self.openai.azure_endpoint = os.getenv("AOAI_ENDPOINT")
-        self.openai.api_version = os.getenv("AOAI_API_VERSION")
-        self.openai.api_key = os.getenv("AOAI_API_KEY")
+    def __init__(self, deployment: str = None, scheduler: EmbeddingScheduler = None,
+                 dimensions: int = None) -> None:
+        """
+        Args:
+            deployment (str, optional): Embeddingモデルのデプロイ名。省略時は AOAI_EMBEDDING_DEPLOYMENT
+            scheduler (EmbeddingScheduler, optional): 流量を制限するスケジューラー。
+                省略時はプロセス内で共有するスケジューラー。別のデプロイを使う場合はそのクォータに合わせて作成する
+            dimensions (int, optional): 次元数。省略時は EMBEDDING_DIMENSIONS
+        """
+        self.deployment = deployment or os.getenv("AOAI_EMBEDDING_DEPLOYMENT")
+        self.embedding_options = embedding_options(dimensions)
+        # openaiモジュールのグローバルな設定は変更せず、接続プールを共有するクライアントを保持する
+        self.client = openai.AzureOpenAI(
+            azure_endpoint=os.getenv("AOAI_ENDPOINT"),
+            api_version=os.getenv("AOAI_API_VERSION"),
+            api_key=os.getenv("AOAI_API_KEY"),
+            # リトライは EmbeddingScheduler で行うため、SDKのリトライは無効にする
+            max_retries=0,
+            http_client=get_http_client()
+        )
+        self.scheduler = scheduler or embedding_scheduler
 
     def getEmbedding(self, input) -> list:
         """ベクトル値を取得する。
@@ -22,11 +295,41 @@ class AzureOpenAIService:
             list: ベクトル値
         """
         try:
-            response = self.openai.embeddings.create(
-                input=input,
-                model=os.getenv("AOAI_EMBEDDING_DEPLOYMENT")
-            )
-            return response.data[0].embedding
+            return list(self.scheduler.embed([input], self._create)[0])
         except Exception as e:
             logging.error(f'❌Error at getEmbedding: {e}')
             raise e
+
+    def get_embeddings(self, inputs: list[str]) -> list:
+        """複数の文字列のベクトル値をまとめて取得する。
+        件数とトークン数の上限に収まるようにリクエストを分割し、TPMとRPMの上限を守りながら送信する。
+
+        Args:
+            inputs (list[str]): ベクトル化する文字列のリスト
+
+        Returns:
+            list[array]: 入力と同じ順序のベクトル値（float32の配列）のリスト
+
+        Raises:
+            EmbeddingError: リトライしても失敗したバッチがある場合。成功したバッチのベクトル値を保持する
+        """
+        try:
+            return self.scheduler.embed(inputs, self._create)
+        except Exception as e:
+            logging.error(f'❌Error at get_embeddings: {e}')
+            raise e
+        finally:
+            logging.info(f'🚀 Embedding scheduler metrics: {self.scheduler.metrics()}')
+
+    def _create(self, batch: list[str]):
+        """1バッチ分のEmbedding APIを呼び出す。
+        """
+        with telemetry.span('openai.embeddings', {'openai.inputs': len(batch)}) as span:
+            response = self.client.embeddings.create(
+                input=batch,
+                model=self.deployment,
+                **self.embedding_options
+            )
+            for key, value in telemetry.token_usage(response).items():
+                span.set(key, value)
+            return response
@@ -0,0 +1,223 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import AsyncIterator, Iterator, NamedTuple
+
+# PDFのページ抽出に使うプロセス数と、1タスクあたりのページ数
+# 1の場合はプロセスプールを使わない。2以上を設定した場合のみ、プロセス内で共有するプールを作成する
+PDF_EXTRACT_MAX_WORKERS = int(os.getenv('PDF_EXTRACT_MAX_WORKERS', '1'))
+PDF_PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', '8'))
+# このページ数以上のPDFのみプロセスプールで並列に抽出する
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', '16'))
+
+# 本文の文字サイズに対する見出しの文字サイズの割合
+_H2_SIZE_RATIO = 1.6
+_H3_SIZE_RATIO = 1.25
+# PyMuPDFのspanのflagsで太字を表すビット
+_BOLD_FLAG = 2 ** 4
+
+# プロセス内で共有するプロセスプール。初回の並列抽出時に作成する
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+class PdfPage(NamedTuple):
+    """PDFから抽出した1ページ分の内容。
+    """
+    # PDFのページ番号（1始まり）
+    page_number: int
+    markdown: str
+    is_contain_image: bool
+
+
+def _body_font_size(blocks: list) -> float:
+    """ページの本文の文字サイズを、文字数が最も多い文字サイズとして求める。
+    """
+    sizes = Counter()
+    for block in blocks:
+        for line in block['lines']:
+            for span in line['spans']:
+                sizes[round(span['size'], 1)] += len(span['text'])
+    return sizes.most_common(1)[0][0] if sizes else 0
+
+
+def page_to_markdown(page) -> str:
+    """PDFの1ページをMarkdownに変換する。
+    文字サイズから見出しを、太字のみのブロックから強調を判定し、表はMarkdownの表に変換する。
+
+    Args:
+        page (fitz.Page): PDFのページ
+
+    Returns:
+        str: Markdown形式の文字列
+    """
+    import fitz
+
+    try:
+        tables = page.find_tables().tables
+    except Exception:
+        # 表の検出に対応していないバージョンでは、表もテキストとして扱う
+        tables = []
+    table_rects = [fitz.Rect(table.bbox) for table in tables]
+
+    blocks = [block for block in page.get_text('dict', sort=True)['blocks']
+              if block.get('type') == 0]
+    body_size = _body_font_size(blocks)
+
+    # (ページ上のy座標, Markdown) の組
+    parts = []
+    for block in blocks:
+        rect = fitz.Rect(block['bbox'])
+        if any(rect.intersects(table_rect) for table_rect in table_rects):
+            continue
+
+        lines = []
+        size = 0
+        is_bold = True
+        for line in block['lines']:
+            text = ''.join(span['text'] for span in line['spans']).strip()
+            if not text:
+                continue
+            lines.append(text)
+            for span in line['spans']:
+                if span['text'].strip():
+                    size = max(size, span['size'])
+                    is_bold = is_bold and bool(span['flags'] & _BOLD_FLAG)
+        if not lines:
+            continue
+
+        if body_size and size >= body_size * _H2_SIZE_RATIO:
+            text = '## ' + ' '.join(lines)
+        elif body_size and size >= body_size * _H3_SIZE_RATIO:
+            text = '### ' + ' '.join(lines)
+        elif is_bold:
+            text = '**' + ' '.join(lines) + '**'
+        else:
+            text = '\n'.join(lines)
+        parts.append((rect.y0, text))
+
+    for table, table_rect in zip(tables, table_rects):
+        parts.append((table_rect.y0, table.to_markdown().strip()))
+
+    parts.sort(key=lambda part: part[0])
+    return '\n\n'.join(text for _, text in parts)
+
+
+def _extract_pages(path: str, start: int, end: int) -> list[PdfPage]:
+    """PDFの指定した範囲のページを抽出する。プロセスプールのワーカーで実行する。
+
+    Args:
+        path (str): PDFファイルのパス
+        start (int): 開始ページのインデックス（0始まり）
+        end (int): 終了ページのインデックス（この値を含まない）
+
+    Returns:
+        list[PdfPage]: 抽出したページのリスト
+    """
+    # PyMuPDFの読み込みは重いため、PDFを処理する時に読み込み、コールドスタートを短くする
+    import fitz
+
+    pages = []
+    with fitz.open(path) as doc:
+        for index in range(start, end):
+            page = doc.load_page(index)
+            pages.append(PdfPage(
+                page_number=index + 1,
+                markdown=page_to_markdown(page),
+                is_contain_image=bool(page.get_images())
+            ))
+    return pages
+
+
+def _page_ranges(path: str) -> list[tuple[int, int]]:
+    """PDFのページを、1タスクあたりのページ数ごとの範囲に分割する。
+    """
+    import fitz
+
+    with fitz.open(path) as doc:
+        page_count = doc.page_count
+    return [(start, min(start + PDF_PAGES_PER_TASK, page_count))
+            for start in range(0, page_count, PDF_PAGES_PER_TASK)]
+
+
+def _use_process_pool(ranges: list) -> bool:
+    """プロセスプールで並列に抽出するかどうかを判定する。
+    """
+    page_count = ranges[-1][1] if ranges else 0
+    return page_count >= PDF_PARALLEL_MIN_PAGES and PDF_EXTRACT_MAX_WORKERS > 1
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    """プロセス内で共有するプロセスプールを返す。呼び出しごとにプロセスを起動しないよう、作成は1回のみとする。
+    Functionsのワーカーは複数のスレッドでトリガーを実行するため、forkではなくspawnでプロセスを起動する。
+    """
+    global _process_pool
+    if _process_pool is None:
+        with _process_pool_lock:
+            if _process_pool is None:
+                _process_pool = ProcessPoolExecutor(
+                    max_workers=PDF_EXTRACT_MAX_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn'))
+    return _process_pool
+
+
+def iter_pdf_pages(path: str) -> Iterator[PdfPage]:
+    """PDFのページをMarkdownに変換して返す。
+    PDF_EXTRACT_MAX_WORKERS を2以上にした場合、大きなPDFは共有のプロセスプールで並列に抽出し、
+    抽出が終わった範囲から順に返すため、ページの順序は保証しない。
+
+    Args:
+        path (str): PDFファイルのパス
+
+    Yields:
+        PdfPage: 抽出したページ
+    """
+    ranges = _page_ranges(path)
+    if not _use_process_pool(ranges):
+        for start, end in ranges:
+            yield from _extract_pages(path, start, end)
+        return
+
+    executor = _get_process_pool()
+    futures = [executor.submit(_extract_pages, path, start, end)
+               for start, end in ranges]
+    try:
+        for future in as_completed(futures):
+            yield from future.result()
+    finally:
+        # 途中で失敗した場合は、まだ開始していない抽出を取り消す
+        for future in futures:
+            future.cancel()
+
+
+async def aiter_pdf_pages(path: str) -> AsyncIterator[PdfPage]:
+    """iter_pdf_pages の非同期版。抽出はスレッドまたはプロセスプールで実行し、イベントループを止めない。
+
+    Args:
+        path (str): PDFファイルのパス
+
+    Yields:
+        PdfPage: 抽出したページ
+    """
+    loop = asyncio.get_running_loop()
+    ranges = await asyncio.to_thread(_page_ranges, path)
+    if not _use_process_pool(ranges):
+        for start, end in ranges:
+            for page in await asyncio.to_thread(_extract_pages, path, start, end):
+                yield page
+        return
+
+    executor = _get_process_pool()
+    futures = [loop.run_in_executor(executor, _extract_pages, path, start, end)
+               for start, end in ranges]
+    try:
+        for future in asyncio.as_completed(futures):
+            for page in await future:
+                yield page
+    finally:
+        # 途中で失敗した場合は、まだ開始していない抽出を取り消す
+        for future in futures:
+            future.cancel()
@@ -0,0 +1,238 @@
+"""処理の段階ごとのトレース（スパン）とメトリックを記録する。
+
+既定（TELEMETRY_EXPORTER=none）では何も記録せず、span() は共有の何もしないオブジェクトを返すだけのため、負荷はほぼない。
+OpenTelemetryのライブラリは、記録を有効にした場合に初回の呼び出し時に読み込む。
+
+- none: 記録しない
+- otel: 既に設定されているOpenTelemetryのプロバイダー（opentelemetry-instrument など）に記録する
+- otlp: OTLP（HTTP）でエクスポートする。opentelemetry-exporter-otlp-proto-http が必要
+- azure_monitor: Application Insights にエクスポートする。APPLICATIONINSIGHTS_CONNECTION_STRING を使う
+"""
+import logging
+import os
+import time
+
+from util.clients import lazy_singleton
+
+TELEMETRY_EXPORTER = os.getenv('TELEMETRY_EXPORTER', 'none')
+TELEMETRY_SERVICE_NAME = os.getenv('TELEMETRY_SERVICE_NAME', 'rag-functions')
+TELEMETRY_ENABLED = TELEMETRY_EXPORTER != 'none'
+
+# メトリックとして合計する属性
+REQUEST_CHARGE = 'cosmos.request_charge'
+TOTAL_TOKENS = 'openai.total_tokens'
+
+
+class _NoopSpan:
+    """記録が無効の場合のスパン。
+    """
+
+    def __enter__(self) -> '_NoopSpan':
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        return False
+
+    def set(self, key: str, value) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    """OpenTelemetryのスパンと、段階の所要時間のメトリックを記録する。
+    """
+
+    def __init__(self, instruments, name: str, attributes: dict) -> None:
+        self._instruments = instruments
+        self._name = name
+        self._attributes = attributes
+        self._scope = None
+        self._span = None
+        self._started = 0.0
+
+    def __enter__(self) -> '_Span':
+        tracer = self._instruments['tracer']
+        self._scope = tracer.start_as_current_span(self._name, attributes=self._attributes)
+        self._span = self._scope.__enter__()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        elapsed_ms = (time.perf_counter() - self._started) * 1000
+        labels = {'stage': self._name, 'error': exc_info[0] is not None}
+        self._instruments['duration'].record(elapsed_ms, labels)
+        if REQUEST_CHARGE in self._attributes:
+            self._instruments['request_charge'].add(self._attributes[REQUEST_CHARGE], labels)
+        if TOTAL_TOKENS in self._attributes:
+            self._instruments['tokens'].add(self._attributes[TOTAL_TOKENS], labels)
+        return self._scope.__exit__(*exc_info)
+
+    def set(self, key: str, value) -> None:
+        """スパンに属性を追加する。Noneの場合は追加しない。
+        """
+        if value is None:
+            return
+        self._attributes[key] = value
+        self._span.set_attribute(key, value)
+
+
+def span(name: str, attributes: dict = None):
+    """段階のスパンを開始する。with 文で使う。
+
+    Args:
+        name (str): 段階の名前（blob.download、cosmos.query など）
+        attributes (dict, optional): スパンの属性
+
+    Returns:
+        スパン。set(key, value) で属性を追加できる
+    """
+    if not TELEMETRY_ENABLED:
+        return _NOOP_SPAN
+    return _Span(_instruments(), name, {key: value for key, value in (attributes or {}).items()
+                                        if value is not None})
+
+
+def record_stage(name: str, seconds: float, attributes: dict = None) -> None:
+    """ストリーミングの処理などで、別に計測した段階の所要時間を記録する。
+    所要時間と属性は、実行中のスパンの属性にも追加する。
+
+    Args:
+        name (str): 段階の名前
+        seconds (float): 所要時間（秒）
+        attributes (dict, optional): スパンに追加する属性（バイト数など）
+    """
+    if not TELEMETRY_ENABLED:
+        return
+    from opentelemetry import trace
+    _instruments()['duration'].record(seconds * 1000, {'stage': name, 'error': False})
+    current = trace.get_current_span()
+    current.set_attribute(f'{name}.ms', seconds * 1000)
+    for key, value in (attributes or {}).items():
+        current.set_attribute(f'{name}.{key}', value)
+
+
+def timed_chunks(name: str, chunks):
+    """バイト列の断片を返すイテレーターの、断片の取得にかかった時間とバイト数を記録する。
+    ダウンロードと後続の処理が交互に行われるため、取得の時間のみを合計する。
+
+    Args:
+        name (str): 段階の名前
+        chunks (Iterable[bytes]): バイト列の断片
+
+    Yields:
+        bytes: バイト列の断片
+    """
+    if not TELEMETRY_ENABLED:
+        yield from chunks
+        return
+    elapsed = 0.0
+    size = 0
+    iterator = iter(chunks)
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - started
+            size += len(chunk)
+            yield chunk
+    finally:
+        record_stage(name, elapsed, {'bytes': size})
+
+
+async def atimed_chunks(name: str, chunks):
+    """timed_chunks の非同期版。
+    """
+    if not TELEMETRY_ENABLED:
+        async for chunk in chunks:
+            yield chunk
+        return
+    elapsed = 0.0
+    size = 0
+    iterator = chunks.__aiter__()
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                chunk = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - started
+            size += len(chunk)
+            yield chunk
+    finally:
+        record_stage(name, elapsed, {'bytes': size})
+
+
+class RequestCharge:
+    """CosmosDBのレスポンスヘッダー（x-ms-request-charge）のRUを合計する。
+    SDKのメソッドの response_hook に渡すか、add_headers でクエリのページごとに加える。
+    """
+
+    def __init__(self) -> None:
+        self.total = 0.0
+
+    def __call__(self, headers, *args) -> None:
+        self.add_headers(headers)
+
+    def add_headers(self, headers) -> None:
+        try:
+            self.total += float((headers or {}).get('x-ms-request-charge') or 0)
+        except (TypeError, ValueError):
+            pass
+
+
+def token_usage(response) -> dict:
+    """OpenAIのレスポンスのトークン使用量を、スパンの属性として返す。
+    """
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return {}
+    return {'openai.prompt_tokens': getattr(usage, 'prompt_tokens', None),
+            TOTAL_TOKENS: getattr(usage, 'total_tokens', None)}
+
+
+def content_logging_enabled() -> bool:
+    """チャンクの本文やクエリをログに出力するかどうか。ログレベルがDEBUGの場合のみ出力する。
+    """
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+@lazy_singleton
+def _instruments() -> dict:
+    """エクスポーターを設定し、トレーサーとメトリックの計器を作成する。
+    """
+    from opentelemetry import metrics, trace
+
+    if TELEMETRY_EXPORTER == 'azure_monitor':
+        from azure.monitor.opentelemetry import configure_azure_monitor
+        configure_azure_monitor(connection_string=os.getenv('APPLICATIONINSIGHTS_CONNECTION_STRING'))
+    elif TELEMETRY_EXPORTER == 'otlp':
+        from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+        resource = Resource.create({'service.name': TELEMETRY_SERVICE_NAME})
+        tracer_provider = TracerProvider(resource=resource)
+        tracer_provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        trace.set_tracer_provider(tracer_provider)
+        metrics.set_meter_provider(MeterProvider(
+            resource=resource, metric_readers=[PeriodicExportingMetricReader(OTLPMetricExporter())]))
+
+    meter = metrics.get_meter(TELEMETRY_SERVICE_NAME)
+    return {
+        'tracer': trace.get_tracer(TELEMETRY_SERVICE_NAME),
+        'duration': meter.create_histogram('rag.stage.duration', unit='ms', description='段階ごとの所要時間'),
+        'request_charge': meter.create_counter('rag.cosmos.request_charge', unit='RU', description='CosmosDBのRU'),
+        'tokens': meter.create_counter('rag.openai.tokens', unit='{token}', description='OpenAIのトークン数'),
+    }
@@ -0,0 +1,48 @@
+import codecs
+import os
+from functools import lru_cache
+
+import tiktoken
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """トークナイザーを取得する。初回呼び出し時のみ読み込む。
+    """
+    return tiktoken.get_encoding(os.getenv('TIKTOKEN_ENCODING', 'cl100k_base'))
+
+
+def count_tokens(text: str) -> int:
+    """文字列のトークン数を数える。
+
+    Args:
+        text (str): トークン数を数える文字列
+
+    Returns:
+        int: トークン数
+    """
+    return len(_get_encoding().encode(text, disallowed_special=()))
+
+
+def split_by_tokens(text: str, max_tokens: int):
+    """文字列をトークン数の上限ごとに分割する。
+    マルチバイト文字がトークンの境界で壊れないよう、バイト列を逐次デコードする。
+
+    Args:
+        text (str): 分割する文字列
+        max_tokens (int): 1つの断片の最大トークン数
+
+    Yields:
+        str: 分割した文字列
+    """
+    encoding = _get_encoding()
+    tokens = encoding.encode(text, disallowed_special=())
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for start in range(0, len(tokens), max_tokens):
+        piece = decoder.decode(
+            encoding.decode_bytes(tokens[start:start + max_tokens]))
+        if piece:
+            yield piece
+    rest = decoder.decode(b'', final=True)
+    if rest:
+        yield rest
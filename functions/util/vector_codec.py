@@ -0,0 +1,71 @@
+import os
+from array import array
+from functools import cache
+
+# Embeddingの次元数。text-embedding-3 系のモデルの dimensions パラメーターで次元を削減する。0の場合はモデルの既定値
+EMBEDDING_DIMENSIONS = int(os.getenv('EMBEDDING_DIMENSIONS', '0'))
+# CosmosDBに保存するベクトル値の小数点以下の桁数。0の場合は丸めない
+VECTOR_DECIMAL_PLACES = int(os.getenv('VECTOR_DECIMAL_PLACES', '6'))
+
+
+def embedding_options(dimensions: int = None) -> dict:
+    """Embedding APIに渡す追加のパラメーターを返す。
+
+    Args:
+        dimensions (int, optional): 次元数。省略時は EMBEDDING_DIMENSIONS
+
+    Returns:
+        dict: 次元数が指定されている場合は dimensions を含む辞書
+    """
+    dimensions = EMBEDDING_DIMENSIONS if dimensions is None else dimensions
+    return {'dimensions': dimensions} if dimensions > 0 else {}
+
+
+def embedding_model_key(deployment: str, dimensions: int = None) -> str:
+    """Embeddingのキャッシュのキーに使う、デプロイ名と次元数を組み合わせた文字列を返す。
+    次元数を変更した場合に、異なる次元のベクトル値をキャッシュから使わないようにする。
+    """
+    dimensions = EMBEDDING_DIMENSIONS if dimensions is None else dimensions
+    return f'{deployment}@{dimensions}' if dimensions > 0 else deployment
+
+
+def to_float32(vector) -> array:
+    """ベクトル値をfloat32の配列に変換する。Pythonのfloatのリストの約1/8のメモリで保持できる。
+
+    Args:
+        vector (Iterable[float]): ベクトル値
+
+    Returns:
+        array: float32の配列
+    """
+    if isinstance(vector, array) and vector.typecode == 'f':
+        return vector
+    return array('f', vector)
+
+
+def encode_vector(vector) -> list:
+    """CosmosDBに保存するため、ベクトル値をJSONに変換できるリストにする。
+    float32の精度を超える桁はJSONの文字数を増やすだけのため、小数点以下の桁数を丸める。
+    丸めは新しく計算したベクトル値を書き込む時に1回だけ行う（CosmosDBから読み込んだベクトル値は丸め済み）。
+
+    Args:
+        vector (Iterable[float]): ベクトル値
+
+    Returns:
+        list: floatのリスト
+    """
+    if VECTOR_DECIMAL_PLACES <= 0 or not len(vector):
+        return list(vector)
+    # 配列全体をまとめて丸める。float32の配列はバッファーをそのまま読み込む
+    np = _numpy()
+    return np.round(np.asarray(vector, dtype=np.float64), VECTOR_DECIMAL_PLACES).tolist()
+
+
+
+@cache
+def _numpy():
+    """numpyを初回の呼び出し時に読み込む。
+    numpyの読み込みはコールドスタートの時間に含まれるため、ベクトル値を保存する時まで遅らせる。
+    """
+    import numpy
+    return numpy
@@ -0,0 +1,237 @@
+import os
+from datetime import datetime, timezone
+
+import openai
+
+from domain.cosmos_document import CosmosDocument
+from util.embedding_cache import compute_content_hash
+from util.openai_service import EmbeddingError
+from util.vector_codec import encode_vector
+
+# ベクトル化の最大試行回数。超えたアイテムはデッドレターのコンテナーに記録し、ベクトル化を諦める
+VECTOR_MAX_ATTEMPTS = int(os.getenv('VECTOR_MAX_ATTEMPTS', '3'))
+# Embeddingモデルの切り替え中に、別のフィールドにも新しいデプロイのベクトル値を書き込む（デュアルライト）。空の場合は書き込まない
+VECTOR_DUAL_WRITE_FIELD = os.getenv('VECTOR_DUAL_WRITE_FIELD', '')
+VECTOR_DUAL_WRITE_DEPLOYMENT = os.getenv('VECTOR_DUAL_WRITE_DEPLOYMENT', '')
+VECTOR_DUAL_WRITE_DIMENSIONS = int(os.getenv('VECTOR_DUAL_WRITE_DIMENSIONS', '0'))
+
+
+def plan_vector_updates(feed_docs: list, states: dict) -> tuple[list, list, int]:
+    """変更フィードのアイテムのうち、ベクトル化が必要なものを決める。
+    変更フィードは同じリビジョンを再配信することがあるため、現在のアイテムの状態と比較して処理済みのものを除く。
+
+    - 削除済み、または_etagが異なる（新しいリビジョンがある、または処理済み）アイテムは処理しない
+    - ベクトル値の計算元のハッシュ値が内容のハッシュ値と同じアイテムは、フラグのみ更新する
+
+    Args:
+        feed_docs (list): vector_update_flagがTrueの変更フィードのアイテム
+        states (dict): アイテムのIDと現在の状態の辞書（CosmosService.get_vector_states）
+
+    Returns:
+        tuple[list, list, int]: ベクトル化する (変更フィードのアイテム, CosmosDocument) の組、
+            フラグのみ更新する (アイテム, パッチ操作, 条件) の組、処理しないアイテム数
+    """
+    pending = []
+    patches = []
+    skipped = 0
+    for doc in feed_docs:
+        state = states.get(doc['id'])
+        if state is None or state.get('_etag') != doc.get('_etag'):
+            skipped += 1
+            continue
+
+        document = CosmosDocument.from_dict(doc)
+        document.content_hash = compute_content_hash(document.content)
+        if document.vector and document.vector_hash == document.content_hash:
+            patches.append((doc, [
+                {'op': 'set', 'path': '/vector_update_flag', 'value': False},
+                {'op': 'set', 'path': '/content_hash', 'value': document.content_hash},
+            ], _condition(doc)))
+            continue
+        pending.append((doc, document))
+    return pending, patches, skipped
+
+
+def embedding_groups(pending: list, missed: dict) -> list[dict]:
+    """キャッシュになかった文字列を、1回の get_embeddings で送信するグループに分ける。
+    ベクトル化に失敗したことのあるアイテムは1件ずつ送信し、同じバッチの他のアイテムを巻き込まないようにする。
+
+    Args:
+        pending (list): plan_vector_updates が返したベクトル化するアイテム
+        missed (dict): キャッシュになかったハッシュ値とベクトル化する文字列の辞書
+
+    Returns:
+        list[dict]: ハッシュ値とベクトル化する文字列の辞書のリスト
+    """
+    retrying = {document.content_hash for _, document in pending if document.vector_attempts > 0}
+    groups = [{content_hash: text} for content_hash, text in missed.items() if content_hash in retrying]
+    first = {content_hash: text for content_hash, text in missed.items() if content_hash not in retrying}
+    return [first] + groups if first else groups
+
+
+def vector_field_operations(field: str, embedding, vector_hash: str) -> list:
+    """ベクトル値と、その計算元のハッシュ値（{field}_hash）を書き込むパッチ操作を返す。
+
+    Args:
+        field (str): ベクトル値のフィールド名（vector、vector_v2 など）
+        embedding (Iterable[float]): ベクトル値
+        vector_hash (str): ベクトル値を計算したデプロイと内容のハッシュ値
+
+    Returns:
+        list: パッチ操作のリスト
+    """
+    return [
+        {'op': 'set', 'path': f'/{field}', 'value': encode_vector(embedding)},
+        {'op': 'set', 'path': f'/{field}_hash', 'value': vector_hash},
+    ]
+
+
+def dual_write_inputs(pending: list, embeddings: dict) -> dict:
+    """ベクトル化に成功したアイテムのうち、デュアルライトでベクトル化する文字列を返す。
+
+    Args:
+        pending (list): plan_vector_updates が返したベクトル化するアイテム
+        embeddings (dict): ハッシュ値とベクトル値の辞書
+
+    Returns:
+        dict: ハッシュ値とベクトル化する文字列の辞書
+    """
+    return {document.content_hash: document.content for _, document in pending
+            if document.content_hash in embeddings}
+
+
+class EmbeddingOutcome:
+    """グループごとのベクトル化の結果を集める。
+    入力の内容が原因の失敗（400）はアイテムごとの失敗として記録し、それ以外の失敗は全体の失敗として保持する。
+    """
+
+    def __init__(self) -> None:
+        # ハッシュ値とベクトル値の辞書
+        self.embeddings = {}
+        # ハッシュ値と失敗の理由の辞書
+        self.errors = {}
+        # 全体の失敗（レート制限、接続エラーなど）。成功したアイテムを更新してから送出する
+        self.error = None
+        # デュアルライトのハッシュ値とベクトル値の辞書。デュアルライトしない場合はNone
+        self.dual_embeddings = None
+        # デュアルライトで入力の内容が原因で失敗した（400）ハッシュ値と失敗の理由の辞書
+        self.dual_errors = {}
+
+    def add(self, group: dict, embeddings: list = None, error: EmbeddingError = None) -> None:
+        """1グループの結果を追加する。
+
+        Args:
+            group (dict): ハッシュ値とベクトル化する文字列の辞書
+            embeddings (list, optional): 成功した場合のベクトル値のリスト
+            error (EmbeddingError, optional): 失敗した場合の例外
+        """
+        if error is None:
+            self.embeddings.update(zip(group, embeddings))
+            return
+        content_error = isinstance(error.cause, openai.BadRequestError)
+        for content_hash, embedding in zip(group, error.embeddings):
+            if embedding is not None:
+                self.embeddings[content_hash] = embedding
+            elif content_error:
+                self.errors[content_hash] = f'{type(error.cause).__name__}: {error.cause}'
+        if not content_error:
+            self.error = self.error or error
+
+    def add_dual_write(self, inputs: dict, embeddings: list = None, error: EmbeddingError = None) -> None:
+        """デュアルライトのベクトル化の結果を追加する。
+        入力の内容が原因の失敗（400）はアイテムごとの失敗として記録し、元のフィールドのみ更新する（バックフィルで処理し直す）。
+        それ以外の失敗は全体の失敗とし、失敗したアイテムは両方のフィールドとも更新せずに再実行に任せる。
+
+        Args:
+            inputs (dict): dual_write_inputs が返したハッシュ値と文字列の辞書
+            embeddings (list, optional): 成功した場合のベクトル値のリスト
+            error (EmbeddingError, optional): 失敗した場合の例外
+        """
+        if error is not None:
+            embeddings = error.embeddings
+            if isinstance(error.cause, openai.BadRequestError):
+                self.dual_errors.update({content_hash: f'{type(error.cause).__name__}: {error.cause}'
+                                         for content_hash, embedding in zip(inputs, embeddings) if embedding is None})
+            else:
+                self.error = self.error or error
+        self.dual_embeddings = {content_hash: embedding for content_hash, embedding in zip(inputs, embeddings)
+                                if embedding is not None}
+
+
+def finish_vector_updates(pending: list, embeddings: dict, errors: dict,
+                          dual_embeddings: dict = None, dual_errors: dict = None) -> tuple[list, list]:
+    """ベクトル化の結果から、アイテムのパッチとデッドレターの記録を作成する。
+    パッチはアイテムの内容が変わっていない場合のみ適用する条件付きとし、並行して更新された内容を上書きしない。
+
+    Args:
+        pending (list): plan_vector_updates が返したベクトル化するアイテム
+        embeddings (dict): ハッシュ値とベクトル値の辞書
+        errors (dict): ベクトル化に失敗したハッシュ値と失敗の理由の辞書
+        dual_embeddings (dict, optional): デュアルライトのハッシュ値とベクトル値の辞書。
+            指定した場合、デュアルライトのベクトル値がないアイテムは更新しない
+        dual_errors (dict, optional): デュアルライトで入力の内容が原因で失敗したハッシュ値の辞書。
+            これらのアイテムは元のフィールドのみ更新し、デュアルライトのフィールドはバックフィルに任せる
+
+    Returns:
+        tuple[list, list]: (アイテム, パッチ操作, 条件) の組のリスト、デッドレターの記録のリスト
+    """
+    patches = []
+    dead_letters = []
+    for doc, document in pending:
+        embedding = embeddings.get(document.content_hash)
+        if embedding is not None:
+            operations = [
+                {'op': 'set', 'path': '/vector', 'value': encode_vector(embedding)},
+                {'op': 'set', 'path': '/vector_update_flag', 'value': False},
+                {'op': 'set', 'path': '/content_hash', 'value': document.content_hash},
+                {'op': 'set', 'path': '/vector_hash', 'value': document.content_hash},
+                {'op': 'set', 'path': '/vector_attempts', 'value': 0},
+                {'op': 'set', 'path': '/vector_error', 'value': ''},
+            ]
+            if dual_embeddings is not None:
+                dual_embedding = dual_embeddings.get(document.content_hash)
+                if dual_embedding is not None:
+                    operations += vector_field_operations(
+                        VECTOR_DUAL_WRITE_FIELD, dual_embedding,
+                        compute_content_hash(document.content, VECTOR_DUAL_WRITE_DEPLOYMENT,
+                                             VECTOR_DUAL_WRITE_DIMENSIONS))
+                elif document.content_hash not in (dual_errors or {}):
+                    # 全体の失敗でデュアルライトできなかったアイテムは、再実行に任せる
+                    continue
+            patches.append((doc, operations, _condition(doc)))
+            continue
+
+        error = errors.get(document.content_hash)
+        if error is None:
+            # 全体の失敗で処理できなかったアイテムは、試行回数を増やさずに再実行に任せる
+            continue
+        attempts = document.vector_attempts + 1
+        operations = [
+            {'op': 'set', 'path': '/vector_attempts', 'value': attempts},
+            {'op': 'set', 'path': '/vector_error', 'value': error[:1000]},
+        ]
+        if attempts >= VECTOR_MAX_ATTEMPTS:
+            # 上限に達したアイテムはフラグを下ろし、変更フィードで再実行されないようにする
+            operations.append({'op': 'set', 'path': '/vector_update_flag', 'value': False})
+            dead_letters.append({
+                'id': document.id,
+                'file_name': document.file_name,
+                'file_path': document.file_path,
+                'page_number': document.page_number,
+                'content_hash': document.content_hash,
+                'attempts': attempts,
+                'error': error,
+                'failed_at': datetime.now(timezone.utc).isoformat(),
+            })
+        # フラグがTrueのままのパッチは新しいリビジョンとなり、変更フィードで再実行される
+        patches.append((doc, operations, _condition(doc)))
+    return patches, dead_letters
+
+
+def _condition(doc) -> str:
+    """アイテムの内容が変更フィードのリビジョンから変わっていない場合のみ、パッチを適用する条件を返す。
+    """
+    content_hash = doc.get('content_hash')
+    if not content_hash:
+        return None
+    return f"FROM c WHERE c.content_hash = '{content_hash}'"